@@ -0,0 +1,71 @@
+"""Benchmark queue claim latency at 10k/100k/1M rows
+
+Fills job_queue_records with N rows, of which 10% are QUEUED and the
+rest finished, the typical shape of a long-lived queue, and measures the
+latency of `dequeue_batch(1)` and `dequeue_batch(100)`.
+
+The benchmark TRUNCATES job_queue_records, so point POSTGRES_DSN at a
+scratch database:
+
+    POSTGRES_DSN=postgresql+asyncpg://.../scratch \\
+        python -m benchmarks.bench_dequeue --truncate [n_rows ...]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import sqlalchemy as sa
+
+from cmgd_nextflow_worker import external_db
+
+FILL_SQL = f"""
+INSERT INTO job_queue_records (job_name, job_metadata, job_priority, job_status, _inserted_at)
+SELECT
+    'bench-' || i,
+    jsonb_build_object('sample_id', 'bench-' || i),
+    (random() * 10)::int,
+    CASE WHEN i % 10 = 0 THEN '{external_db.QUEUED}' ELSE '{external_db.COMPLETED}' END,
+    now() - (random() * interval '2 days')
+FROM generate_series(1, :n_rows) AS i
+"""
+
+
+async def fill(n_rows: int) -> None:
+    async with external_db.get_engine().begin() as conn:
+        await conn.execute(sa.text("TRUNCATE job_queue_records"))
+        await conn.execute(sa.text(FILL_SQL), {"n_rows": n_rows})
+        await conn.execute(sa.text("ANALYZE job_queue_records"))
+
+
+async def measure(batch_size: int, repeat: int) -> list[float]:
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await external_db.dequeue_batch(batch_size)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def main(sizes: list[int], repeat: int) -> None:
+    await external_db.create_tables()
+    print(f"{'rows':>9}  {'batch':>5}  {'p50 ms':>8}  {'p95 ms':>8}  {'max ms':>8}")
+    for n_rows in sizes:
+        await fill(n_rows)
+        for batch_size in (1, 100):
+            latencies = sorted(await measure(batch_size, repeat))
+            p50 = statistics.median(latencies)
+            p95 = latencies[int(0.95 * (len(latencies) - 1))]
+            print(f"{n_rows:>9}  {batch_size:>5}  {p50 * 1000:>8.2f}  {p95 * 1000:>8.2f}  {latencies[-1] * 1000:>8.2f}")
+    await external_db.dispose_engine()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark queue claim latency")
+    parser.add_argument("sizes", type=int, nargs="*", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--truncate", action="store_true", help="confirm that job_queue_records may be truncated")
+    args = parser.parse_args()
+    if not args.truncate:
+        parser.error("this benchmark truncates job_queue_records; pass --truncate to confirm")
+    asyncio.run(main(args.sizes, args.repeat))
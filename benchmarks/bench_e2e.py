@@ -0,0 +1,189 @@
+"""End-to-end throughput against the fake Slurm toolchain
+
+Installs `benchmarks.fake_slurm` first on PATH and pushes N samples
+through one of two paths:
+
+  runner    runner.py's QueueRunner draining cmgd_queue into sbatch
+  workflow  SlurmBatchJobWorkflow on Temporal's local dev server, from
+            submission through status checks to storing the final sacct
+            record (needs the dev server binary, downloaded on first use)
+
+and reports samples/minute, end-to-end latency percentiles and
+subprocess / database call counts.
+
+Both modes TRUNCATE the tables they use, so point POSTGRES_DSN at a
+scratch database:
+
+    POSTGRES_DSN=postgresql+asyncpg://.../scratch \\
+        python -m benchmarks.bench_e2e --mode runner --truncate 100 1000 10000
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks import fake_slurm
+
+# Settings are read at import, so tune the package for short fake jobs
+# before importing it.
+BENCH_SETTINGS = {
+    "SACCT_POLL_MIN_INTERVAL": "1",
+    "SACCT_POLL_INTERVAL": "5",
+    "RUNNER_CAPACITY_INTERVAL": "1",
+    "STATUS_CHECK_INTERVAL": "1",
+    "STATUS_CHECK_MAX_INTERVAL": "5",
+    "RESULT_FLUSH_INTERVAL": "0.2",
+    "CMGD_NOTIFY_DIR": "",
+    # recovery is not what is measured here
+    "RECONCILE_INTERVAL": "0",
+}
+
+
+def setup_fake_slurm(args: argparse.Namespace) -> str:
+    work_dir = tempfile.mkdtemp(prefix="fake-slurm-")
+    bin_dir = os.path.join(work_dir, "bin")
+    fake_slurm.install(bin_dir)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+    os.environ["FAKE_SLURM_DB"] = os.path.join(work_dir, "state.db")
+    os.environ["FAKE_SLURM_QUEUE_WAIT"] = str(args.queue_wait)
+    os.environ["FAKE_SLURM_RUNTIME"] = str(args.runtime)
+    os.environ["FAKE_SLURM_FAILURE_RATE"] = str(args.failure_rate)
+    os.environ["FAKE_SLURM_LATENCY"] = str(args.latency)
+    for name, value in BENCH_SETTINGS.items():
+        os.environ.setdefault(name, value)
+    return work_dir
+
+
+def percentiles(values: list[float]) -> str:
+    if len(values) < 2:
+        return "n/a"
+    cuts = statistics.quantiles(values, n=100)
+    return f"p50={cuts[49]:.2f}s p90={cuts[89]:.2f}s p99={cuts[98]:.2f}s max={max(values):.2f}s"
+
+
+def report(n: int, elapsed: float, latencies: list[float], commands: dict, db_calls: int) -> None:
+    print(f"  {n} samples in {elapsed:.1f}s: {n / elapsed * 60:.0f} samples/min")
+    print(f"  latency: {percentiles(latencies)}")
+    for name, histogram in sorted(commands.items()):
+        print(
+            f"  {name}: {histogram.count} calls, {histogram.failures} failed, "
+            f"mean {histogram.sum / max(histogram.count, 1) * 1000:.0f}ms"
+        )
+    print(f"  database calls: {db_calls}")
+
+
+async def bench_runner(n: int) -> None:
+    import asyncpg
+    import runner
+    from cmgd_nextflow_worker.capacity import CapacityTracker
+    from cmgd_nextflow_worker.config import settings
+    from cmgd_nextflow_worker.queue_notify import asyncpg_dsn
+
+    await runner.create_database_table()
+    conn = await asyncpg.connect(asyncpg_dsn(settings.POSTGRES_DSN))
+    try:
+        await conn.execute("TRUNCATE cmgd_queue")
+        runner.command_runner.histograms.clear()
+        queue_runner = runner.QueueRunner(
+            settings.POSTGRES_DSN,
+            capacity=CapacityTracker(runner.run_cmd, limit=n),
+            report_interval=3600,
+        )
+        start = time.perf_counter()
+        await conn.executemany(
+            "INSERT INTO cmgd_queue (sample_id, run_ids, status) VALUES ($1, $2, 'QUEUED')",
+            [(f"sample-{i}", f"SRR{i}") for i in range(n)],
+        )
+        task = asyncio.create_task(queue_runner.run())
+        while await conn.fetchval("SELECT count(*) FROM cmgd_queue WHERE status = 'PROCESSED'") < n:
+            if task.done():
+                task.result()
+            await asyncio.sleep(0.1)
+        elapsed = time.perf_counter() - start
+        queue_runner.stop()
+        await task
+        rows = await conn.fetch("SELECT extract(epoch FROM _updated_at - _created_at) AS latency FROM cmgd_queue")
+    finally:
+        await conn.close()
+    db_calls = sum(queue_runner.timings[stage].count for stage in ("claim", "mark"))
+    report(n, elapsed, [float(row["latency"]) for row in rows], runner.command_runner.histograms, db_calls)
+
+
+async def bench_workflow(n: int) -> None:
+    import sqlalchemy as sa
+    from temporalio.testing import WorkflowEnvironment
+    from cmgd_nextflow_worker import external_db
+    from cmgd_nextflow_worker.activities import ActivityContainer
+    from cmgd_nextflow_worker.config import settings
+    from cmgd_nextflow_worker.models import CMGDJobInput
+    from cmgd_nextflow_worker.worker import create_worker, worker_profiles
+    from cmgd_nextflow_worker.workflow import SlurmBatchJobWorkflow
+
+    await external_db.create_tables()
+    async with external_db.get_engine().begin() as conn:
+        await conn.execute(sa.text("TRUNCATE slurm_batch_job_results"))
+
+    db_calls = 0
+
+    def count_db_call(*args) -> None:
+        nonlocal db_calls
+        db_calls += 1
+
+    sa.event.listen(external_db.get_engine().sync_engine, "before_cursor_execute", count_db_call)
+    activities = ActivityContainer(external_db.get_engine())
+    async with await WorkflowEnvironment.start_local() as env:
+        workers = [create_worker(env.client, profile) for profile in worker_profiles(activities).values()]
+        worker_tasks = [asyncio.create_task(worker.run()) for worker in workers]
+
+        async def one(i: int) -> float:
+            start = time.perf_counter()
+            await env.client.execute_workflow(
+                SlurmBatchJobWorkflow.run,
+                CMGDJobInput(
+                    sample_id=f"sample-{i}",
+                    run_ids=[f"SRR{i}"],
+                    status_check_interval=settings.STATUS_CHECK_INTERVAL,
+                    status_check_max_interval=settings.STATUS_CHECK_MAX_INTERVAL,
+                ),
+                id=f"bench-{i}",
+                task_queue=settings.TASK_QUEUE,
+            )
+            return time.perf_counter() - start
+
+        try:
+            start = time.perf_counter()
+            latencies = await asyncio.gather(*[one(i) for i in range(n)])
+            elapsed = time.perf_counter() - start
+        finally:
+            for worker in workers:
+                await worker.shutdown()
+            await asyncio.gather(*worker_tasks, return_exceptions=True)
+    sa.event.remove(external_db.get_engine().sync_engine, "before_cursor_execute", count_db_call)
+    report(n, elapsed, latencies, activities.runner.histograms, db_calls)
+
+
+async def main(mode: str, sizes: list[int]) -> None:
+    bench = bench_runner if mode == "runner" else bench_workflow
+    for n in sizes:
+        print(f"{mode}, {n} samples:")
+        await bench(n)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("sizes", type=int, nargs="*", default=[100, 1_000, 10_000])
+    parser.add_argument("--mode", choices=["runner", "workflow"], default="runner")
+    parser.add_argument("--queue-wait", type=float, default=1, help="mean fake Slurm queue wait (s)")
+    parser.add_argument("--runtime", type=float, default=2, help="mean fake Slurm job runtime (s)")
+    parser.add_argument("--failure-rate", type=float, default=0)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per fake Slurm command")
+    parser.add_argument("--truncate", action="store_true",
+                        help="confirm that the benchmark may truncate its tables")
+    args = parser.parse_args()
+    if not args.truncate:
+        sys.exit("refusing to run without --truncate (the benchmark empties its tables)")
+    print(f"fake slurm state in {setup_fake_slurm(args)}")
+    asyncio.run(main(args.mode, args.sizes))
@@ -0,0 +1,77 @@
+"""Benchmark sacct JSON parsing on synthetic multi-job payloads
+
+Builds 1k- and 10k-job `sacct --json` documents by copying the job in
+`sacct-out-example.json` and compares parse time and peak memory of the
+full-document parse against the summary-only parse, with and without
+the optional msgspec backend.
+
+Usage:
+    python -m benchmarks.bench_sacct_parse [n_jobs ...]
+"""
+import copy
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from cmgd_nextflow_worker import sacct
+
+EXAMPLE = os.path.join(os.path.dirname(__file__), '..', 'sacct-out-example.json')
+
+
+def make_payload(n_jobs: int) -> bytes:
+    with open(EXAMPLE) as f:
+        doc = json.load(f)
+    template = doc['jobs'][0]
+    jobs = []
+    for i in range(n_jobs):
+        job = copy.deepcopy(template)
+        job['job_id'] = template['job_id'] + i
+        for step in job['steps']:
+            step['step']['id']['job_id'] = job['job_id']
+        jobs.append(job)
+    doc['jobs'] = jobs
+    return json.dumps(doc).encode('utf-8')
+
+
+def measure(fn, data: bytes, repeat: int = 3) -> tuple[float, float]:
+    """Return (best wall time in seconds, peak traced memory in MiB)"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(data)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    fn(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak / 2**20
+
+
+def main(sizes: list[int]) -> None:
+    msgspec = sacct.msgspec
+    cases = [
+        ("json full document", lambda data: json.loads(data), None),
+        ("json summaries", sacct.parse_sacct_summaries, None),
+    ]
+    if msgspec is not None:
+        cases += [
+            ("msgspec full document", sacct.parse_sacct_document, msgspec),
+            ("msgspec summaries", sacct.parse_sacct_summaries, msgspec),
+        ]
+    else:
+        print("msgspec not installed; only the json backend is measured")
+
+    print(f"{'jobs':>6}  {'payload MiB':>11}  {'parser':<22}  {'time ms':>9}  {'peak MiB':>9}")
+    for n_jobs in sizes:
+        data = make_payload(n_jobs)
+        for name, fn, backend in cases:
+            sacct.msgspec = backend
+            elapsed, peak = measure(fn, data)
+            print(f"{n_jobs:>6}  {len(data) / 2**20:>11.1f}  {name:<22}  {elapsed * 1000:>9.1f}  {peak:>9.1f}")
+    sacct.msgspec = msgspec
+
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or [1000, 10000])
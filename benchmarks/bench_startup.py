@@ -0,0 +1,48 @@
+"""Benchmark process startup of the worker and CLI entry points
+
+Each target is run in a fresh interpreter `--repeat` times and the median
+wall time is reported, which is what a short-lived worker on a compute
+node or a `cmgd-db` call in a script pays before doing any work. No
+database or Temporal server is needed; nothing connects.
+
+    python -m benchmarks.bench_startup [--repeat 10]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+TARGETS = {
+    "python": "pass",
+    "import external_db": "import cmgd_nextflow_worker.external_db",
+    "import activities": "import cmgd_nextflow_worker.activities",
+    "import worker": "import cmgd_nextflow_worker.worker",
+    "cmgd-db --help": (
+        "import sys; sys.argv = ['cmgd-db', '--help']\n"
+        "from cmgd_nextflow_worker.external_db import main\n"
+        "try:\n    main()\nexcept SystemExit:\n    pass"
+    ),
+}
+
+
+def run(code: str) -> tuple[float, str]:
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    return time.perf_counter() - start, result.stdout
+
+
+def main(repeat: int) -> None:
+    for name, code in TARGETS.items():
+        # first run warms the filesystem and bytecode caches
+        _, stdout = run(code)
+        timings = [run(code)[0] for _ in range(repeat)]
+        noise = "" if name == "cmgd-db --help" or not stdout else f"  (prints {len(stdout.splitlines())} lines)"
+        print(f"{name:20s} median {statistics.median(timings) * 1000:6.0f}ms  min {min(timings) * 1000:6.0f}ms{noise}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    main(args.repeat)
@@ -0,0 +1,317 @@
+"""A fake Slurm toolchain for load tests without a cluster
+
+`sbatch`, `sacct`, `squeue` and `scancel` are emulated on top of a small
+SQLite state store. Jobs are never run: a job's state is derived from the
+time it was submitted and the queue wait, runtime and outcome drawn for it
+at submission, so thousands of jobs cost nothing but a row each.
+
+Behaviour is configured through the environment:
+
+    FAKE_SLURM_DB            path of the state store (required)
+    FAKE_SLURM_QUEUE_WAIT    mean seconds a job stays PENDING (default 5)
+    FAKE_SLURM_RUNTIME       mean seconds a job stays RUNNING (default 30)
+    FAKE_SLURM_FAILURE_RATE  fraction of jobs that end FAILED (default 0)
+    FAKE_SLURM_LATENCY       seconds every command takes (default 0.05)
+    FAKE_SLURM_SEED          seed for the per-job draws (default 0)
+
+Install the commands into a directory that is then put first on PATH:
+
+    python -m benchmarks.fake_slurm install /tmp/fake-slurm/bin
+"""
+import json
+import os
+import random
+import sqlite3
+import stat
+import sys
+import time
+
+COMMANDS = ("sbatch", "sacct", "squeue", "scancel")
+PARTITION = "amilan"
+# slurm assigns job ids from a site specific offset
+FIRST_JOB_ID = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY,
+    name TEXT,
+    array_job_id INTEGER,
+    array_task_id INTEGER,
+    submitted REAL,
+    wait REAL,
+    runtime REAL,
+    fails INTEGER,
+    cancelled REAL,
+    script TEXT,
+    submit_line TEXT,
+    comment TEXT
+)
+"""
+
+
+def _env(name: str, default: float) -> float:
+    return float(os.getenv(name, default))
+
+
+def connect() -> sqlite3.Connection:
+    path = os.environ["FAKE_SLURM_DB"]
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(SCHEMA)
+    return conn
+
+
+def job_state(job: sqlite3.Row, now: float) -> tuple[str, float, float]:
+    """Return (state, start, end) of a job at `now`; 0 means not (yet) set"""
+    start = job["submitted"] + job["wait"]
+    end = start + job["runtime"]
+    cancelled = job["cancelled"]
+    if cancelled is not None and cancelled < min(now, end):
+        return "CANCELLED", (start if cancelled >= start else 0), cancelled
+    if now < start:
+        return "PENDING", 0, 0
+    if now < end:
+        return "RUNNING", start, 0
+    return ("FAILED" if job["fails"] else "COMPLETED"), start, end
+
+
+def _number(value: int, set: bool = True) -> dict:
+    return {'set': set, 'infinite': False, 'number': value}
+
+
+def sacct_job(job: sqlite3.Row, now: float) -> dict:
+    """A job record shaped like `sacct --json` output (see sacct-out-example.json)"""
+    state, start, end = job_state(job, now)
+    submitted = int(job["submitted"])
+    elapsed = int((end or now) - start) if start else 0
+    return_code = 1 if state == "FAILED" else 0
+    is_array = job["array_job_id"] is not None
+    return {
+        'job_id': job["job_id"],
+        'name': job["name"],
+        'partition': PARTITION,
+        'nodes': "c3cpu-a2-u1-1" if start else "None assigned",
+        'state': {'current': [state], 'reason': "None"},
+        'exit_code': {
+            'status': ["ERROR" if return_code else "SUCCESS"],
+            'return_code': _number(return_code),
+        },
+        'time': {
+            'elapsed': elapsed,
+            'eligible': submitted,
+            'submission': submitted,
+            'start': int(start),
+            'end': int(end),
+            'suspended': 0,
+            'limit': _number(24 * 60),
+            'total': {'seconds': elapsed, 'microseconds': 0},
+            'user': {'seconds': elapsed, 'microseconds': 0},
+            'system': {'seconds': 0, 'microseconds': 0},
+        },
+        'array': {
+            'job_id': job["array_job_id"] or 0,
+            'task_id': _number(job["array_task_id"] or 0, set=is_array),
+            'task': "",
+        },
+        'required': {
+            'CPUs': 1,
+            'memory_per_cpu': _number(0, set=False),
+            'memory_per_node': _number(4096),
+            'memory': 4096,
+        },
+        'script': job["script"],
+        'submit_line': job["submit_line"],
+        'comment': {'administrator': "", 'job': job["comment"] or "", 'system': ""},
+        'steps': [{
+            'step': {'name': "batch"},
+            'state': state,
+            'tres': {
+                'requested': {
+                    'max': [{'type': "mem", 'name': "", 'id': 2, 'count': 512 * 1024 * 1024}],
+                    'total': [{'type': "fs", 'name': "disk", 'id': 6, 'count': 1024 * 1024}],
+                },
+                'consumed': {
+                    'total': [{'type': "fs", 'name': "disk", 'id': 6, 'count': 2048 * 1024}],
+                },
+            },
+        }] if start else [],
+    }
+
+
+def _draws(job_id: int) -> tuple[float, float, bool]:
+    # per-job draws, reproducible for a given seed
+    rng = random.Random(f"{os.getenv('FAKE_SLURM_SEED', '0')}-{job_id}")
+    wait = _env("FAKE_SLURM_QUEUE_WAIT", 5) * rng.uniform(0.5, 1.5)
+    runtime = _env("FAKE_SLURM_RUNTIME", 30) * rng.uniform(0.5, 1.5)
+    return wait, runtime, rng.random() < _env("FAKE_SLURM_FAILURE_RATE", 0)
+
+
+def sbatch(args: list[str]) -> int:
+    name = None
+    array = None
+    comment = None
+    positional = []
+    for arg in args:
+        if positional:
+            positional.append(arg)
+        elif arg.startswith("--array="):
+            array = arg.split("=", 1)[1].split("%")[0]
+        elif arg.startswith("--job-name="):
+            name = arg.split("=", 1)[1]
+        elif arg.startswith("--comment="):
+            comment = arg.split("=", 1)[1]
+        elif arg.startswith("-"):
+            continue
+        else:
+            positional.append(arg)
+    if not positional:
+        print("sbatch: error: Batch job submission failed: no script given", file=sys.stderr)
+        return 1
+    script = positional[0]
+    name = name or os.path.basename(script)
+    try:
+        with open(script) as f:
+            script_text = f.read()
+    except OSError:
+        script_text = f"#!/bin/bash\n# {script}\n"
+    tasks = [None]
+    if array is not None:
+        first, _, last = array.partition("-")
+        tasks = list(range(int(first), int(last or first) + 1))
+
+    conn = connect()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    next_id = conn.execute("SELECT coalesce(max(job_id) + 1, ?) FROM jobs", (FIRST_JOB_ID,)).fetchone()[0]
+    for offset, task_id in enumerate(tasks):
+        job_id = next_id + offset
+        wait, runtime, fails = _draws(job_id)
+        conn.execute(
+            "INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL, ?, ?, ?)",
+            (
+                job_id, name, next_id if task_id is not None else None, task_id,
+                now, wait, runtime, int(fails), script_text, " ".join(["sbatch", *args]), comment,
+            ),
+        )
+    conn.execute("COMMIT")
+    print(f"Submitted batch job {next_id}")
+    return 0
+
+
+def _lookup(conn: sqlite3.Connection, job_ids: list[str]) -> list[sqlite3.Row]:
+    jobs = {}
+    for job_id in job_ids:
+        array_job_id, sep, task_id = job_id.partition("_")
+        if sep:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE array_job_id = ? AND array_task_id = ?",
+                (int(array_job_id), int(task_id)),
+            ).fetchall()
+        else:
+            # like slurm, the array job id selects every task of the array
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE job_id = ? OR array_job_id = ?",
+                (int(job_id), int(job_id)),
+            ).fetchall()
+        for row in rows:
+            jobs[row["job_id"]] = row
+    return [jobs[job_id] for job_id in sorted(jobs)]
+
+
+def sacct(args: list[str]) -> int:
+    job_ids = []
+    since = until = None
+    for flag, value in zip(args, args[1:]):
+        if flag in ("-j", "--jobs"):
+            job_ids = [job_id for job_id in value.split(",") if job_id]
+        elif flag in ("-S", "--starttime"):
+            since = time.mktime(time.strptime(value, "%Y-%m-%dT%H:%M:%S"))
+        elif flag in ("-E", "--endtime"):
+            until = time.mktime(time.strptime(value, "%Y-%m-%dT%H:%M:%S"))
+    conn = connect()
+    if job_ids:
+        jobs = _lookup(conn, job_ids)
+    else:
+        jobs = conn.execute("SELECT * FROM jobs ORDER BY job_id").fetchall()
+    now = time.time()
+    if since is not None:
+        # like slurm: jobs that were pending or running at some point since
+        jobs = [job for job in jobs if not job_state(job, now)[2] or job_state(job, now)[2] >= since]
+    if until is not None:
+        jobs = [job for job in jobs if job["submitted"] <= until]
+    document = {
+        'meta': {'plugin': {'type': "openapi/slurmdbd", 'name': "fake_slurm"}},
+        'jobs': [sacct_job(job, now) for job in jobs],
+        'warnings': [],
+        'errors': [],
+    }
+    json.dump(document, sys.stdout)
+    return 0
+
+
+def squeue(args: list[str]) -> int:
+    header = "--noheader" not in args and "-h" not in args
+    fmt = "%i %T"
+    for arg in args:
+        if arg.startswith("--format="):
+            fmt = arg.split("=", 1)[1]
+    conn = connect()
+    now = time.time()
+    lines = []
+    for job in conn.execute("SELECT * FROM jobs ORDER BY job_id"):
+        state, _, _ = job_state(job, now)
+        if state not in ("PENDING", "RUNNING"):
+            continue
+        job_id = str(job["job_id"])
+        if job["array_job_id"] is not None:
+            job_id = f"{job['array_job_id']}_{job['array_task_id']}"
+        lines.append(
+            fmt.replace("%i", job_id)
+            .replace("%T", state)
+            .replace("%P", PARTITION)
+            .replace("%j", job["name"])
+        )
+    if header:
+        print(fmt.replace("%i", "JOBID").replace("%T", "STATE").replace("%P", "PARTITION").replace("%j", "NAME"))
+    print("\n".join(lines))
+    return 0
+
+
+def scancel(args: list[str]) -> int:
+    conn = connect()
+    now = time.time()
+    jobs = _lookup(conn, [arg for arg in args if not arg.startswith("-")])
+    conn.executemany(
+        "UPDATE jobs SET cancelled = ? WHERE job_id = ? AND cancelled IS NULL",
+        [(now, job["job_id"]) for job in jobs],
+    )
+    return 0
+
+
+def main(command: str, args: list[str]) -> int:
+    time.sleep(_env("FAKE_SLURM_LATENCY", 0.05))
+    return {"sbatch": sbatch, "sacct": sacct, "squeue": squeue, "scancel": scancel}[command](args)
+
+
+def install(bin_dir: str) -> None:
+    """Write `sbatch`, `sacct`, ... executables into `bin_dir`"""
+    os.makedirs(bin_dir, exist_ok=True)
+    here = os.path.dirname(os.path.abspath(__file__))
+    for command in COMMANDS:
+        path = os.path.join(bin_dir, command)
+        with open(path, "w") as f:
+            f.write(
+                f"#!{sys.executable}\n"
+                "import sys\n"
+                f"sys.path.insert(0, {here!r})\n"
+                "from fake_slurm import main\n"
+                f"sys.exit(main({command!r}, sys.argv[1:]))\n"
+            )
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "install":
+        sys.exit(__doc__)
+    install(sys.argv[2])
@@ -1,32 +1,60 @@
 import asyncio
-import json
+import os
+import time
+import uuid
 from temporalio import activity
 import sqlalchemy as sa
-from sqlalchemy.ext.asyncio import AsyncSession
-from .external_db import SlurmBatchJobResult
-from .models import CMGDJobInput, CommandResult
+from temporalio.client import WorkflowExecutionStatus
+from temporalio.service import RPCError, RPCStatusCode
+from .command_runner import CommandRunner
+from .config import settings
+from .external_db import (
+    COMPLETED,
+    FAILED,
+    completed_keys,
+    completion_key,
+    dequeue_batch,
+    update_job_statuses,
+)
+from .metrics import observe_slurm_times
+from .models import CMGDJobInput, CommandResult, QueueJobResult, ResourceRequest, queue_workflow_id
+from .result_writer import SacctResultWriter
+from .sacct import (
+    get_job_state,
+    is_final_job,
+    is_terminal_state,
+    job_comment,
+    parse_sacct_document,
+    summarize_job,
+)
+from .sacct_cache import SacctDocumentCache
+from .sacct_poller import SacctPoller
+from .nextflow_trace import ingest_trace, trace_path
+from .sizing import SizingModel
+from . import external_db, workdirs
 
 
 # The ActivityContainer class is a container for all the activities
 # Such a class is the recommended way to inject dependencies into activities
 class ActivityContainer:
-    def __init__(self, db_engine: sa.engine.Engine):
+    def __init__(self, db_engine: sa.engine.Engine, runner: CommandRunner | None = None):
         self.engine = db_engine
+        self.runner = runner or CommandRunner()
+        # shared across all activities so that every watched job
+        # is polled by a single batched sacct call per tick
+        # the poller keeps records of finished jobs for the storage activity
+        self.sacct_cache = SacctDocumentCache()
+        self.poller = SacctPoller(self.run_cmd, cache=self.sacct_cache)
+        # batches final sacct rows from all concurrent storage activities
+        self.result_writer = SacctResultWriter(db_engine)
+        self.sizing = SizingModel()
+        self._pruned_at: float | None = None
     
-    async def run_cmd(self, cmd: str) -> CommandResult:
-        proc = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        stdout, stderr = await proc.communicate()
-        returncode = proc.returncode
-        
-        return CommandResult(returncode, stdout, stderr)
+    async def run_cmd(self, cmd: str | list[str]) -> CommandResult:
+        return await self.runner.run(cmd)
     
     @activity.defn
-    async def sbatch_submit(self, cmd: str) -> int:
+    async def sbatch_submit(self, cmd: str | list[str]) -> int:
         result = await self.run_cmd(cmd)
         
         if result.returncode != 0:
@@ -37,44 +65,230 @@ class ActivityContainer:
             return job_id
         except ValueError:
             raise Exception(f"Error parsing job id: {result.stdout}")
+
+    def write_array_manifest(self, inputs: list[CMGDJobInput]) -> str:
+        """Write one tab separated `run_ids sample_id` line per array index"""
+        os.makedirs(settings.SLURM_MANIFEST_DIR, exist_ok=True)
+        path = os.path.join(settings.SLURM_MANIFEST_DIR, f"manifest-{uuid.uuid4().hex}.tsv")
+        with open(path, 'w') as f:
+            for input in inputs:
+                f.write(f"{';'.join(input.run_ids)}\t{input.sample_id}\n")
+        return path
+
+    @activity.defn
+    async def sbatch_submit_array(self, inputs: list[CMGDJobInput]) -> dict[str, str]:
+        """Submit many samples as Slurm job arrays
+
+        Samples are grouped by run count and queue row, since the job comment
+        applies to a whole array, and split into arrays of at most
+        SLURM_MAX_ARRAY_SIZE tasks, each backed by a manifest file that
+        `submit_alpine.sh` reads by `$SLURM_ARRAY_TASK_ID`. Returns a mapping
+        from sample_id to the `<array_job_id>_<index>` job id of its task.
+
+        The mapping is heartbeated after every array, so a retry only
+        submits the samples that are not in it yet.
+        """
+        details = activity.info().heartbeat_details
+        job_ids: dict[str, str] = dict(details[0]) if details else {}
+        groups: dict[tuple[int, int | None], list[CMGDJobInput]] = {}
+        for input in inputs:
+            if input.sample_id not in job_ids:
+                groups.setdefault((len(input.run_ids), input.queue_id), []).append(input)
+        size = settings.SLURM_MAX_ARRAY_SIZE
+        for (runs, queue_id), group in groups.items():
+            for start in range(0, len(group), size):
+                chunk = group[start:start + size]
+                manifest = await asyncio.to_thread(self.write_array_manifest, chunk)
+                cmd = [
+                    "sbatch", "--export=NONE", f"--array=0-{len(chunk) - 1}",
+                    f"--comment={job_comment(runs=runs, queue=queue_id)}",
+                    "submit_alpine.sh", "--manifest", manifest,
+                ]
+                array_job_id = await self.sbatch_submit(cmd)
+                for index, input in enumerate(chunk):
+                    job_ids[input.sample_id] = f"{array_job_id}_{index}"
+                activity.heartbeat(job_ids)
+        return job_ids
+
+    @activity.defn
+    async def finish_work_dir(self, sample_id: str) -> None:
+        """Release the resume directory of a completed sample
+
+        Also prunes the other directories under NEXTFLOW_WORK_ROOT, at most
+        every WORKDIR_PRUNE_INTERVAL seconds per worker.
+        """
+        await asyncio.to_thread(workdirs.finish, workdirs.work_dir(sample_id))
+        if self._pruned_at is None or time.monotonic() - self._pruned_at > settings.WORKDIR_PRUNE_INTERVAL:
+            self._pruned_at = time.monotonic()
+            removed = await asyncio.to_thread(workdirs.prune)
+            if removed:
+                activity.logger.info(f"Pruned {len(removed)} work directories")
+
+    @activity.defn
+    async def predict_resources(self, input: CMGDJobInput) -> ResourceRequest | None:
+        """Resources to request for a sample, or None to keep the script's defaults"""
+        await self.sizing.refresh(self.engine)
+        return self.sizing.predict(len(input.run_ids))
+
+    @activity.defn
+    async def completed_samples(self, inputs: list[CMGDJobInput]) -> list[str]:
+        """Sample ids of `inputs` that are already in the completion index"""
+        done = await completed_keys([completion_key(input.sample_id, input.run_ids) for input in inputs])
+        return [input.sample_id for input in inputs if completion_key(input.sample_id, input.run_ids) in done]
+
+    @activity.defn
+    async def record_completions(self, inputs: list[CMGDJobInput], job_ids: list[str]) -> None:
+        """Add samples whose jobs COMPLETED to the completion index"""
+        # module-qualified: this activity has the same name
+        await external_db.record_completions([
+            (input.sample_id, input.run_ids, job_id) for input, job_id in zip(inputs, job_ids)
+        ])
+
+    @activity.defn
+    async def claim_queued_jobs(self, n: int) -> list[CMGDJobInput]:
+        """Claim up to `n` jobs from the job queue for the QueueCoordinatorWorkflow
+
+        Queue rows carry `{"sample_id": ..., "run_ids": [...]}` as
+        `job_metadata`; rows without them are marked FAILED right away, and
+        samples already in the completion index COMPLETED.
+        """
+        inputs = []
+        invalid = []
+        for record in await dequeue_batch(n):
+            metadata = record.job_metadata or {}
+            try:
+                inputs.append(CMGDJobInput(
+                    sample_id=metadata['sample_id'],
+                    run_ids=list(metadata['run_ids']),
+                    queue_id=record.id,
+                    status_check_interval=settings.STATUS_CHECK_INTERVAL or None,
+                    status_check_max_interval=settings.STATUS_CHECK_MAX_INTERVAL,
+                    right_size=settings.SIZING_ENABLED,
+                    resume=settings.NEXTFLOW_RESUME,
+                    skip_completed=False,
+                ))
+            except (KeyError, TypeError):
+                activity.logger.error(f"Queue job {record.id} has no sample_id/run_ids: {metadata}")
+                invalid.append(record.id)
+        await update_job_statuses(invalid, FAILED)
+        if settings.SKIP_COMPLETED and inputs:
+            keys = [completion_key(input.sample_id, input.run_ids) for input in inputs]
+            done = await completed_keys(keys)
+            skipped = [input.queue_id for input, key in zip(inputs, keys) if key in done]
+            if skipped:
+                activity.logger.info(f"Skipping {len(skipped)} already completed samples")
+                await update_job_statuses(skipped, COMPLETED)
+                inputs = [input for input, key in zip(inputs, keys) if key not in done]
+        return inputs
+
+    @activity.defn
+    async def mark_queued_jobs(self, results: list[QueueJobResult]) -> None:
+        """Write the final status of finished child workflows back to the queue"""
+        by_status: dict[str, list[int]] = {}
+        for result in results:
+            by_status.setdefault(result.status, []).append(result.queue_id)
+        for status, queue_ids in by_status.items():
+            await update_job_statuses(queue_ids, status)
         
-    async def get_sacct_json_by_job_id(self, job_id: int) -> dict:
-        cmd = f"sacct -j {job_id} --json"
+    @activity.defn
+    async def closed_queue_children(self, queue_ids: list[int]) -> list[QueueJobResult]:
+        """Results of QueueCoordinatorWorkflow children that are no longer running
+
+        A child reports back before it completes, so only children that
+        were terminated, timed out or failed before their report need
+        these; they are FAILED.
+        """
+        client = activity.client()
+
+        async def closed(queue_id: int) -> QueueJobResult | None:
+            try:
+                description = await client.get_workflow_handle(queue_workflow_id(queue_id)).describe()
+            except RPCError as e:
+                if e.status != RPCStatusCode.NOT_FOUND:
+                    raise
+                return QueueJobResult(queue_id, FAILED)
+            if description.status == WorkflowExecutionStatus.RUNNING:
+                return None
+            status = COMPLETED if description.status == WorkflowExecutionStatus.COMPLETED else FAILED
+            return QueueJobResult(queue_id, status)
+
+        results = await asyncio.gather(*[closed(queue_id) for queue_id in queue_ids])
+        return [result for result in results if result is not None]
+
+    async def get_sacct_json_by_job_id(self, job_id: int | str) -> dict:
+        cmd = ["sacct", "-j", str(job_id), "--json"]
         result = await self.run_cmd(cmd)
-        json_result = result.stdout.decode('utf-8').strip()
-        result_dict = json.loads(json_result)
+        result_dict = parse_sacct_document(result.stdout)
         return result_dict
     
     
     
     
+    async def slurm_job_id(self, job_id: int | str) -> int:
+        """The numeric job id of a job or of an `<array_job_id>_<index>` task"""
+        if str(job_id).isdigit():
+            return int(job_id)
+        result_dict = self.sacct_cache.pop(job_id)
+        if result_dict is None:
+            result_dict = await self.get_sacct_json_by_job_id(job_id)
+        # keep it for the storage activity that follows
+        self.sacct_cache.put([str(job_id)], result_dict)
+        return result_dict['jobs'][0]['job_id']
+
     @activity.defn
-    async def get_and_store_final_sacct_details(self, job_id: int) -> dict:
-        result_dict = await self.get_sacct_json_by_job_id(job_id)
-        async_session = sa.orm.sessionmaker(
-            self.engine, expire_on_commit=False, class_=AsyncSession
+    async def ingest_nextflow_trace(self, job_id: int | str, sample_id: str) -> dict | None:
+        """Store the tasks of a job's Nextflow trace; return their summary
+
+        Array tasks write their trace as `<array_job_id>_<index>.txt`, and
+        their tasks are stored under the task's numeric job id. The file is
+        removed once ingested. Returns None if tracing is off or the job
+        left no trace file (e.g. it failed before nextflow started).
+        """
+        path = trace_path(job_id)
+        if not settings.TRACE_INGEST or not await asyncio.to_thread(os.path.exists, path):
+            return None
+        summary = await ingest_trace(
+            self.engine, path, await self.slurm_job_id(job_id), sample_id, on_batch=activity.heartbeat,
         )
-        async with async_session() as session:
-            async with session.begin():
-                sacct_result = SlurmBatchJobResult(
-                    job_id=job_id,
-                    job_metadata=result_dict['jobs'][0],
-                    sacct_result=result_dict
-                )
-                session.add(sacct_result)
+        await asyncio.to_thread(os.remove, path)
+        return summary
+
+    @activity.defn
+    async def get_and_store_final_sacct_details(self, job_id: int | str, nextflow_summary: dict | None = None) -> dict:
+        # array tasks are looked up as <array_job_id>_<index>, but are
+        # stored under the numeric job id slurm assigned to the task
+        result_dict = self.sacct_cache.pop(job_id)
+        # refresh if the poll ran on another worker or caught the job
+        # before slurm finished recording it
+        if result_dict is None or not all(is_final_job(job) for job in result_dict['jobs']):
+            result_dict = await self.get_sacct_json_by_job_id(job_id)
+        await self.result_writer.write(result_dict, nextflow_summary)
+        for job in result_dict.get('jobs', []):
+            summary = summarize_job(job)
+            observe_slurm_times(summary.state, summary.submission, summary.start, summary.end)
         return result_dict
 
-    async def get_sacct_job_status(self, job_id: int) -> str:
+    async def get_sacct_job_status(self, job_id: int | str) -> str:
         result = await self.get_sacct_json_by_job_id(job_id)
         try:
-            state = result['jobs'][0]['state']['current']
+            state = get_job_state(result['jobs'][0])
             return state
         except (IndexError, KeyError):
             return "PENDING"
 
     @activity.defn
-    async def get_job_status_activity(self, job_id: int) -> str:
-        current_state = await self.get_sacct_job_status(job_id)
+    async def check_job_state(self, job_id: int | str) -> str:
+        """Return the current state of a job
+
+        Short-lived counterpart of `get_job_status_activity` for workflows
+        that wait on a durable timer between checks. Concurrent checks are
+        still answered by one batched sacct call.
+        """
+        return await self.poller.next_state(job_id, immediate=True)
+
+    @activity.defn
+    async def get_job_status_activity(self, job_id: int | str) -> str:
+        current_state = "PENDING"
 
         async def heartbeat():
             while True:
@@ -83,12 +297,14 @@ class ActivityContainer:
             
         heartbeat_task = asyncio.create_task(heartbeat())
         
-        while True:
-            await asyncio.sleep(60)
-            if current_state in ["COMPLETED", "FAILED"]:
-                heartbeat_task.cancel()
-                return current_state
-            current_state = await self.get_sacct_job_status(job_id)
+        try:
+            while True:
+                # resolves on the next batched poll that includes this job
+                current_state = await self.poller.next_state(job_id)
+                if is_terminal_state(current_state):
+                    return current_state
+        finally:
+            heartbeat_task.cancel()
 
 if __name__ == "__main__":
     activities = ActivityContainer(None)
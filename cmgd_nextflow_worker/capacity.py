@@ -0,0 +1,113 @@
+import asyncio
+import getpass
+import logging
+import time
+from collections import Counter
+from typing import Awaitable, Callable
+
+from .config import settings
+from .models import CommandResult
+from .sacct import is_terminal_state
+
+logger = logging.getLogger(__name__)
+
+
+class CapacityTracker:
+    """In-memory view of how many Slurm jobs a user has queued or running
+
+    One `squeue` snapshot is taken at most every `interval` seconds and
+    kept as per-(state, partition) counts. Between snapshots the view is
+    updated optimistically: `reserve(n)` hands out up to `n` of the free
+    slots below `limit`, `submitted` turns reservations into pending jobs,
+    `release` returns unused reservations and `completed` frees slots of
+    jobs known to have finished. After a failed snapshot, squeue is not
+    tried again for another `interval` seconds.
+    """
+    def __init__(
+        self,
+        run_cmd: Callable[[list[str]], Awaitable[CommandResult]],
+        limit: int = settings.RUNNER_MAX_JOBS,
+        interval: float = settings.RUNNER_CAPACITY_INTERVAL,
+        user: str | None = None,
+    ):
+        self.run_cmd = run_cmd
+        self.limit = limit
+        self.interval = interval
+        self.user = user or getpass.getuser()
+        self.counts: Counter[tuple[str, str]] = Counter()
+        self.reserved = 0
+        # jobs submitted/finished locally since the last snapshot
+        self._adjustment = 0
+        self._snapshot_at: float | None = None
+        self._failed_at: float | None = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def active(self) -> int:
+        """Jobs counting against the limit, including local adjustments"""
+        return sum(self.counts.values()) + self._adjustment
+
+    @property
+    def free(self) -> int:
+        return max(0, self.limit - self.active - self.reserved)
+
+    def counts_by_state(self) -> dict[str, int]:
+        by_state = Counter()
+        for (state, _), count in self.counts.items():
+            by_state[state] += count
+        return dict(by_state)
+
+    async def refresh(self) -> None:
+        cmd = ["squeue", "--noheader", "--format=%T|%P", "-u", self.user]
+        result = await self.run_cmd(cmd)
+        if result.returncode != 0:
+            raise Exception(f"Error running squeue: {result.stderr}")
+        counts = Counter()
+        for line in result.stdout.decode('utf-8').splitlines():
+            # skip anything that is not a "<state>|<partition>" line
+            state, sep, partition = line.strip().partition('|')
+            if not sep or not state.isupper():
+                continue
+            # finished jobs linger in squeue for a while; do not count them
+            if is_terminal_state(state) or state == "COMPLETING":
+                continue
+            counts[(state, partition)] += 1
+        self.counts = counts
+        self._adjustment = 0
+        self._snapshot_at = time.monotonic()
+
+    def _refresh_due(self) -> bool:
+        now = time.monotonic()
+        if self._failed_at is not None and now - self._failed_at <= self.interval:
+            return False
+        return self._snapshot_at is None or now - self._snapshot_at > self.interval
+
+    async def reserve(self, n: int) -> int:
+        """Reserve up to `n` job slots; returns how many were granted"""
+        async with self._lock:
+            if self._refresh_due():
+                try:
+                    await self.refresh()
+                    self._failed_at = None
+                except Exception as e:
+                    # keep admitting against the last known (adjusted) counts
+                    logger.warning(f"Could not refresh capacity: {e}")
+                    self._failed_at = time.monotonic()
+            if self._snapshot_at is None:
+                return 0
+            granted = min(n, self.free)
+            self.reserved += granted
+            return granted
+
+    def release(self, n: int = 1) -> None:
+        """Return reserved slots that were not used"""
+        self.reserved = max(0, self.reserved - n)
+
+    def submitted(self, n: int = 1) -> None:
+        """Turn `n` reservations into submitted jobs"""
+        self.release(n)
+        self._adjustment += n
+
+    def completed(self, n: int = 1) -> None:
+        """Free the slots of `n` jobs known to have finished"""
+        self._adjustment -= n
@@ -0,0 +1,144 @@
+import asyncio
+import bisect
+import logging
+import os
+import shlex
+import time
+
+from .config import settings
+from .metrics import COMMAND_FAILURES, COMMAND_SECONDS
+from .models import CommandResult
+
+logger = logging.getLogger(__name__)
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float('inf'))
+
+
+class LatencyHistogram:
+    """Latency histogram with fixed, non-cumulative buckets"""
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.failures = 0
+
+    def observe(self, seconds: float, failed: bool = False) -> None:
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if failed:
+            self.failures += 1
+
+    def as_dict(self) -> dict:
+        return {
+            'buckets': dict(zip(self.buckets, self.counts)),
+            'count': self.count,
+            'sum': self.sum,
+            'failures': self.failures,
+        }
+
+
+class CommandRunner:
+    """Runs external commands (sbatch, sacct, squeue, ...) without a shell
+
+    Commands are exec'd directly from an argv list, so no `/bin/sh` is
+    started per call. A semaphore caps the number of concurrent child
+    processes, every call has a timeout after which the child is killed
+    (as it is when the calling task is cancelled), and at most
+    `max_output_bytes` of stdout/stderr are kept; the rest is drained and
+    discarded so the child never blocks on a full pipe.
+    Latency is recorded per executable in `histograms`.
+    """
+    def __init__(
+        self,
+        max_concurrency: int = settings.CMD_MAX_CONCURRENCY,
+        timeout: float = settings.CMD_TIMEOUT,
+        max_output_bytes: int = settings.CMD_MAX_OUTPUT_BYTES,
+    ):
+        self.timeout = timeout
+        self.max_output_bytes = max_output_bytes
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.histograms: dict[str, LatencyHistogram] = {}
+
+    async def _read(self, stream: asyncio.StreamReader, name: str) -> bytes:
+        chunks = []
+        size = 0
+        truncated = False
+        while chunk := await stream.read(65536):
+            if size < self.max_output_bytes:
+                chunk = chunk[:self.max_output_bytes - size]
+                chunks.append(chunk)
+                size += len(chunk)
+            else:
+                truncated = True
+        if truncated:
+            logger.warning(f"{name} output truncated to {self.max_output_bytes} bytes")
+        return b''.join(chunks)
+
+    def observe(self, name: str, seconds: float, failed: bool) -> None:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = LatencyHistogram()
+        histogram.observe(seconds, failed)
+        COMMAND_SECONDS.labels(command=name).observe(seconds)
+        if failed:
+            COMMAND_FAILURES.labels(command=name).inc()
+
+    async def _kill(self, proc: asyncio.subprocess.Process) -> None:
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+        await proc.wait()
+
+    async def run(self, cmd: str | list[str], timeout: float | None = None) -> CommandResult:
+        """Run a command and return its exit code and (bounded) output
+
+        `cmd` is either an argv list or a string that is split with shell
+        quoting rules; no shell features (pipes, variables) are available.
+        Raises TimeoutError if the command does not finish within `timeout`
+        (default: the runner's timeout).
+        """
+        argv = shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+        name = os.path.basename(argv[0])
+        timeout = self.timeout if timeout is None else timeout
+        async with self._semaphore:
+            start = time.perf_counter()
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *argv,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+            except OSError as e:
+                # mirror what a shell would report for a missing executable
+                self.observe(name, time.perf_counter() - start, True)
+                return CommandResult(127, b'', str(e).encode('utf-8'))
+            except BaseException:
+                # cancelled while spawning; asyncio kills a child it started
+                self.observe(name, time.perf_counter() - start, True)
+                raise
+            try:
+                stdout, stderr, returncode = await asyncio.wait_for(
+                    asyncio.gather(
+                        self._read(proc.stdout, name),
+                        self._read(proc.stderr, name),
+                        proc.wait(),
+                    ),
+                    timeout,
+                )
+            except TimeoutError:
+                await self._kill(proc)
+                self.observe(name, time.perf_counter() - start, True)
+                raise TimeoutError(f"{name} did not finish within {timeout}s")
+            except BaseException:
+                # e.g. the activity was cancelled on a heartbeat timeout or
+                # worker shutdown; do not leave the child running
+                await self._kill(proc)
+                self.observe(name, time.perf_counter() - start, True)
+                raise
+            self.observe(name, time.perf_counter() - start, returncode != 0)
+        return CommandResult(returncode, stdout, stderr)
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+
+from .config import settings
+from .external_db import dispose_engine, get_engine
+
+logger = logging.getLogger(__name__)
+
+
+class AppContext:
+    """Process-wide resources of a worker or CLI, created on first use
+
+    Holds the one Temporal client a process needs (workers and starters
+    used to connect separately) and gives access to the lazily built
+    database engine. Nothing is constructed at import; `warm_up` opens the
+    database pool ahead of the first activity and `close` releases it.
+    """
+    def __init__(self):
+        self._client = None
+        self._client_lock: asyncio.Lock | None = None
+
+    @property
+    def engine(self):
+        return get_engine()
+
+    async def temporal_client(self):
+        """The shared Temporal client, connected on first call"""
+        if self._client_lock is None:
+            self._client_lock = asyncio.Lock()
+        async with self._client_lock:
+            if self._client is None:
+                # imported here so CLI tools that never talk to Temporal skip it
+                from temporalio.client import Client
+                from .metrics import temporal_runtime
+                self._client = await Client.connect(
+                    settings.TEMPORALIO_ADDRESS,
+                    tls=settings.TEMPORAL_TLS,
+                    runtime=temporal_runtime(),
+                )
+        return self._client
+
+    async def warm_up(self, connections: int = settings.DB_POOL_SIZE) -> None:
+        """Open `connections` pooled database connections at once"""
+        engine = self.engine
+        conns = await asyncio.gather(*[engine.connect() for _ in range(connections)])
+        # returning them to the pool keeps them open for the first activities
+        for conn in conns:
+            await conn.close()
+        logger.info(f"Opened {connections} database connections")
+
+    async def close(self) -> None:
+        await dispose_engine()
+
+
+app = AppContext()
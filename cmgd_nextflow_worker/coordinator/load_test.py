@@ -0,0 +1,93 @@
+"""Push many register/complete cycles through a WorkflowConcurrencyTracker
+
+Runs against a local Temporal dev server and reports signal throughput
+and how many runs the tracker went through (continue_as_new).
+
+    python -m cmgd_nextflow_worker.coordinator.load_test --jobs 10000
+"""
+import argparse
+import asyncio
+import time
+
+from temporalio.client import Client, WorkflowHandle
+from temporalio.testing import WorkflowEnvironment
+from temporalio.worker import Worker
+
+from ..models import JobRegistration
+from .workflow import TrackerState, WorkflowConcurrencyTracker
+
+TASK_QUEUE = "tracker-load-test"
+
+
+async def cycle(handle: WorkflowHandle, job_ids: list[str], concurrency: int) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(job_id: str) -> None:
+        async with semaphore:
+            await handle.signal(WorkflowConcurrencyTracker.register_job, JobRegistration(job_id))
+            await handle.signal(WorkflowConcurrencyTracker.complete_job, job_id)
+
+    await asyncio.gather(*[one(job_id) for job_id in job_ids])
+
+
+async def settled(handle: WorkflowHandle, jobs: int) -> TrackerState:
+    """Wait until every job was either admitted and completed or dropped"""
+    while True:
+        state = await handle.query(WorkflowConcurrencyTracker.state)
+        if state.completed_total + state.dropped_total >= jobs and not state.running and not state.waiting:
+            return state
+        await asyncio.sleep(0.1)
+
+
+async def run_load_test(
+    client: Client,
+    jobs: int,
+    concurrency: int,
+    limit: int,
+    history_limit: int,
+    workflow_id: str = "tracker-load-test",
+) -> tuple[TrackerState, int, float]:
+    """Returns the tracker's final state, its number of runs and the signalling time"""
+    async with Worker(
+        client,
+        task_queue=TASK_QUEUE,
+        workflows=[WorkflowConcurrencyTracker],
+    ):
+        handle = await client.start_workflow(
+            WorkflowConcurrencyTracker.run,
+            TrackerState(max_concurrent_jobs=limit, history_limit=history_limit),
+            id=workflow_id,
+            task_queue=TASK_QUEUE,
+        )
+        start = time.perf_counter()
+        await cycle(handle, [f"job-{i}" for i in range(jobs)], concurrency)
+        elapsed = time.perf_counter() - start
+
+        # signals follow the latest run across continue_as_new
+        handle = client.get_workflow_handle(workflow_id)
+        state = await settled(handle, jobs)
+        runs = 0
+        async for _ in client.list_workflows(f"WorkflowId = '{workflow_id}'"):
+            runs += 1
+        await handle.terminate()
+    return state, runs, elapsed
+
+
+async def main(jobs: int, concurrency: int, limit: int, history_limit: int) -> None:
+    async with await WorkflowEnvironment.start_local() as env:
+        state, runs, elapsed = await run_load_test(env.client, jobs, concurrency, limit, history_limit)
+    print(f"{2 * jobs} signals in {elapsed:.1f}s: {2 * jobs / elapsed:.0f} signals/s")
+    print(
+        f"admitted {state.admitted_total}, completed {state.completed_total}, "
+        f"dropped while waiting {state.dropped_total}, runs {runs}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=10_000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=400)
+    parser.add_argument("--history-limit", type=int, default=10_000)
+    args = parser.parse_args()
+    asyncio.run(main(args.jobs, args.concurrency, args.limit, args.history_limit))
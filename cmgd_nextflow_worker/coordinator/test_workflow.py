@@ -3,6 +3,7 @@ from dataclasses import dataclass
 from temporalio.client import Client
 from temporalio.worker import Worker
 from .workflow import WorkflowConcurrencyTracker
+from ..models import JobRegistration
 
 from temporalio.testing import WorkflowEnvironment
 
@@ -44,7 +45,7 @@ async def main():
             
             for i in range(10):
                 # Register a job
-                await handle.signal(WorkflowConcurrencyTracker.register_job, f"job-{i}")
+                await handle.signal(WorkflowConcurrencyTracker.register_job, JobRegistration(f"job-{i}"))
                 print(f"Registered job-{i}")
                 
                 # Wait for the workflow to complete
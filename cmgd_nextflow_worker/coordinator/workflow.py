@@ -1,69 +1,165 @@
+from collections import deque
+from dataclasses import dataclass, field
 from temporalio import workflow
-from temporalio.exceptions import ApplicationError
 import asyncio
 
+with workflow.unsafe.imports_passed_through():
+    from cmgd_nextflow_worker.models import JobRegistration
+    from cmgd_nextflow_worker.workflow import CONTINUE_SIGNAL
+
+
+@dataclass
+class TrackerState:
+    """State of a WorkflowConcurrencyTracker, carried across continue_as_new"""
+    max_concurrent_jobs: int = 400
+    # continue as new once the run's history exceeds this many events
+    history_limit: int = 10_000
+    waiting: list[JobRegistration] = field(default_factory=list)
+    running: list[JobRegistration] = field(default_factory=list)
+    admitted_total: int = 0
+    completed_total: int = 0
+    # completed while still waiting, i.e. never admitted
+    dropped_total: int = 0
+
+
 @workflow.defn
 class WorkflowConcurrencyTracker():
     """Serves as a semaphore to limit the number of concurrent jobs
+
+    Jobs register with `register_job` and release their slot with
+    `complete_job`. Whenever slots are free, as many waiting jobs as fit
+    are admitted at once, in registration order, and each registration
+    that names a workflow is signalled with CONTINUE_SIGNAL. The limit can
+    be changed at runtime with `set_limit`.
+
+    To keep event history bounded, the tracker compacts its state into a
+    `TrackerState` and continues as new once Temporal suggests it or the
+    history exceeds `history_limit` events.
     """
-    def __init__(self, max_concurrent_jobs: int=400):
-        self.queue = asyncio.Queue()
-        self.running_jobs = {}
-        self.max_concurrent_jobs = max_concurrent_jobs
+    def __init__(self):
+        self.max_concurrent_jobs = 400
+        self.history_limit = 10_000
+        self.waiting: deque[JobRegistration] = deque()
+        self.waiting_ids: set[str] = set()
+        self.running: dict[str, JobRegistration] = {}
+        self.admitted_total = 0
+        self.completed_total = 0
+        self.dropped_total = 0
         self.job_status_changed: bool = False
-        
+
+    def is_known(self, job_id: str) -> bool:
+        return job_id in self.running or job_id in self.waiting_ids
+
     @workflow.signal
-    async def register_job(self, job_id: str):
-        """Register a job id to the queue
+    def register_job(self, registration: JobRegistration):
+        """Register a job to wait for a slot
         """
-        await self.queue.put(job_id)
+        # signals may be redelivered by retrying callers
+        if self.is_known(registration.job_id):
+            return
+        self.waiting.append(registration)
+        self.waiting_ids.add(registration.job_id)
         self.job_status_changed = True
-        workflow.logger.info(f"Job {job_id} registered")
-        return True
 
     @workflow.signal
-    async def complete_job(self, job_id: str):
-        """Unregister a job id from the queue
+    def complete_job(self, job_id: str):
+        """Release the slot of a job (or drop it if it is still waiting)
         """
-        if job_id in self.running_jobs:
-            del self.running_jobs[job_id]
-            self.job_status_changed = True
-            workflow.logger.info(f"Job {job_id} completed")
-        #else:
-        #    raise ApplicationError(f"Job {job_id} not found in running jobs")
-        return True
-    
+        if self.running.pop(job_id, None) is not None:
+            self.completed_total += 1
+        elif job_id in self.waiting_ids:
+            self.waiting = deque(job for job in self.waiting if job.job_id != job_id)
+            self.waiting_ids.discard(job_id)
+            self.dropped_total += 1
+        self.job_status_changed = True
+
+    @workflow.signal
+    def set_limit(self, max_concurrent_jobs: int):
+        """Change the number of jobs that may run at once
+        """
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.job_status_changed = True
+
     @workflow.query
-    async def job_count(self):
-        """Get the number of jobs in the queue
+    def job_count(self) -> int:
+        """Get the number of jobs waiting for a slot
         """
-        return self.queue.qsize()
-    
+        return len(self.waiting)
+
+    @workflow.query
+    def running_count(self) -> int:
+        return len(self.running)
+
+    @workflow.query
+    def state(self) -> TrackerState:
+        return TrackerState(
+            max_concurrent_jobs=self.max_concurrent_jobs,
+            history_limit=self.history_limit,
+            waiting=list(self.waiting),
+            running=list(self.running.values()),
+            admitted_total=self.admitted_total,
+            completed_total=self.completed_total,
+            dropped_total=self.dropped_total,
+        )
+
+    async def admit(self) -> None:
+        """Admit as many waiting jobs as there are free slots"""
+        admitted = []
+        while self.waiting and len(self.running) < self.max_concurrent_jobs:
+            job = self.waiting.popleft()
+            self.waiting_ids.discard(job.job_id)
+            self.running[job.job_id] = job
+            admitted.append(job)
+        if not admitted:
+            return
+        workflow.logger.info(f"Admitted {len(admitted)} jobs; running: {len(self.running)}, waiting: {len(self.waiting)}")
+
+        to_signal = [job for job in admitted if job.workflow_id is not None]
+        results = await asyncio.gather(
+            *[
+                workflow.get_external_workflow_handle(job.workflow_id).signal(CONTINUE_SIGNAL)
+                for job in to_signal
+            ],
+            return_exceptions=True,
+        )
+        failed = 0
+        for job, result in zip(to_signal, results):
+            if isinstance(result, BaseException):
+                # the workflow is gone; give its slot to someone else
+                workflow.logger.warning(f"Could not admit job {job.job_id}: {result}")
+                self.running.pop(job.job_id, None)
+                self.job_status_changed = True
+                failed += 1
+        # only jobs that were told to go count as admitted
+        self.admitted_total += len(admitted) - failed
+
+    def should_continue_as_new(self) -> bool:
+        info = workflow.info()
+        return info.is_continue_as_new_suggested() or info.get_current_history_length() > self.history_limit
+
     @workflow.run
-    async def run(self):
+    async def run(self, state: TrackerState | None = None):
         """Run the workflow
         """
+        if state is not None:
+            self.max_concurrent_jobs = state.max_concurrent_jobs
+            self.history_limit = state.history_limit
+            self.waiting = deque(state.waiting)
+            self.waiting_ids = {job.job_id for job in state.waiting}
+            self.running = {job.job_id: job for job in state.running}
+            self.admitted_total = state.admitted_total
+            self.completed_total = state.completed_total
+            self.dropped_total = state.dropped_total
+            # admit anything the limit allows straight away
+            self.job_status_changed = True
+
         while True:
+            await workflow.wait_condition(
+                lambda: self.job_status_changed or self.should_continue_as_new()
+            )
             self.job_status_changed = False
-            
-            # Wait for a job to be registered
-            await workflow.wait_condition(lambda: self.job_status_changed)
-            
-            
-            # log the number of jobs in the queue
-            workflow.logger.info(f"Jobs in queue: {self.queue.qsize()}")
-            # log the number of running jobs
-            workflow.logger.info(f"Running jobs: {len(self.running_jobs)}") 
-            
-            # check if the number of running jobs is less than the max concurrent jobs
-            if len(self.running_jobs) < self.max_concurrent_jobs:
-                job_id = await self.queue.get()
-                self.running_jobs[job_id] = True
-                workflow.logger.info(f"Starting job {job_id}")
-                # start the job
-                # run the job here
-                workflow.logger.info(f"Job {job_id} started")
-            else:
-                workflow.logger.info("Max concurrent jobs reached")
-
-# worker code for testing 
\ No newline at end of file
+            await self.admit()
+
+            if self.should_continue_as_new():
+                await workflow.wait_condition(workflow.all_handlers_finished)
+                workflow.continue_as_new(self.state())
@@ -0,0 +1,115 @@
+"""Prometheus metrics for the submit -> run -> record pipeline
+
+Metrics are recorded through `prometheus_client` when the optional
+package is installed and are no-ops otherwise, so instrumented code never
+has to check. Recording is a lock and a float add, cheap enough to leave
+on under full load. `start_metrics_server` exposes the text endpoint;
+Temporal's own worker metrics (task slots, poll latency, ...) are served
+by the SDK runtime from `temporal_runtime`.
+"""
+import logging
+from contextlib import contextmanager
+import time
+
+from .config import settings
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+# upper bounds (seconds) for latencies of subprocesses and database calls
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# upper bounds (seconds) for slurm queue wait and run times
+SLURM_BUCKETS = (60, 300, 900, 1800, 3600, 2 * 3600, 6 * 3600, 12 * 3600, 24 * 3600, 48 * 3600)
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs) -> "_NoopMetric":
+        return self
+
+    def observe(self, value: float) -> None:
+        pass
+
+    def inc(self, value: float = 1) -> None:
+        pass
+
+    def set(self, value: float) -> None:
+        pass
+
+
+def _histogram(name: str, documentation: str, labels: tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+    if prometheus_client is None:
+        return _NoopMetric()
+    return prometheus_client.Histogram(name, documentation, labels, buckets=buckets)
+
+
+def _counter(name: str, documentation: str, labels: tuple[str, ...] = ()):
+    if prometheus_client is None:
+        return _NoopMetric()
+    return prometheus_client.Counter(name, documentation, labels)
+
+
+def _gauge(name: str, documentation: str, labels: tuple[str, ...] = ()):
+    if prometheus_client is None:
+        return _NoopMetric()
+    return prometheus_client.Gauge(name, documentation, labels)
+
+
+COMMAND_SECONDS = _histogram(
+    "cmgd_command_seconds", "Latency of sbatch/sacct/squeue subprocesses", ("command",))
+COMMAND_FAILURES = _counter(
+    "cmgd_command_failures", "Subprocesses that failed, timed out or could not start", ("command",))
+QUEUE_JOBS = _gauge(
+    "cmgd_queue_jobs", "Jobs in the job queue by status", ("status",))
+DEQUEUE_SECONDS = _histogram(
+    "cmgd_dequeue_seconds", "Latency of claiming a batch of queued jobs", ("queue",))
+DEQUEUED_JOBS = _counter(
+    "cmgd_dequeued_jobs", "Jobs claimed from the job queue", ("queue",))
+DB_WRITE_SECONDS = _histogram(
+    "cmgd_db_write_seconds", "Latency of database writes", ("operation",))
+RUNNER_STAGE_SECONDS = _histogram(
+    "cmgd_runner_stage_seconds", "Latency of the queue runner's stages", ("stage",))
+SLURM_WAIT_SECONDS = _histogram(
+    "cmgd_slurm_wait_seconds", "Time finished jobs spent pending in the Slurm queue", buckets=SLURM_BUCKETS)
+SLURM_RUN_SECONDS = _histogram(
+    "cmgd_slurm_run_seconds", "Run time of finished Slurm jobs", ("state",), buckets=SLURM_BUCKETS)
+
+
+@contextmanager
+def timed(histogram):
+    """Observe the duration of the `with` block on `histogram`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start)
+
+
+def observe_slurm_times(state: str, submission: int, start: int, end: int) -> None:
+    """Record queue wait and run time of a finished job from sacct's epoch times"""
+    if start and submission:
+        SLURM_WAIT_SECONDS.observe(max(0, start - submission))
+    if end and start:
+        SLURM_RUN_SECONDS.labels(state=state.split()[0]).observe(max(0, end - start))
+
+
+def start_metrics_server(port: int = settings.METRICS_PORT) -> bool:
+    """Serve /metrics on `port`; returns False if metrics are unavailable"""
+    if not port:
+        return False
+    if prometheus_client is None:
+        logger.warning("METRICS_PORT is set but prometheus_client is not installed")
+        return False
+    prometheus_client.start_http_server(port)
+    return True
+
+
+def temporal_runtime(port: int = settings.TEMPORAL_METRICS_PORT):
+    """A Temporal runtime exporting SDK metrics on `port`, or None for the default"""
+    if not port:
+        return None
+    from temporalio.runtime import PrometheusConfig, Runtime, TelemetryConfig
+    return Runtime(telemetry=TelemetryConfig(metrics=PrometheusConfig(bind_address=f"0.0.0.0:{port}")))
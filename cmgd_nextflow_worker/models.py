@@ -1,13 +1,85 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 @dataclass
 class CMGDJobInput:
     sample_id: str
     run_ids: list[str]
+    # if set, wait for a slot from this WorkflowConcurrencyTracker before submitting
+    tracker_workflow_id: str | None = None
+    # job_queue_records id, if the job was claimed from the queue
+    queue_id: int | None = None
+    # if set, check the job's state every status_check_interval seconds
+    # (backing off to status_check_max_interval) between durable timers
+    # instead of waiting in one long-running activity
+    status_check_interval: float | None = None
+    status_check_max_interval: float = 600
+    # request resources predicted from past jobs instead of the batch
+    # script's #SBATCH defaults
+    right_size: bool = False
+    # run in a persistent work directory and resume earlier attempts
+    resume: bool = False
+    # skip the sample if it is in the completion index (the queue
+    # coordinator checks whole batches when it claims them instead)
+    skip_completed: bool = True
     
 @dataclass
 class CommandResult:
     returncode: int | None
     stdout: bytes
     stderr: bytes
-    
\ No newline at end of file
+    
+@dataclass
+class JobRegistration:
+    """A job asking the WorkflowConcurrencyTracker for a slot
+
+    If `workflow_id` is set, that workflow is sent CONTINUE_SIGNAL once the
+    job is admitted.
+    """
+    job_id: str
+    workflow_id: str | None = None
+
+
+@dataclass
+class QueueJobResult:
+    """Final queue status of a job claimed by the QueueCoordinatorWorkflow"""
+    queue_id: int
+    status: str
+
+
+def queue_workflow_id(queue_id: int) -> str:
+    """Workflow id of the QueueCoordinatorWorkflow child for a queue row"""
+    return f"cmgd-queue-{queue_id}"
+
+
+@dataclass
+class QueueCoordinatorState:
+    """Input of the QueueCoordinatorWorkflow, carried across continue_as_new"""
+    max_children: int = 400
+    claim_batch: int = 50
+    idle_seconds: float = 60
+    # continue as new once the run's history exceeds this many events
+    history_limit: int = 10_000
+    # how often to look for children of earlier runs that closed without
+    # reporting back (e.g. were terminated)
+    child_check_seconds: float = 300
+    # queue ids of child workflows that have not reported back yet
+    running: list[int] = field(default_factory=list)
+    # results not yet written back to the queue
+    finished: list[QueueJobResult] = field(default_factory=list)
+    started_total: int = 0
+    finished_total: int = 0
+
+
+@dataclass
+class ResourceRequest:
+    """Resources to request from Slurm, overriding the batch script's"""
+    mem_mb: int
+    cpus: int
+    time_minutes: int
+
+    def sbatch_args(self) -> list[str]:
+        return [
+            f"--mem={self.mem_mb}M",
+            f"--cpus-per-task={self.cpus}",
+            f"--time={self.time_minutes}",
+        ]
@@ -0,0 +1,185 @@
+"""Ingestion of Nextflow trace files
+
+`submit_alpine.sh` runs nextflow with `-with-trace $TRACE_DIR/<job id>.txt`
+(`<array_job_id>_<index>.txt` for array tasks), a tab separated file with
+one line per pipeline task. `ingest_trace`
+streams it in batches of TRACE_BATCH_SIZE lines into `nextflow_tasks`, so
+memory use does not grow with the number of tasks, and returns a
+per-process summary that is stored with the job's sacct record.
+
+Both the default human readable trace values ("1h 2m 3s", "1.5 GB",
+"95.3%") and `trace.raw = true` values (milliseconds, bytes) are parsed.
+"""
+import asyncio
+import csv
+import itertools
+import os
+import re
+from datetime import datetime, timezone
+from typing import Callable, Iterator
+
+import sqlalchemy.dialects.postgresql as sapg
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .config import settings
+from .external_db import NextflowTask
+from .metrics import DB_WRITE_SECONDS, timed
+
+_DURATION_UNITS = {'ms': 1, 's': 1000, 'm': 60_000, 'h': 3_600_000, 'd': 86_400_000}
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)\s*(ms|d|h|m|s)")
+# nextflow's MemoryUnit is binary
+_MEMORY_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024**2, 'GB': 1024**3, 'TB': 1024**4, 'PB': 1024**5}
+
+
+def trace_path(job_id: int | str, trace_dir: str = settings.TRACE_DIR) -> str:
+    return os.path.join(trace_dir, f"{job_id}.txt")
+
+
+def _missing(value: str | None) -> bool:
+    return value is None or value.strip() in ("", "-")
+
+
+def parse_duration(value: str | None) -> int | None:
+    """Milliseconds of a trace duration"""
+    if _missing(value):
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return round(sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts))
+
+
+def parse_memory(value: str | None) -> int | None:
+    """Bytes of a trace memory or I/O value"""
+    if _missing(value):
+        return None
+    number, _, unit = value.strip().partition(" ")
+    try:
+        return round(float(number) * _MEMORY_UNITS.get(unit.upper() or 'B', 1))
+    except ValueError:
+        return None
+
+
+def parse_percent(value: str | None) -> float | None:
+    if _missing(value):
+        return None
+    try:
+        return float(value.strip().rstrip("%"))
+    except ValueError:
+        return None
+
+
+def parse_int(value: str | None) -> int | None:
+    if _missing(value):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def parse_timestamp(value: str | None) -> datetime | None:
+    if _missing(value):
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return datetime.fromtimestamp(int(value) / 1000, timezone.utc)
+    try:
+        # the trace file is written in the local time of the compute node
+        return datetime.fromisoformat(value).astimezone(timezone.utc)
+    except ValueError:
+        return None
+
+
+def task_row(record: dict, job_id: int, sample_id: str) -> dict:
+    """Turn one trace line into a NextflowTask row"""
+    name = record.get('name') or ""
+    return {
+        'job_id': job_id,
+        'sample_id': sample_id,
+        'task_id': parse_int(record.get('task_id')),
+        'hash': record.get('hash'),
+        'native_id': record.get('native_id'),
+        # name is "<process> (<tag>)" unless the process field was traced
+        'process': record.get('process') or name.split(" (", 1)[0],
+        'name': name,
+        'status': record.get('status'),
+        'exit': parse_int(record.get('exit')),
+        'submit': parse_timestamp(record.get('submit')),
+        'duration_ms': parse_duration(record.get('duration')),
+        'realtime_ms': parse_duration(record.get('realtime')),
+        'cpu_percent': parse_percent(record.get('%cpu')),
+        'peak_rss_bytes': parse_memory(record.get('peak_rss')),
+        'peak_vmem_bytes': parse_memory(record.get('peak_vmem')),
+        'read_bytes': parse_memory(record.get('rchar')),
+        'write_bytes': parse_memory(record.get('wchar')),
+    }
+
+
+def read_trace(path: str, job_id: int, sample_id: str) -> Iterator[dict]:
+    """Yield the task rows of a trace file, one line at a time"""
+    with open(path, newline="") as f:
+        for record in csv.DictReader(f, delimiter="\t"):
+            if record.get('task_id'):
+                yield task_row(record, job_id, sample_id)
+
+
+class TraceSummary:
+    """Per-process totals of a run's tasks"""
+    def __init__(self):
+        self.processes: dict[str, dict] = {}
+
+    def add(self, row: dict) -> None:
+        totals = self.processes.setdefault(row['process'], {
+            'tasks': 0, 'failed': 0, 'realtime_seconds': 0.0, 'cpu_seconds': 0.0,
+            'max_peak_rss_bytes': 0, 'read_bytes': 0, 'write_bytes': 0,
+        })
+        totals['tasks'] += 1
+        if row['status'] not in ("COMPLETED", "CACHED"):
+            totals['failed'] += 1
+        realtime = (row['realtime_ms'] or 0) / 1000
+        totals['realtime_seconds'] += realtime
+        totals['cpu_seconds'] += realtime * (row['cpu_percent'] or 0) / 100
+        totals['max_peak_rss_bytes'] = max(totals['max_peak_rss_bytes'], row['peak_rss_bytes'] or 0)
+        totals['read_bytes'] += row['read_bytes'] or 0
+        totals['write_bytes'] += row['write_bytes'] or 0
+
+    def to_dict(self) -> dict:
+        return {'tasks': sum(p['tasks'] for p in self.processes.values()), 'processes': self.processes}
+
+
+async def ingest_trace(
+    engine: AsyncEngine,
+    path: str,
+    job_id: int,
+    sample_id: str,
+    batch_size: int = settings.TRACE_BATCH_SIZE,
+    on_batch: Callable[[int], None] | None = None,
+) -> dict:
+    """Insert the tasks of a trace file and return their TraceSummary
+
+    Re-ingesting a file inserts nothing twice, so a retried activity is
+    harmless. `on_batch` is called with the running row count, e.g. to
+    heartbeat.
+    """
+    summary = TraceSummary()
+    stmt = sapg.insert(NextflowTask).on_conflict_do_nothing(index_elements=["job_id", "task_id"])
+    rows = read_trace(path, job_id, sample_id)
+    count = 0
+    while True:
+        # file reads and parsing stay off the event loop
+        batch = await asyncio.to_thread(list, itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        with timed(DB_WRITE_SECONDS.labels(operation="nextflow_tasks")):
+            async with engine.begin() as conn:
+                await conn.execute(stmt, batch)
+        for row in batch:
+            summary.add(row)
+        count += len(batch)
+        if on_batch is not None:
+            on_batch(count)
+    return summary.to_dict()
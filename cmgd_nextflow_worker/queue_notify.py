@@ -0,0 +1,75 @@
+"""Postgres LISTEN/NOTIFY wakeups for queue consumers
+
+Producers NOTIFY `QUEUE_CHANNEL` when they enqueue work and
+`COMPLETION_CHANNEL` when jobs finish. A completion payload is the number
+of Slurm jobs that finished, or empty when only queue rows were settled
+and the jobs are reported elsewhere. Consumers block on a `QueueListener`
+instead of sleeping, with a timeout as a fallback in case a notification
+is missed (e.g. while the listening connection is down).
+"""
+import asyncio
+import logging
+from typing import Callable
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+QUEUE_CHANNEL = "cmgd_queue"
+COMPLETION_CHANNEL = "cmgd_job_completed"
+
+
+def asyncpg_dsn(dsn: str) -> str:
+    """Strip the SQLAlchemy driver suffix so asyncpg accepts the DSN"""
+    return dsn.replace("postgresql+asyncpg://", "postgresql://", 1)
+
+
+class QueueListener:
+    """Wakes a consumer when any of `channels` is notified
+
+    Notifications that arrive while the consumer is busy are not lost: the
+    next `wait` returns immediately, and the consumer re-checks the queue.
+    `on_completed` is called with the job count of every counted
+    COMPLETION_CHANNEL notification as it arrives.
+    """
+    def __init__(self, dsn: str, channels: list[str], on_completed: Callable[[int], None] | None = None):
+        self.dsn = asyncpg_dsn(dsn)
+        self.channels = channels
+        self.on_completed = on_completed
+        self.connection: asyncpg.Connection | None = None
+        self._notified = asyncio.Event()
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        if channel == COMPLETION_CHANNEL and payload.isdigit() and self.on_completed is not None:
+            self.on_completed(int(payload))
+        self._notified.set()
+
+    async def start(self) -> None:
+        self.connection = await asyncpg.connect(dsn=self.dsn)
+        for channel in self.channels:
+            await self.connection.add_listener(channel, self._on_notify)
+
+    async def wait(self, timeout: float) -> bool:
+        """Wait for a notification; returns False if `timeout` expired first"""
+        if self.connection is None or self.connection.is_closed():
+            # reconnect lazily; until then the timeout acts as a poll interval
+            try:
+                await self.start()
+            except (OSError, asyncpg.exceptions.PostgresError) as e:
+                logger.warning(f"Cannot listen for queue notifications: {e}")
+        try:
+            await asyncio.wait_for(self._notified.wait(), timeout)
+            return True
+        except TimeoutError:
+            return False
+        finally:
+            self._notified.clear()
+
+    def wake(self) -> None:
+        """Wake current waiters as if a notification had arrived"""
+        self._notified.set()
+
+    async def close(self) -> None:
+        if self.connection is not None:
+            await self.connection.close()
+            self.connection = None
@@ -0,0 +1,262 @@
+"""Reconciliation of the job queues with what Slurm did
+
+A worker or runner that dies leaves rows claimed (PROCESSING in
+job_queue_records, CLAIMED in cmgd_queue) or submitted (PROCESSED in
+cmgd_queue) with nobody left to finish them. A reconciliation pass asks
+`sacct --starttime <last pass> --json` for every job that was pending,
+running or ended since, in slices of at most RECONCILE_WINDOW_HOURS, and
+applies them to a queue table in one set-based statement:
+
+- rows whose job ended become COMPLETED or FAILED, and completed samples
+  are added to the completion index
+- claimed rows whose job is still pending or running keep their claim
+  (job_queue_records: the lease is extended)
+- claimed rows whose lease expired and that have no job go back to QUEUED
+
+Jobs are matched to rows by the queue reference in their sbatch comment
+(see `sacct.job_comment`), and cmgd_queue rows also by the `batch_id` the
+runner stored. A job settles its row whatever the row's lease says: a
+job that ended is only in the window of the pass right after it ended.
+Only the requeue waits for the lease, so an owner that has yet to submit
+keeps its row. The checkpoint row is locked for the duration of a pass,
+so when several workers reconcile the same table only one of them does
+the work.
+
+    cmgd-db reconcile
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable
+
+import sqlalchemy as sa
+import sqlalchemy.dialects.postgresql as sapg
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .config import settings
+from .external_db import ReconcileCheckpoint, get_engine, notify
+from .models import CommandResult
+from .queue_notify import COMPLETION_CHANNEL
+from .sacct import SacctJobSummary, is_terminal_state, parse_job_comment, parse_sacct_summaries
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUE = "job_queue_records"
+CMGD_QUEUE = "cmgd_queue"
+# queue reference of each table in the job comment
+COMMENT_KEYS = {JOB_QUEUE: "queue", CMGD_QUEUE: "cmgd_queue"}
+
+# Both statements take the window's jobs as three parallel arrays, with
+# each job's state reduced to COMPLETED, FAILED or ACTIVE.
+_JOBS = """
+jobs AS (
+    SELECT * FROM unnest(CAST(:queue_ids AS int[]), CAST(:job_ids AS bigint[]), CAST(:outcomes AS text[]))
+        AS j(queue_id, job_id, outcome)
+),
+-- a row may have had several jobs (e.g. a retry with more memory); the last one counts
+latest AS (
+    SELECT DISTINCT ON (queue_id) * FROM jobs WHERE queue_id IS NOT NULL ORDER BY queue_id, job_id DESC
+)"""
+
+_COUNTS = """
+SELECT
+    (SELECT count(*) FROM settled WHERE status = 'COMPLETED') AS completed,
+    (SELECT count(*) FROM settled WHERE status = 'FAILED') AS failed,
+    (SELECT count(*) FROM settled WHERE status NOT IN ('COMPLETED', 'FAILED')) AS active,
+    (SELECT count(*) FROM requeued) AS requeued,
+    (SELECT count(*) FROM indexed) AS indexed
+"""
+
+STATEMENTS = {
+    JOB_QUEUE: sa.text(f"""
+WITH {_JOBS},
+settled AS (
+    UPDATE job_queue_records q SET
+        job_status = CASE WHEN l.outcome = 'ACTIVE' THEN q.job_status ELSE l.outcome END,
+        lease_expires_at = CASE
+            WHEN l.outcome = 'ACTIVE' THEN greatest(q.lease_expires_at, now() + CAST(:lease AS interval))
+        END,
+        _updated_at = now()
+    FROM latest l
+    WHERE q.id = l.queue_id AND q.job_status = 'PROCESSING'
+    RETURNING q.job_status AS status, q.job_metadata AS metadata, l.job_id
+),
+requeued AS (
+    UPDATE job_queue_records q SET job_status = 'QUEUED', lease_expires_at = NULL, _updated_at = now()
+    WHERE q.job_status = 'PROCESSING'
+        AND (q.lease_expires_at IS NULL OR q.lease_expires_at < now())
+        AND NOT EXISTS (SELECT 1 FROM latest l WHERE l.queue_id = q.id)
+    RETURNING q.id
+),
+indexed AS (
+    INSERT INTO sample_completions (sample_id, run_ids, pipeline_revision, job_id)
+    SELECT
+        metadata->>'sample_id',
+        -- sorted like external_db.completion_key
+        (SELECT string_agg(r, ';' ORDER BY r COLLATE "C") FROM jsonb_array_elements_text(metadata->'run_ids') AS r),
+        :revision,
+        CAST(job_id AS text)
+    FROM settled
+    WHERE status = 'COMPLETED' AND metadata->>'sample_id' IS NOT NULL
+        AND jsonb_typeof(metadata->'run_ids') = 'array' AND jsonb_array_length(metadata->'run_ids') > 0
+    ON CONFLICT DO NOTHING
+    RETURNING 1
+)
+{_COUNTS}"""),
+    CMGD_QUEUE: sa.text(f"""
+WITH {_JOBS},
+submitted AS (
+    -- claimed rows whose sbatch went through before the runner could mark them
+    UPDATE cmgd_queue q SET
+        status = CASE WHEN l.outcome = 'ACTIVE' THEN 'PROCESSED' ELSE l.outcome END,
+        batch_id = l.job_id, lease_expires_at = NULL, _updated_at = now()
+    FROM latest l
+    WHERE q.id = l.queue_id AND q.status = 'CLAIMED'
+    RETURNING q.status, q.sample_id, q.run_ids, q.batch_id
+),
+finished AS (
+    UPDATE cmgd_queue q SET status = j.outcome, _updated_at = now()
+    FROM jobs j
+    WHERE q.batch_id = j.job_id AND q.status = 'PROCESSED' AND j.outcome <> 'ACTIVE'
+    RETURNING q.status, q.sample_id, q.run_ids, q.batch_id
+),
+settled AS (
+    SELECT * FROM submitted UNION ALL SELECT * FROM finished
+),
+requeued AS (
+    UPDATE cmgd_queue q SET status = 'QUEUED', lease_expires_at = NULL, _updated_at = now()
+    WHERE q.status = 'CLAIMED'
+        AND (q.lease_expires_at IS NULL OR q.lease_expires_at < now())
+        AND NOT EXISTS (SELECT 1 FROM latest l WHERE l.queue_id = q.id)
+    RETURNING q.id
+),
+indexed AS (
+    INSERT INTO sample_completions (sample_id, run_ids, pipeline_revision, job_id)
+    SELECT
+        sample_id,
+        (SELECT string_agg(r, ';' ORDER BY r COLLATE "C") FROM unnest(string_to_array(run_ids, ';')) AS r),
+        :revision,
+        CAST(batch_id AS text)
+    FROM settled
+    WHERE status = 'COMPLETED' AND sample_id IS NOT NULL AND run_ids IS NOT NULL
+    ON CONFLICT DO NOTHING
+    RETURNING 1
+)
+{_COUNTS}"""),
+}
+
+
+def outcome(state: str) -> str:
+    if state == "COMPLETED":
+        return "COMPLETED"
+    return "FAILED" if is_terminal_state(state) else "ACTIVE"
+
+
+def job_arrays(table: str, jobs: list[SacctJobSummary]) -> dict[str, list]:
+    """The window's jobs as the statement's array parameters"""
+    key = COMMENT_KEYS[table]
+    queue_ids, job_ids, outcomes = [], [], []
+    for job in jobs:
+        queue_id = parse_job_comment(job.comment).get(key)
+        # job_queue_records rows are only found through the comment
+        if queue_id is None and table == JOB_QUEUE:
+            continue
+        queue_ids.append(queue_id)
+        job_ids.append(job.job_id)
+        outcomes.append(outcome(job.state))
+    return {'queue_ids': queue_ids, 'job_ids': job_ids, 'outcomes': outcomes}
+
+
+def sacct_time(value: datetime) -> str:
+    # sacct reads times in the local time zone
+    return value.astimezone().strftime("%Y-%m-%dT%H:%M:%S")
+
+
+async def sacct_window(
+    run_cmd: Callable[..., Awaitable[CommandResult]],
+    since: datetime,
+    until: datetime,
+    slice_length: timedelta = timedelta(hours=settings.RECONCILE_WINDOW_HOURS),
+) -> list[SacctJobSummary]:
+    """Every job pending, running or ended since `since`
+
+    The window is split into slices of `slice_length`, one sacct call
+    each, so that a long first pass does not exceed CMD_MAX_OUTPUT_BYTES.
+    The last slice is open ended. A job seen in several slices is
+    returned once.
+    """
+    jobs: dict[int, SacctJobSummary] = {}
+    start = since
+    while True:
+        cmd = ["sacct", "--starttime", sacct_time(start), "--json"]
+        end = start + slice_length
+        if end < until:
+            cmd[3:3] = ["--endtime", sacct_time(end)]
+        result = await run_cmd(cmd)
+        if result.returncode != 0:
+            raise RuntimeError(f"sacct failed: {result.stderr.decode(errors='replace')}")
+        for job in parse_sacct_summaries(result.stdout):
+            jobs[job.job_id] = job
+        if end >= until:
+            return list(jobs.values())
+        start = end
+
+
+async def reconcile(
+    table: str,
+    run_cmd: Callable[..., Awaitable[CommandResult]],
+    engine: AsyncEngine | None = None,
+) -> dict[str, int] | None:
+    """Run one reconciliation pass over `table`
+
+    Returns the number of rows completed, failed, still active, requeued
+    and added to the completion index, or None if another pass over the
+    same table is running.
+    """
+    engine = engine or get_engine()
+    started = datetime.now(timezone.utc)
+    async with engine.begin() as conn:
+        await conn.execute(sapg.insert(ReconcileCheckpoint).values(name=table).on_conflict_do_nothing())
+        checkpoint = (await conn.execute(
+            sa.select(ReconcileCheckpoint.checked_at)
+            .where(ReconcileCheckpoint.name == table)
+            .with_for_update(skip_locked=True)
+        )).first()
+        if checkpoint is None:
+            logger.info(f"Another reconciliation of {table} is running")
+            return None
+        if checkpoint.checked_at is None:
+            since = started - timedelta(hours=settings.RECONCILE_LOOKBACK_HOURS)
+        else:
+            since = checkpoint.checked_at - timedelta(seconds=settings.RECONCILE_OVERLAP_SECONDS)
+
+        jobs = await sacct_window(run_cmd, since, started)
+        counts = dict((await conn.execute(STATEMENTS[table], job_arrays(table, jobs) | {
+            'lease': timedelta(seconds=settings.QUEUE_LEASE_SECONDS),
+            'revision': settings.PIPELINE_REVISION,
+        })).one()._mapping)
+        if counts['completed'] or counts['failed']:
+            # job_queue_records jobs are counted when their results are stored
+            payload = str(counts['completed'] + counts['failed']) if table == CMGD_QUEUE else ""
+            await conn.execute(notify(COMPLETION_CHANNEL, payload))
+        await conn.execute(
+            sa.update(ReconcileCheckpoint)
+            .where(ReconcileCheckpoint.name == table)
+            .values(checked_at=started)
+        )
+    logger.info(f"Reconciled {table} against {len(jobs)} Slurm jobs since {since:%Y-%m-%d %H:%M}: {counts}")
+    return counts
+
+
+async def reconcile_periodically(
+    table: str,
+    run_cmd: Callable[..., Awaitable[CommandResult]],
+    interval: float = settings.RECONCILE_INTERVAL,
+) -> None:
+    """Reconcile `table` now and then every `interval` seconds"""
+    while True:
+        try:
+            await reconcile(table, run_cmd)
+        except Exception as e:
+            logger.error(f"Error reconciling {table}: {e}")
+        await asyncio.sleep(interval)
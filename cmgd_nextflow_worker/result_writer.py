@@ -0,0 +1,214 @@
+import asyncio
+import hashlib
+import json
+import logging
+import zlib
+from datetime import datetime, timezone
+
+import sqlalchemy as sa
+import sqlalchemy.dialects.postgresql as sapg
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .config import settings
+from .external_db import SlurmBatchJobResult, SlurmBatchScript, notify
+from .metrics import DB_WRITE_SECONDS, timed
+from .queue_notify import COMPLETION_CHANNEL
+from .sacct import get_job_state, normalize_number
+from .sizing import parse_run_count
+
+logger = logging.getLogger(__name__)
+
+
+def _timestamp(value: int | dict | None) -> datetime | None:
+    value = normalize_number(value)
+    return datetime.fromtimestamp(value, timezone.utc) if value else None
+
+
+def _tres_count(tres: list[dict], type: str, name: str = "") -> int | None:
+    for item in tres or []:
+        if item.get('type') == type and item.get('name', "") == name:
+            return item.get('count')
+    return None
+
+
+def _step_usage(steps: list[dict]) -> dict:
+    """Aggregate TRES usage over a job's steps"""
+    max_rss = disk_read = disk_write = None
+    for step in steps:
+        tres = step.get('tres') or {}
+        requested = tres.get('requested') or {}
+        consumed = tres.get('consumed') or {}
+        # sacct reports usage "in" (memory, reads) under requested and
+        # usage "out" (writes) under consumed
+        rss = _tres_count(requested.get('max'), 'mem')
+        if rss is not None:
+            max_rss = max(max_rss or 0, rss)
+        read = _tres_count(requested.get('total'), 'fs', 'disk')
+        if read is not None:
+            disk_read = (disk_read or 0) + read
+        write = _tres_count(consumed.get('total'), 'fs', 'disk')
+        if write is not None:
+            disk_write = (disk_write or 0) + write
+    return {
+        'max_rss_bytes': max_rss,
+        'disk_read_bytes': disk_read,
+        'disk_write_bytes': disk_write,
+    }
+
+
+def compress_sacct_result(result_dict: dict) -> bytes:
+    return zlib.compress(json.dumps(result_dict, separators=(',', ':')).encode('utf-8'))
+
+
+def load_sacct_result(result: SlurmBatchJobResult) -> dict:
+    """Return the stored sacct document of a result row"""
+    return json.loads(zlib.decompress(result.sacct_compressed))
+
+
+def hash_script(script: str) -> str:
+    return hashlib.sha256(script.encode('utf-8')).hexdigest()
+
+
+def result_row(result_dict: dict, nextflow_summary: dict | None = None) -> tuple[dict, str | None]:
+    """Turn a single-job sacct document into a SlurmBatchJobResult row
+
+    Returns the row and the batch script, which is stripped from the
+    stored document and referenced by `script_hash` instead.
+    """
+    job = result_dict['jobs'][0]
+    script = job.get('script') or None
+    stored = dict(result_dict, jobs=[
+        {key: value for key, value in stored_job.items() if key != 'script'}
+        for stored_job in result_dict['jobs']
+    ])
+    time = job.get('time') or {}
+    required = job.get('required') or {}
+    cpu_time = time.get('total') or {}
+    req_mem = normalize_number(required.get('memory_per_node'))
+    if not req_mem:
+        per_cpu = normalize_number(required.get('memory_per_cpu'))
+        req_mem = per_cpu * required.get('CPUs', 0) if per_cpu else None
+    row = {
+        'job_id': job['job_id'],
+        'job_name': job.get('name'),
+        'state': get_job_state(job),
+        'exit_code': normalize_number((job.get('exit_code') or {}).get('return_code')),
+        'partition': job.get('partition'),
+        'nodes': job.get('nodes'),
+        'submit_time': _timestamp(time.get('submission')),
+        'start_time': _timestamp(time.get('start')),
+        'end_time': _timestamp(time.get('end')),
+        'elapsed_seconds': time.get('elapsed'),
+        'time_limit_minutes': normalize_number(time.get('limit')),
+        'req_cpus': required.get('CPUs'),
+        'req_mem_mb': req_mem,
+        'cpu_seconds': cpu_time.get('seconds', 0) + cpu_time.get('microseconds', 0) / 1e6,
+        'run_count': parse_run_count((job.get('comment') or {}).get('job')),
+        'nextflow_summary': nextflow_summary,
+        'script_hash': hash_script(script) if script else None,
+        'sacct_compressed': compress_sacct_result(stored),
+    } | _step_usage(job.get('steps') or [])
+    return row, script
+
+
+class SacctResultWriter:
+    """Write-behind buffer for final sacct records
+
+    `write` queues a sacct document and returns once the batch containing
+    it has been committed, so a caller (the storage activity) only succeeds
+    after its row is durable. Batches are flushed as one multi-row
+    `INSERT ... ON CONFLICT (job_id) DO UPDATE` once `max_batch` records
+    are waiting or `max_delay` seconds after the first one arrived. A
+    failed flush fails every waiting `write`, and a retried write simply
+    upserts the same row again, giving at-least-once, idempotent storage.
+    """
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        max_batch: int = settings.RESULT_BATCH_SIZE,
+        max_delay: float = settings.RESULT_FLUSH_INTERVAL,
+    ):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._pending: list[tuple[dict, asyncio.Future]] = []
+        self._batch_full: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    async def write(self, result_dict: dict, nextflow_summary: dict | None = None) -> None:
+        """Queue a final sacct document and wait until it is committed"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((result_row(result_dict, nextflow_summary), future))
+        self._ensure_running()
+        if len(self._pending) >= self.max_batch:
+            self._batch_full.set()
+        await future
+
+    def _ensure_running(self) -> None:
+        if self._batch_full is None:
+            self._batch_full = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while self._pending:
+            try:
+                await asyncio.wait_for(self._batch_full.wait(), self.max_delay)
+            except TimeoutError:
+                pass
+            self._batch_full.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Write everything that is currently buffered"""
+        while self._pending:
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            try:
+                await self._insert([record for record, _ in batch])
+            except Exception as e:
+                logger.error(f"Error writing {len(batch)} sacct results: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+    async def _insert(self, records: list[tuple[dict, str | None]]) -> None:
+        # a multi-row upsert may not touch the same job twice
+        rows = list({row['job_id']: row for row, _ in records}.values())
+        scripts = {
+            row['script_hash']: script
+            for row, script in records
+            if script is not None
+        }
+        stmt = sapg.insert(SlurmBatchJobResult).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[SlurmBatchJobResult.job_id],
+            set_={
+                column: stmt.excluded[column]
+                for column in rows[0]
+                if column != 'job_id'
+            } | {
+                # storing a job again without its trace keeps the summary
+                'nextflow_summary': sa.func.coalesce(
+                    stmt.excluded.nextflow_summary, SlurmBatchJobResult.nextflow_summary,
+                ),
+                '_updated_at': sa.func.now(),
+            },
+        )
+        with timed(DB_WRITE_SECONDS.labels(operation="sacct_results")):
+            async with self.engine.begin() as conn:
+                if scripts:
+                    await conn.execute(
+                        sapg.insert(SlurmBatchScript)
+                        .values([
+                            {'script_hash': script_hash, 'script': script}
+                            for script_hash, script in scripts.items()
+                        ])
+                        .on_conflict_do_nothing()
+                    )
+                await conn.execute(stmt)
+                # finished jobs free cluster capacity for queue consumers
+                await conn.execute(notify(COMPLETION_CHANNEL, str(len(rows))))
@@ -0,0 +1,277 @@
+"""Helpers for working with `sacct --json` output
+
+Status checks only need a handful of fields per job, while a full sacct
+document carries hundreds of lines of step and TRES details per job.
+`parse_sacct_summaries` extracts just the fields in `SacctJobSummary`;
+when the optional `msgspec` package is installed it decodes straight
+into typed structs and never materializes the rest of the document.
+`parse_sacct_document` returns the complete document for storage.
+"""
+import json
+from dataclasses import dataclass
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+# sbatch --comment of our jobs: "cmgd:runs=2,queue=17"
+JOB_COMMENT_PREFIX = "cmgd:"
+
+
+def job_comment(**fields: int | None) -> str:
+    """sbatch comment recording e.g. the run count and the queue row of a job
+
+    sacct returns the comment with every record, which lets the sizing
+    model and reconciliation know what a job was for.
+    """
+    return JOB_COMMENT_PREFIX + ",".join(f"{key}={value}" for key, value in fields.items() if value is not None)
+
+
+def parse_job_comment(comment: str | None) -> dict[str, int]:
+    """The fields of a `job_comment`; empty for other comments"""
+    if not comment or not comment.startswith(JOB_COMMENT_PREFIX):
+        return {}
+    fields = {}
+    for item in comment[len(JOB_COMMENT_PREFIX):].split(","):
+        key, _, value = item.partition("=")
+        try:
+            fields[key] = int(value)
+        except ValueError:
+            pass
+    return fields
+
+
+def get_job_state(job: dict) -> str:
+    """Return the current state of a single sacct job record
+
+    Slurm 23.02 reports `state.current` as a string while newer
+    releases report a list of flags, so normalize both to a string.
+    """
+    return _normalize_state(job['state']['current'])
+
+
+def _normalize_state(state: str | list[str]) -> str:
+    if isinstance(state, list):
+        return state[0] if state else "PENDING"
+    return state
+
+
+def normalize_number(value: int | dict | None) -> int | None:
+    # newer slurm releases wrap numbers as {"set": .., "infinite": .., "number": ..}
+    if isinstance(value, dict):
+        return value.get('number') if value.get('set') else None
+    return value
+
+
+def get_array_job_key(job: dict) -> str | None:
+    """Return `<array_job_id>_<task_id>` for a job array task, else None"""
+    array = job.get('array') or {}
+    task_id = array.get('task_id') or {}
+    if not array.get('job_id') or not task_id.get('set'):
+        return None
+    return f"{array['job_id']}_{task_id['number']}"
+
+
+def get_job_states(result_dict: dict) -> dict[str, str]:
+    """Map job id to current state for every job in a sacct document
+
+    Job array tasks are additionally keyed by `<array_job_id>_<task_id>`,
+    the form returned by `sbatch_submit_array`.
+    """
+    states = {}
+    for job in result_dict.get('jobs', []):
+        try:
+            state = get_job_state(job)
+            states[str(job['job_id'])] = state
+        except (IndexError, KeyError):
+            continue
+        array_key = get_array_job_key(job)
+        if array_key is not None:
+            states[array_key] = state
+    return states
+
+
+@dataclass
+class SacctJobSummary:
+    """The subset of a sacct job record needed to track a job"""
+    job_id: int
+    state: str
+    exit_code: int | None
+    elapsed: int
+    submission: int
+    start: int
+    end: int
+    array_job_id: int = 0
+    array_task_id: int | None = None
+    # the job's sbatch --comment
+    comment: str = ""
+
+    @property
+    def keys(self) -> list[str]:
+        """Ids under which callers may look this job up"""
+        keys = [str(self.job_id)]
+        if self.array_job_id and self.array_task_id is not None:
+            keys.append(f"{self.array_job_id}_{self.array_task_id}")
+        return keys
+
+
+def summarize_job(job: dict) -> SacctJobSummary:
+    """Build a `SacctJobSummary` from a decoded sacct job record"""
+    time = job.get('time') or {}
+    array = job.get('array') or {}
+    task_id = array.get('task_id') or {}
+    return SacctJobSummary(
+        job_id=job['job_id'],
+        state=get_job_state(job),
+        exit_code=normalize_number((job.get('exit_code') or {}).get('return_code')),
+        elapsed=time.get('elapsed', 0),
+        submission=time.get('submission', 0),
+        start=time.get('start', 0),
+        end=time.get('end', 0),
+        array_job_id=array.get('job_id', 0),
+        array_task_id=task_id.get('number') if task_id.get('set') else None,
+        comment=(job.get('comment') or {}).get('job') or "",
+    )
+
+
+if msgspec is not None:
+    # Typed views of the sacct document. Any field not declared here is
+    # skipped by the decoder without being turned into Python objects.
+    class _Number(msgspec.Struct):
+        set: bool = False
+        number: int = 0
+
+    class _State(msgspec.Struct):
+        current: str | list[str] = "PENDING"
+
+    class _ExitCode(msgspec.Struct):
+        return_code: int | _Number | None = None
+
+    class _Time(msgspec.Struct):
+        elapsed: int = 0
+        submission: int = 0
+        start: int = 0
+        end: int = 0
+
+    class _Array(msgspec.Struct):
+        job_id: int = 0
+        task_id: _Number = msgspec.field(default_factory=_Number)
+
+    class _Comment(msgspec.Struct):
+        job: str | None = None
+
+    class _Job(msgspec.Struct):
+        job_id: int
+        state: _State = msgspec.field(default_factory=_State)
+        exit_code: _ExitCode = msgspec.field(default_factory=_ExitCode)
+        time: _Time = msgspec.field(default_factory=_Time)
+        array: _Array = msgspec.field(default_factory=_Array)
+        comment: _Comment = msgspec.field(default_factory=_Comment)
+
+    class _Document(msgspec.Struct):
+        jobs: list[_Job] = []
+
+    _summary_decoder = msgspec.json.Decoder(_Document)
+
+    class _RawDocument(msgspec.Struct):
+        jobs: list[msgspec.Raw] = []
+
+    # splits the document into per-job JSON without decoding any job
+    _raw_decoder = msgspec.json.Decoder(_RawDocument)
+
+    def _summarize_struct(job: "_Job") -> SacctJobSummary:
+        exit_code = job.exit_code.return_code
+        if isinstance(exit_code, _Number):
+            exit_code = exit_code.number if exit_code.set else None
+        return SacctJobSummary(
+            job_id=job.job_id,
+            state=_normalize_state(job.state.current),
+            exit_code=exit_code,
+            elapsed=job.time.elapsed,
+            submission=job.time.submission,
+            start=job.time.start,
+            end=job.time.end,
+            array_job_id=job.array.job_id,
+            array_task_id=job.array.task_id.number if job.array.task_id.set else None,
+            comment=job.comment.job or "",
+        )
+
+
+def parse_sacct_summaries(data: bytes | str) -> list[SacctJobSummary]:
+    """Parse raw `sacct --json` output into per-job summaries"""
+    if msgspec is not None:
+        return [_summarize_struct(job) for job in _summary_decoder.decode(data).jobs]
+    return [summarize_job(job) for job in json.loads(data).get('jobs', [])]
+
+
+def parse_sacct_document(data: bytes | str) -> dict:
+    """Parse raw `sacct --json` output into the full document"""
+    if msgspec is not None:
+        return msgspec.json.decode(data)
+    return json.loads(data)
+
+
+def parse_sacct_jobs(data: bytes | str, indices: list[int]) -> list[dict]:
+    """Decode only the job records at `indices` of raw `sacct --json` output
+
+    The indices are positions in the document's job list, as in the list
+    returned by `parse_sacct_summaries` for the same output.
+    """
+    if msgspec is not None:
+        jobs = _raw_decoder.decode(data).jobs
+        return [msgspec.json.decode(jobs[index]) for index in indices]
+    jobs = json.loads(data).get('jobs', [])
+    return [jobs[index] for index in indices]
+
+
+def is_final_job(job: dict) -> bool:
+    """True once sacct will not add to this job record any more
+
+    Slurm records the job's terminal state before the end time and the
+    records of its steps are complete, so a terminal state alone is not
+    enough to store the record for good.
+    """
+    if not is_terminal_state(get_job_state(job)):
+        return False
+    time = job.get('time') or {}
+    if not time.get('end'):
+        return False
+    steps = job.get('steps') or []
+    # a job cancelled while pending never has steps
+    if not steps and time.get('start'):
+        return False
+    return all(is_terminal_state(_normalize_state(step.get('state') or "")) for step in steps)
+
+
+def get_summary_states(summaries: list[SacctJobSummary]) -> dict[str, str]:
+    """Like `get_job_states`, but for parsed summaries"""
+    return {key: summary.state for summary in summaries for key in summary.keys}
+
+
+# Job states after which Slurm will not run the job again. Everything
+# else (PENDING, RUNNING, REQUEUED, SUSPENDED, COMPLETING, ...) may still
+# change, so callers should keep watching the job.
+TERMINAL_STATES = frozenset({
+    "BOOT_FAIL",
+    "CANCELLED",
+    "COMPLETED",
+    "DEADLINE",
+    "FAILED",
+    "NODE_FAIL",
+    "OUT_OF_MEMORY",
+    "PREEMPTED",
+    "REVOKED",
+    "SPECIAL_EXIT",
+    "TIMEOUT",
+})
+
+
+# terminal states of jobs that asked for too little memory or time
+UNDERSIZED_STATES = ("OUT_OF_MEMORY", "TIMEOUT")
+
+
+def is_terminal_state(state: str) -> bool:
+    # sacct reports e.g. "CANCELLED by 1234" for user cancellations
+    return state.split()[0] in TERMINAL_STATES if state else False
@@ -0,0 +1,44 @@
+import time
+from collections import OrderedDict
+
+from .config import settings
+
+
+class SacctDocumentCache:
+    """Bounded, short-lived cache of single-job sacct documents
+
+    The `SacctPoller` puts the record of every job it sees reach a
+    terminal state here, and `get_and_store_final_sacct_details` takes it
+    out again instead of running `sacct -j` for the same job a moment
+    later. Entries expire after `ttl` seconds and the least recently used
+    ones are dropped beyond `max_size`, so jobs whose storage activity
+    runs on another worker cost no more than a little memory.
+    """
+    def __init__(self, max_size: int = settings.SACCT_CACHE_SIZE, ttl: float = settings.SACCT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        # job_id -> (monotonic expiry time, document)
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def put(self, job_ids: list[str], document: dict) -> None:
+        """Cache `document` under each of `job_ids` (job and array task ids)"""
+        expires = time.monotonic() + self.ttl
+        for job_id in job_ids:
+            self._entries[job_id] = (expires, document)
+            self._entries.move_to_end(job_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, job_id: int | str) -> dict | None:
+        """Remove and return the document of a job, if cached and fresh"""
+        entry = self._entries.pop(str(job_id), None)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
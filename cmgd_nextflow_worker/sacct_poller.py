@@ -0,0 +1,264 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable
+
+from .config import settings
+from .models import CommandResult
+from .sacct import (
+    SacctJobSummary,
+    get_summary_states,
+    is_terminal_state,
+    parse_sacct_jobs,
+    parse_sacct_summaries,
+)
+from .sacct_cache import SacctDocumentCache
+
+logger = logging.getLogger(__name__)
+
+
+def chunked(items: list, size: int) -> list[list]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class SacctPoller:
+    """Worker-wide sacct poller
+
+    Activities register the job ids they are waiting on with `next_state`.
+    Each tick the poller issues one `sacct -j id1,id2,... --json` per
+    chunk of due jobs, parses the combined document once and fans the
+    per-job state out to every waiter.
+
+    Every job is polled on its own adaptive schedule: it starts at
+    `min_interval` and backs off by `backoff` up to `max_interval` while
+    its state does not change. `notify` (driven by the `SpoolWatcher`)
+    makes a job due immediately so that completions are picked up
+    without waiting for the next scheduled poll.
+
+    With a `cache`, the full record of every job seen in a terminal state
+    is kept there for the storage activity.
+    """
+    def __init__(
+        self,
+        run_cmd: Callable[[list[str]], Awaitable[CommandResult]],
+        min_interval: float = settings.SACCT_POLL_MIN_INTERVAL,
+        max_interval: float = settings.SACCT_POLL_INTERVAL,
+        backoff: float = settings.SACCT_POLL_BACKOFF,
+        chunk_size: int = settings.SACCT_CHUNK_SIZE,
+        notify_dir: str = settings.SLURM_NOTIFY_DIR,
+        notify_interval: float = settings.SACCT_NOTIFY_INTERVAL,
+        cache: SacctDocumentCache | None = None,
+    ):
+        self.run_cmd = run_cmd
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+        self.notify_dir = notify_dir
+        self.notify_interval = notify_interval
+        self.cache = cache
+        self._waiters: dict[str, list[asyncio.Future]] = {}
+        # job_id -> (current delay, monotonic time the job is due, last state)
+        self._schedule: dict[str, tuple[float, float, str | None]] = {}
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._watcher_task: asyncio.Task | None = None
+
+    @property
+    def watched_job_ids(self) -> list[str]:
+        return list(self._waiters)
+
+    async def next_state(self, job_id: int | str, immediate: bool = False) -> str:
+        """Wait for the next poll that covers `job_id` and return its state
+
+        With `immediate`, the job is polled in the next batch instead of on
+        its own schedule; used by one-off status checks.
+        """
+        job_id = str(job_id)
+        future = asyncio.get_running_loop().create_future()
+        waiters = self._waiters.setdefault(job_id, [])
+        waiters.append(future)
+        if immediate:
+            delay, _, last_state = self._schedule.get(job_id, (self.min_interval, 0, None))
+            self._schedule[job_id] = (delay, time.monotonic(), last_state)
+        elif job_id not in self._schedule:
+            self._schedule[job_id] = (self.min_interval, time.monotonic() + self.min_interval, None)
+        self._ensure_running()
+        self._wakeup.set()
+        try:
+            return await future
+        finally:
+            # drop our future if we were cancelled before the tick fired
+            if not future.done() and future in waiters:
+                waiters.remove(future)
+                if not waiters and self._waiters.get(job_id) is waiters:
+                    del self._waiters[job_id]
+
+    def notify(self, job_id: int | str) -> bool:
+        """Mark a job as (about to be) finished and poll it right away
+
+        Returns False if this poller is not watching the job.
+        """
+        job_id = str(job_id)
+        if job_id not in self._schedule:
+            return False
+        _, _, last_state = self._schedule[job_id]
+        # the exit trap fires before slurm records the final state, so
+        # restart the backoff from a short delay to catch the transition
+        self._schedule[job_id] = (self.notify_interval, time.monotonic(), last_state)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return True
+
+    def _ensure_running(self) -> None:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        if self.notify_dir and (self._watcher_task is None or self._watcher_task.done()):
+            self._watcher_task = asyncio.create_task(SpoolWatcher(self.notify_dir, self).run())
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            due = [job_id for job_id in self._waiters if self._due_at(job_id) <= now]
+            if due:
+                # pull in jobs that are nearly due to keep sacct calls batched
+                horizon = now + self.min_interval
+                due = [job_id for job_id in self._waiters if self._due_at(job_id) <= horizon]
+                await self.tick(due)
+                continue
+            timeout = None
+            if self._waiters:
+                timeout = min(self._due_at(job_id) for job_id in self._waiters) - now
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except TimeoutError:
+                pass
+
+    def _due_at(self, job_id: str) -> float:
+        # a waiter without a schedule entry is polled right away
+        return self._schedule.get(job_id, (self.min_interval, 0, None))[1]
+
+    async def query_states(self, job_ids: list[str]) -> dict[str, str]:
+        cmd = ["sacct", "-j", ",".join(job_ids), "--json"]
+        result = await self.run_cmd(cmd)
+        if result.returncode != 0:
+            raise Exception(f"Error running sacct: {result.stderr}")
+        summaries = parse_sacct_summaries(result.stdout)
+        if self.cache is not None:
+            self.cache_terminal_jobs(result.stdout, summaries)
+        return get_summary_states(summaries)
+
+    def cache_terminal_jobs(self, data: bytes, summaries: list[SacctJobSummary]) -> None:
+        # only the (few) finished jobs of a poll are decoded in full
+        indices = [i for i, summary in enumerate(summaries) if is_terminal_state(summary.state)]
+        if not indices:
+            return
+        for index, job in zip(indices, parse_sacct_jobs(data, indices)):
+            self.cache.put(summaries[index].keys, {'jobs': [job]})
+
+    def _reschedule(self, job_id: str, state: str | None) -> None:
+        delay, _, last_state = self._schedule.get(job_id, (self.min_interval, 0, None))
+        if state is not None and state == last_state:
+            delay = min(delay * self.backoff, self.max_interval)
+        elif state is not None:
+            # keep the short post-notify delay if the job is mid-transition
+            delay = min(delay, self.min_interval)
+        self._schedule[job_id] = (delay, time.monotonic() + delay, state or last_state)
+
+    async def tick(self, job_ids: list[str] | None = None) -> None:
+        """Poll the given (default: all watched) jobs once and resolve their waiters"""
+        if job_ids is None:
+            job_ids = list(self._waiters)
+        waiters = {job_id: self._waiters.pop(job_id) for job_id in job_ids if job_id in self._waiters}
+        for chunk in chunked(list(waiters), self.chunk_size):
+            try:
+                states = await self.query_states(chunk)
+            except Exception as e:
+                # keep the waiters around for the next poll; slurmdbd
+                # hiccups should not fail every in-flight activity
+                logger.warning(f"sacct poll failed for {len(chunk)} jobs: {e}")
+                for job_id in chunk:
+                    self._waiters.setdefault(job_id, []).extend(waiters[job_id])
+                    self._reschedule(job_id, None)
+                continue
+            for job_id in chunk:
+                # jobs that sacct does not know about yet are still pending
+                state = states.get(job_id, "PENDING")
+                if is_terminal_state(state):
+                    self._schedule.pop(job_id, None)
+                    # waiters that registered while sacct was running get the
+                    # final state too; there is nothing left to poll for them
+                    waiters[job_id].extend(self._waiters.pop(job_id, []))
+                else:
+                    self._reschedule(job_id, state)
+                for future in waiters[job_id]:
+                    if not future.done():
+                        future.set_result(state)
+        # forget schedules of jobs nobody has waited on for a while
+        stale = time.monotonic() - 2 * self.max_interval
+        for job_id in [j for j, (_, due, _) in self._schedule.items() if due < stale and j not in self._waiters]:
+            del self._schedule[job_id]
+
+
+class SpoolWatcher:
+    """Watches the directory that `submit_alpine.sh` writes to on exit
+
+    The batch script's EXIT trap drops a file named after the job id into
+    `notify_dir`. Files for jobs this worker is watching are handed to
+    `SacctPoller.notify` and removed, so finished jobs are re-polled within
+    a fraction of a second. Files for other jobs are left for the worker
+    that watches them and only cleaned up once they are older than
+    `retention` seconds.
+    """
+    def __init__(
+        self,
+        notify_dir: str,
+        poller: SacctPoller,
+        interval: float = settings.SLURM_NOTIFY_SCAN_INTERVAL,
+        retention: float = 3600,
+    ):
+        self.notify_dir = notify_dir
+        self.poller = poller
+        self.interval = interval
+        self.retention = retention
+
+    def scan(self) -> list[tuple[str, str, float]]:
+        try:
+            entries = list(os.scandir(self.notify_dir))
+        except FileNotFoundError:
+            return []
+        found = []
+        for entry in entries:
+            # the trap writes <job_id>.tmp and renames it into place
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                found.append((entry.name, entry.path, entry.stat().st_mtime))
+            except FileNotFoundError:
+                continue
+        return found
+
+    def remove(self, paths: list[str]) -> None:
+        for path in paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    async def run(self) -> None:
+        while True:
+            try:
+                expired = time.time() - self.retention
+                done = []
+                for job_id, path, mtime in await asyncio.to_thread(self.scan):
+                    if self.poller.notify(job_id) or mtime < expired:
+                        done.append(path)
+                if done:
+                    await asyncio.to_thread(self.remove, done)
+            except OSError as e:
+                logger.warning(f"Error scanning {self.notify_dir}: {e}")
+            await asyncio.sleep(self.interval)
@@ -1,46 +1,34 @@
 import asyncio
-import temporalio.client
-from temporalio.worker import Worker
 from cmgd_nextflow_worker.workflow import SlurmBatchJobWorkflow
 from cmgd_nextflow_worker.activities import ActivityContainer
 from cmgd_nextflow_worker.config import settings
-from .external_db import engine
-
-from temporalio.client import Client
+from cmgd_nextflow_worker.context import app
 from cmgd_nextflow_worker.models import CMGDJobInput
+from cmgd_nextflow_worker.worker import create_worker, worker_profiles
 
 async def main(input: CMGDJobInput):
-    # Create a Temporal worker
-    print(settings.TEMPORALIO_ADDRESS)
-    print(settings.TEMPORAL_TLS)
-    
     # Using an activity container allows us to
     # include shared resources across activies
 
-    activities = ActivityContainer(engine)
-    
-    async with Worker(
-        client=await temporalio.client.Client.connect(settings.TEMPORALIO_ADDRESS, tls=settings.TEMPORAL_TLS),
-        task_queue="alpine-task-queue",
-        workflows=[SlurmBatchJobWorkflow],
-        activities=[
-            activities.sbatch_submit, 
-            activities.get_job_status_activity, 
-            activities.get_and_store_final_sacct_details
-        ],
-    ):
-        print("Worker started. Waiting for workflows...")
-        # start a workflow
-        
-        client = await Client.connect(settings.TEMPORALIO_ADDRESS, tls = settings.TEMPORAL_TLS)
-
-        # Start the workflow
-        handle = await client.execute_workflow(
+    activities = ActivityContainer(app.engine)
+    # one client serves the in-process workers and starts the workflow
+    client = await app.temporal_client()
+    workers = [create_worker(client, profile) for profile in worker_profiles(activities).values()]
+    worker_tasks = [asyncio.create_task(worker.run()) for worker in workers]
+    print("Worker started. Waiting for workflows...")
+    try:
+        await client.execute_workflow(
             SlurmBatchJobWorkflow.run,
-            CMGDJobInput(sample_id=input.sample_id, run_ids=input.run_ids),
-            task_queue="alpine-task-queue",
+            CMGDJobInput(sample_id=input.sample_id, run_ids=input.run_ids,
+                         resume=settings.NEXTFLOW_RESUME, skip_completed=settings.SKIP_COMPLETED),
+            task_queue=settings.TASK_QUEUE,
             id=f'{input.sample_id}-cmgd-workflow'
         )
+    finally:
+        for worker in workers:
+            await worker.shutdown()
+        await asyncio.gather(*worker_tasks, return_exceptions=True)
+        await app.close()
          
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+"""Right-sizing of sbatch requests from the usage of past jobs
+
+Every job is submitted with its run count in the sbatch comment (see
+`sacct.job_comment`), which sacct hands back and `result_row` stores as
+`run_count`. `SizingModel` fits, per run
+count, a high quantile of peak memory, CPUs in use (cpu time / elapsed)
+and elapsed time of past jobs and predicts a request of that quantile
+times a safety margin. Run counts without enough history borrow the fit
+of the next larger run count, or get no prediction at all, in which case
+the batch script's #SBATCH defaults apply.
+
+Jobs that ran OUT_OF_MEMORY or into their TIMEOUT needed more than they
+asked for, so they enter the fit with their request as a lower bound of
+their usage. Every undersized job thus pushes later predictions up.
+"""
+import asyncio
+import math
+import time
+from datetime import timedelta
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .config import settings
+from .external_db import SlurmBatchJobResult
+from .models import ResourceRequest
+from .sacct import UNDERSIZED_STATES, parse_job_comment
+
+MIB = 1024 * 1024
+
+
+def parse_run_count(comment: str | None) -> int | None:
+    """Read the run count back from a job's sbatch comment"""
+    return parse_job_comment(comment).get('runs')
+
+
+def _clamp(value: float, low: int, high: int) -> int:
+    return max(low, min(high, math.ceil(value)))
+
+
+class SizingModel:
+    """Predicts a `ResourceRequest` from the number of runs of a sample"""
+    def __init__(
+        self,
+        quantile: float = settings.SIZING_QUANTILE,
+        min_samples: int = settings.SIZING_MIN_SAMPLES,
+        max_run_bucket: int = settings.SIZING_MAX_RUN_BUCKET,
+        history: timedelta = timedelta(days=settings.SIZING_HISTORY_DAYS),
+        refresh_seconds: float = settings.SIZING_REFRESH_SECONDS,
+    ):
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.max_run_bucket = max_run_bucket
+        self.history = history
+        self.refresh_seconds = refresh_seconds
+        # run count bucket -> (jobs, peak memory bytes, cpus in use, elapsed seconds)
+        self.buckets: dict[int, tuple[int, float, float, float]] = {}
+        self._fitted_at: float | None = None
+        self._lock = asyncio.Lock()
+
+    def bucket(self, run_count: int) -> int:
+        return max(1, min(run_count, self.max_run_bucket))
+
+    async def fit(self, engine: AsyncEngine) -> None:
+        """Fit the per run count quantiles in one grouped query"""
+        R = SlurmBatchJobResult
+        bucket = sa.func.least(R.run_count, self.max_run_bucket).label("bucket")
+
+        def quantile(column):
+            return sa.func.percentile_cont(self.quantile).within_group(column)
+
+        # an undersized job used at least what it requested
+        mem_bytes = sa.case(
+            (R.state == "OUT_OF_MEMORY", sa.func.greatest(R.max_rss_bytes, R.req_mem_mb * MIB)),
+            else_=R.max_rss_bytes,
+        )
+        elapsed = sa.case(
+            (R.state == "TIMEOUT", sa.func.greatest(R.elapsed_seconds, R.time_limit_minutes * 60)),
+            else_=R.elapsed_seconds,
+        )
+        stmt = (
+            sa.select(
+                bucket,
+                sa.func.count(),
+                quantile(mem_bytes),
+                quantile(R.cpu_seconds / sa.func.nullif(R.elapsed_seconds, 0)),
+                quantile(elapsed),
+            )
+            .where(
+                R.state.in_(["COMPLETED", *UNDERSIZED_STATES]),
+                R.run_count.is_not(None),
+                mem_bytes.is_not(None),
+                R.end_time > sa.func.now() - self.history,
+            )
+            .group_by(bucket)
+        )
+        async with engine.connect() as conn:
+            rows = (await conn.execute(stmt)).all()
+        self.buckets = {row[0]: tuple(row[1:]) for row in rows}
+        self._fitted_at = time.monotonic()
+
+    async def refresh(self, engine: AsyncEngine) -> None:
+        """Refit if the fit is older than `refresh_seconds`"""
+        async with self._lock:
+            if self._fitted_at is None or time.monotonic() - self._fitted_at > self.refresh_seconds:
+                await self.fit(engine)
+
+    def predict(self, run_count: int) -> ResourceRequest | None:
+        for bucket in range(self.bucket(run_count), self.max_run_bucket + 1):
+            n, mem_bytes, cpus, elapsed = self.buckets.get(bucket, (0, None, None, None))
+            if n >= self.min_samples and mem_bytes and elapsed:
+                break
+        else:
+            return None
+        return ResourceRequest(
+            mem_mb=_clamp(mem_bytes * settings.SIZING_MEM_MARGIN / MIB, settings.SIZING_MIN_MEM_MB, settings.SIZING_MAX_MEM_MB),
+            cpus=_clamp((cpus or 0) * settings.SIZING_CPU_MARGIN, settings.SIZING_MIN_CPUS, settings.SIZING_MAX_CPUS),
+            time_minutes=_clamp(elapsed * settings.SIZING_TIME_MARGIN / 60, settings.SIZING_MIN_MINUTES, settings.SIZING_MAX_MINUTES),
+        )
+
+
+async def sizing_report(engine: AsyncEngine, history: timedelta = timedelta(days=settings.SIZING_HISTORY_DAYS)) -> list[dict]:
+    """Requested vs used resources of finished jobs, per run count"""
+    R = SlurmBatchJobResult
+    bucket = sa.func.least(R.run_count, settings.SIZING_MAX_RUN_BUCKET).label("runs")
+
+    def median(column):
+        return sa.func.percentile_cont(0.5).within_group(column)
+
+    def p95(column):
+        return sa.func.percentile_cont(0.95).within_group(column)
+
+    cpus_used = R.cpu_seconds / sa.func.nullif(R.elapsed_seconds, 0)
+    stmt = (
+        sa.select(
+            bucket,
+            sa.func.count().label("jobs"),
+            sa.func.count().filter(R.state == "COMPLETED").label("completed"),
+            sa.func.count().filter(R.state.in_(UNDERSIZED_STATES)).label("oom_or_timeout"),
+            median(R.req_mem_mb).label("req_mem_mb"),
+            median(R.max_rss_bytes / MIB).label("used_mem_mb_p50"),
+            p95(R.max_rss_bytes / MIB).label("used_mem_mb_p95"),
+            median(R.req_cpus).label("req_cpus"),
+            median(cpus_used).label("used_cpus_p50"),
+            median(R.time_limit_minutes).label("req_minutes"),
+            median(R.elapsed_seconds / 60.0).label("used_minutes_p50"),
+            p95(R.elapsed_seconds / 60.0).label("used_minutes_p95"),
+        )
+        .where(R.end_time > sa.func.now() - history)
+        .group_by(bucket)
+        .order_by(bucket.nulls_last())
+    )
+    async with engine.connect() as conn:
+        return [dict(row._mapping) for row in (await conn.execute(stmt)).all()]
+
+
+async def print_sizing_report(engine: AsyncEngine) -> None:
+    rows = await sizing_report(engine)
+    columns = [
+        ("runs", "runs"), ("jobs", "jobs"), ("completed", "ok"), ("oom_or_timeout", "oom/to"),
+        ("req_mem_mb", "mem req"), ("used_mem_mb_p50", "used p50"), ("used_mem_mb_p95", "used p95"),
+        ("req_cpus", "cpu req"), ("used_cpus_p50", "used p50"),
+        ("req_minutes", "min req"), ("used_minutes_p50", "used p50"), ("used_minutes_p95", "used p95"),
+    ]
+    print("  ".join(f"{label:>8s}" for _, label in columns))
+    for row in rows:
+        cells = []
+        for key, _ in columns:
+            value = row[key]
+            cells.append(f"{'-' if value is None else f'{value:.0f}':>8s}")
+        print("  ".join(cells))
@@ -1,19 +1,27 @@
 import asyncio
-from temporalio.client import Client
-from cmgd_nextflow_worker.workflow import SlurmBatchJobWorkflow
-from cmgd_nextflow_worker.models import CMGDJobInput
+from cmgd_nextflow_worker.workflow import QueueCoordinatorWorkflow, SlurmBatchJobWorkflow
+from cmgd_nextflow_worker.models import CMGDJobInput, QueueCoordinatorState
 
 from cmgd_nextflow_worker.config import settings
+from cmgd_nextflow_worker.context import app
 
 async def main(input: CMGDJobInput):
     # Connect to the Temporal server
-    client = await Client.connect(settings.TEMPORALIO_ADDRESS, tls = settings.TEMPORAL_TLS)
+    client = await app.temporal_client()
 
     # Start the workflow
     handle = await client.start_workflow(
         SlurmBatchJobWorkflow.run,
-        CMGDJobInput(sample_id=input.sample_id, run_ids=input.run_ids),
-        task_queue="alpine-task-queue",
+        CMGDJobInput(
+            sample_id=input.sample_id,
+            run_ids=input.run_ids,
+            status_check_interval=settings.STATUS_CHECK_INTERVAL or None,
+            status_check_max_interval=settings.STATUS_CHECK_MAX_INTERVAL,
+            right_size=settings.SIZING_ENABLED,
+            resume=settings.NEXTFLOW_RESUME,
+            skip_completed=settings.SKIP_COMPLETED,
+        ),
+        task_queue=settings.TASK_QUEUE,
         id=f'{input.sample_id}-cmgd-workflow'
     )
     print(f"Workflow started with ID: {handle.id}")
@@ -27,10 +35,31 @@ async def main(input: CMGDJobInput):
     # result = await handle.result()
     # print(f"Workflow result: {result}")
 
+async def start_queue_coordinator():
+    """Start the workflow that drains the job queue (once per namespace)"""
+    client = await app.temporal_client()
+    handle = await client.start_workflow(
+        QueueCoordinatorWorkflow.run,
+        QueueCoordinatorState(
+            max_children=settings.COORDINATOR_MAX_CHILDREN,
+            claim_batch=settings.COORDINATOR_CLAIM_BATCH,
+            idle_seconds=settings.COORDINATOR_IDLE_SECONDS,
+        ),
+        task_queue=settings.TASK_QUEUE,
+        id='cmgd-queue-coordinator'
+    )
+    print(f"Queue coordinator started with ID: {handle.id}")
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="Start a Temporal workflow")
-    parser.add_argument("--sample-id", type=str, help="The sample ID", required=True)
-    parser.add_argument("--run-ids", type=str, nargs="+", help="The run IDs", required=True)
+    parser.add_argument("--sample-id", type=str, help="The sample ID")
+    parser.add_argument("--run-ids", type=str, nargs="+", help="The run IDs")
+    parser.add_argument("--drain-queue", action="store_true", help="Start the job queue coordinator instead")
     args = parser.parse_args()
-    asyncio.run(main(CMGDJobInput(sample_id=args.sample_id, run_ids=args.run_ids)))
\ No newline at end of file
+    if args.drain_queue:
+        asyncio.run(start_queue_coordinator())
+    elif args.sample_id and args.run_ids:
+        asyncio.run(main(CMGDJobInput(sample_id=args.sample_id, run_ids=args.run_ids)))
+    else:
+        parser.error("--sample-id and --run-ids are required unless --drain-queue is given")
\ No newline at end of file
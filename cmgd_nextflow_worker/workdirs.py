@@ -0,0 +1,141 @@
+"""Persistent per-sample Nextflow work directories
+
+In resume mode each sample gets a stable launch directory under
+NEXTFLOW_WORK_ROOT instead of the job's `$SLURM_SCRATCH`, so the session
+history and the `work/` task cache survive the job. `submit_alpine.sh`
+adds `-resume` when it finds an earlier session there, and a retry only
+runs the tasks that were left.
+
+Directories of completed samples are marked and removed after
+WORKDIR_COMPLETED_RETENTION_HOURS; directories of failed or abandoned
+samples are kept for WORKDIR_FAILED_RETENTION_DAYS so they can still be
+resumed. If the root grows beyond WORKDIR_MAX_GB, completed and then idle
+directories are removed oldest first.
+
+    python -m cmgd_nextflow_worker.workdirs [--dry-run]
+"""
+import argparse
+import hashlib
+import logging
+import os
+import re
+import shutil
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+COMPLETED_MARKER = ".cmgd-completed"
+# directories touched more recently than this may belong to a running job
+IDLE_AFTER = timedelta(days=1)
+
+
+def work_dir(sample_id: str, root: str = settings.NEXTFLOW_WORK_ROOT) -> str:
+    """The launch directory of a sample, the same for every attempt
+
+    Unsafe characters are replaced, and a hash of the raw id keeps ids
+    that differ only in those characters apart.
+    """
+    digest = hashlib.sha256(sample_id.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(root, f"{re.sub(r'[^A-Za-z0-9._-]', '_', sample_id)}-{digest}")
+
+
+def finish(path: str, retention: timedelta = timedelta(hours=settings.WORKDIR_COMPLETED_RETENTION_HOURS)) -> None:
+    """Remove the directory of a completed sample, or mark it for `prune`"""
+    if not os.path.isdir(path):
+        return
+    if retention <= timedelta(0):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        with open(os.path.join(path, COMPLETED_MARKER), "w"):
+            pass
+
+
+@dataclass
+class WorkDir:
+    path: str
+    completed: bool
+    # seconds since the epoch of the last sign of activity
+    touched: float
+    size: int = 0
+
+
+def disk_usage(path: str) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def scan(root: str) -> list[WorkDir]:
+    dirs = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            marker = os.path.join(entry.path, COMPLETED_MARKER)
+            completed = os.path.exists(marker)
+            if completed:
+                touched = os.path.getmtime(marker)
+            else:
+                # nextflow appends to its log for as long as the run lasts
+                log = os.path.join(entry.path, ".nextflow.log")
+                touched = max(entry.stat().st_mtime, os.path.getmtime(log) if os.path.exists(log) else 0)
+            dirs.append(WorkDir(entry.path, completed, touched))
+    return dirs
+
+
+def prune(
+    root: str = settings.NEXTFLOW_WORK_ROOT,
+    completed_retention: timedelta = timedelta(hours=settings.WORKDIR_COMPLETED_RETENTION_HOURS),
+    failed_retention: timedelta = timedelta(days=settings.WORKDIR_FAILED_RETENTION_DAYS),
+    max_bytes: int = int(settings.WORKDIR_MAX_GB * 1024**3),
+    dry_run: bool = False,
+) -> list[str]:
+    """Apply the retention and size policy to `root`; return removed paths"""
+    if not os.path.isdir(root):
+        return []
+    now = time.time()
+    dirs = scan(root)
+    expired = [
+        d for d in dirs
+        if now - d.touched > (completed_retention if d.completed else failed_retention).total_seconds()
+    ]
+    remaining = [d for d in dirs if d not in expired]
+    evicted = []
+    if max_bytes > 0:
+        for d in remaining:
+            d.size = disk_usage(d.path)
+        total = sum(d.size for d in remaining)
+        # completed first, then idle, each oldest first; never a live run
+        candidates = sorted(
+            (d for d in remaining if d.completed or now - d.touched > IDLE_AFTER.total_seconds()),
+            key=lambda d: (not d.completed, d.touched),
+        )
+        for d in candidates:
+            if total <= max_bytes:
+                break
+            evicted.append(d)
+            total -= d.size
+    removed = [d.path for d in expired + evicted]
+    for path in removed:
+        logger.info(f"{'Would remove' if dry_run else 'Removing'} work directory {path}")
+        if not dry_run:
+            shutil.rmtree(path, ignore_errors=True)
+    return removed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Prune persistent Nextflow work directories")
+    parser.add_argument("--dry-run", action="store_true", help="only list what would be removed")
+    args = parser.parse_args()
+    removed = prune(dry_run=args.dry_run)
+    print(f"{'Would remove' if args.dry_run else 'Removed'} {len(removed)} work directories")
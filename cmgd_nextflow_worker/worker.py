@@ -1,33 +1,133 @@
 import asyncio
+from dataclasses import dataclass, field
+from typing import Callable
 import temporalio.client
 from temporalio.worker import Worker
-from cmgd_nextflow_worker.workflow import SlurmBatchJobWorkflow
+from cmgd_nextflow_worker.workflow import SlurmBatchJobWorkflow, SlurmBatchArrayWorkflow, QueueCoordinatorWorkflow
 from cmgd_nextflow_worker.activities import ActivityContainer
 from cmgd_nextflow_worker.config import settings
-from .external_db import engine
+from cmgd_nextflow_worker.context import app
+from cmgd_nextflow_worker.metrics import start_metrics_server
+from .external_db import report_queue_depth
+from .reconcile import JOB_QUEUE, reconcile_periodically
+
+
+@dataclass
+class WorkerProfile:
+    """One task queue served by this process, with its own limits
+
+    Each stage of the pipeline has its own task queue, so that e.g.
+    thousands of waiting status activities cannot starve quick sbatch
+    submissions, and each stage can be scaled on its own nodes by running
+    `worker.py` with a different WORKER_PROFILES.
+    """
+    task_queue: str
+    workflows: list[type] = field(default_factory=list)
+    activities: list[Callable] = field(default_factory=list)
+    max_concurrent_activities: int | None = None
+    max_concurrent_workflow_tasks: int | None = None
+    # 0 means unlimited
+    max_activities_per_second: float = 0
+
+
+def worker_profiles(activities: ActivityContainer) -> dict[str, WorkerProfile]:
+    return {
+        'workflow': WorkerProfile(
+            task_queue=settings.TASK_QUEUE,
+            workflows=[SlurmBatchJobWorkflow, SlurmBatchArrayWorkflow, QueueCoordinatorWorkflow],
+            max_concurrent_workflow_tasks=settings.WORKFLOW_MAX_TASKS,
+        ),
+        'submit': WorkerProfile(
+            task_queue=settings.SUBMIT_TASK_QUEUE,
+            activities=[
+                activities.sbatch_submit,
+                activities.sbatch_submit_array,
+            ],
+            max_concurrent_activities=settings.SUBMIT_MAX_ACTIVITIES,
+            max_activities_per_second=settings.SUBMIT_ACTIVITIES_PER_SECOND,
+        ),
+        'monitor': WorkerProfile(
+            task_queue=settings.MONITOR_TASK_QUEUE,
+            activities=[
+                activities.get_job_status_activity,
+                activities.check_job_state,
+            ],
+            max_concurrent_activities=settings.MONITOR_MAX_ACTIVITIES,
+            max_activities_per_second=settings.MONITOR_ACTIVITIES_PER_SECOND,
+        ),
+        'persist': WorkerProfile(
+            task_queue=settings.PERSIST_TASK_QUEUE,
+            activities=[
+                activities.get_and_store_final_sacct_details,
+                activities.ingest_nextflow_trace,
+                activities.predict_resources,
+                activities.completed_samples,
+                activities.record_completions,
+                activities.claim_queued_jobs,
+                activities.mark_queued_jobs,
+                activities.closed_queue_children,
+                # slow filesystem work that must not hold up sbatch
+                activities.finish_work_dir,
+            ],
+            max_concurrent_activities=settings.PERSIST_MAX_ACTIVITIES,
+            max_activities_per_second=settings.PERSIST_ACTIVITIES_PER_SECOND,
+        ),
+    }
+
+
+def create_worker(client: temporalio.client.Client, profile: WorkerProfile) -> Worker:
+    kwargs = {}
+    if profile.max_concurrent_activities is not None:
+        kwargs['max_concurrent_activities'] = profile.max_concurrent_activities
+    if profile.max_concurrent_workflow_tasks is not None:
+        kwargs['max_concurrent_workflow_tasks'] = profile.max_concurrent_workflow_tasks
+    if profile.max_activities_per_second:
+        kwargs['max_activities_per_second'] = profile.max_activities_per_second
+    return Worker(
+        client=client,
+        task_queue=profile.task_queue,
+        workflows=profile.workflows,
+        activities=profile.activities,
+        **kwargs,
+    )
+
 
 async def main():
-    # Create a Temporal worker
-    print(settings.TEMPORALIO_ADDRESS)
-    print(settings.TEMPORAL_TLS)
-    
+    names = [name.strip() for name in settings.WORKER_PROFILES.split(',') if name.strip()]
+    uses_db = 'persist' in names
+
     # Using an activity container allows us to
     # include shared resources across activies
+    # (only persistence activities need the database)
+    activities = ActivityContainer(app.engine if uses_db else None)
+    profiles = worker_profiles(activities)
+    unknown = set(names) - set(profiles)
+    if unknown:
+        raise ValueError(f"Unknown worker profiles {sorted(unknown)}; choose from {sorted(profiles)}")
+
+    # connect to Temporal and open the database pool concurrently
+    client, _ = await asyncio.gather(
+        app.temporal_client(),
+        app.warm_up() if uses_db else asyncio.sleep(0),
+    )
+    workers = [create_worker(client, profiles[name]) for name in names]
+    tasks = [worker.run() for worker in workers]
+    if start_metrics_server() and uses_db:
+        tasks.append(report_queue_depth())
+    if uses_db and settings.RECONCILE_INTERVAL > 0:
+        # picks up queue rows left behind by crashed workers
+        tasks.append(reconcile_periodically(JOB_QUEUE, activities.run_cmd))
+    print(f"Worker for {', '.join(names)} connected to {settings.TEMPORALIO_ADDRESS}. Waiting for workflows...")
+    try:
+        # Keep the workers running
+        await asyncio.gather(*tasks)
+    finally:
+        await app.close()
+
 
-    activities = ActivityContainer(engine)
-    
-    async with Worker(
-        client=await temporalio.client.Client.connect(settings.TEMPORALIO_ADDRESS, tls=settings.TEMPORAL_TLS),
-        task_queue="alpine-task-queue",
-        workflows=[SlurmBatchJobWorkflow],
-        activities=[
-            activities.sbatch_submit, 
-            activities.get_job_status_activity, 
-            activities.get_and_store_final_sacct_details
-        ],
-    ):
-        print("Worker started. Waiting for workflows...")
-        await asyncio.Event().wait()  # Keep the worker running
+def run() -> None:
+    """Entry point of the `cmgd-worker` command"""
+    asyncio.run(main())
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    run()
@@ -1,60 +1,438 @@
+import asyncio
+import dataclasses
 from temporalio import workflow
+from temporalio.exceptions import WorkflowAlreadyStartedError
 
 # Define the signal name
 CONTINUE_SIGNAL = "continue_signal"
-from datetime import timedelta
-from cmgd_nextflow_worker.models import CMGDJobInput
+CHILD_FINISHED_SIGNAL = "child_finished"
+# job_queue_records statuses, as in external_db (which needs a database
+# engine and so is not imported into workflow code)
+COMPLETED = "COMPLETED"
+FAILED = "FAILED"
+from datetime import datetime, timedelta
+from temporalio.workflow import ParentClosePolicy
+from cmgd_nextflow_worker.models import (
+    CMGDJobInput,
+    JobRegistration,
+    QueueCoordinatorState,
+    QueueJobResult,
+    ResourceRequest,
+    queue_workflow_id,
+)
 
 with workflow.unsafe.imports_passed_through():
-    pass
+    # task queue names are read from the environment once at import, so
+    # every worker of a deployment must share the same *_TASK_QUEUE values
+    from cmgd_nextflow_worker.config import settings
+    from cmgd_nextflow_worker.sacct import UNDERSIZED_STATES, is_terminal_state, job_comment
+    from cmgd_nextflow_worker.workdirs import work_dir
     # from cmgd_nextflow_worker.activities import ActivityContainer
 
 
+async def completed_samples(inputs: list[CMGDJobInput]) -> list[str]:
+    """Sample ids of `inputs` in the completion index"""
+    return await workflow.execute_activity(
+        "completed_samples",
+        inputs,
+        task_queue=settings.PERSIST_TASK_QUEUE,
+        start_to_close_timeout=timedelta(seconds=60),
+        result_type=list[str],
+    )
+
+
+async def record_completions(inputs: list[CMGDJobInput], job_ids: list[str]) -> None:
+    if inputs:
+        await workflow.execute_activity(
+            "record_completions",
+            args=[inputs, job_ids],
+            task_queue=settings.PERSIST_TASK_QUEUE,
+            start_to_close_timeout=timedelta(seconds=60),
+        )
+
+
 @workflow.defn
 class SlurmBatchJobWorkflow:
     def __init__(self):
         self.signal_received = False
+        self.final_state: str | None = None
 
     @workflow.run
     async def run(self, input: CMGDJobInput) -> dict:
         self.input = input
-        # Log the start of the workflow
-        workflow.logger.info("Workflow started. Waiting for signal...")
+        try:
+            if input.skip_completed and await completed_samples([input]):
+                workflow.logger.info(f"Sample {input.sample_id} already completed, skipping")
+                self.final_state = "COMPLETED"
+                return {'jobs': [], 'already_completed': True}
+            return await self.run_job(input)
+        finally:
+            await self.report_to_coordinator(input)
+
+    async def report_to_coordinator(self, input: CMGDJobInput) -> None:
+        """Tell the QueueCoordinatorWorkflow that started us how the job ended"""
+        parent = workflow.info().parent
+        if parent is None or input.queue_id is None:
+            return
+        # no run id: the coordinator may have continued as new since
+        coordinator = workflow.get_external_workflow_handle(parent.workflow_id)
+        status = COMPLETED if self.final_state == "COMPLETED" else FAILED
+        await coordinator.signal(CHILD_FINISHED_SIGNAL, QueueJobResult(input.queue_id, status))
+
+    async def run_job(self, input: CMGDJobInput) -> dict:
+        if input.tracker_workflow_id is None:
+            return await self.submit_and_wait(input)
+
+        # hold a slot in the concurrency tracker for the lifetime of the job
+        tracker = workflow.get_external_workflow_handle(input.tracker_workflow_id)
+        workflow_id = workflow.info().workflow_id
+        await tracker.signal(
+            "register_job",
+            JobRegistration(job_id=workflow_id, workflow_id=workflow_id),
+        )
+        try:
+            workflow.logger.info("Workflow started. Waiting for signal...")
+            await workflow.wait_condition(lambda: self.signal_received)
+            workflow.logger.info("Signal received. Proceeding with workflow...")
+            return await self.submit_and_wait(input)
+        finally:
+            await tracker.signal("complete_job", workflow_id)
 
-        # Wait for the signal to be received
-        # await workflow.wait_condition(lambda: self.signal_received)
+    async def submit_and_wait(self, input: CMGDJobInput) -> dict:
+        resources = None
+        if input.right_size:
+            resources = await workflow.execute_activity(
+                "predict_resources",
+                input,
+                task_queue=settings.PERSIST_TASK_QUEUE,
+                start_to_close_timeout=timedelta(seconds=60),
+                result_type=ResourceRequest | None,
+            )
+        final_sacct_details = await self.submit_once(input, resources)
+        if resources is not None and self.final_state in UNDERSIZED_STATES:
+            # the prediction was too tight; the failed attempt is stored and
+            # raises later predictions (see sizing.py), and the sample runs
+            # once more with the batch script's defaults
+            workflow.logger.info(f"Right-sized job ended {self.final_state}, resubmitting with defaults")
+            final_sacct_details = await self.submit_once(input, None)
+        return final_sacct_details
 
-        # Proceed after receiving the signal
-        # workflow.logger.info("Signal received. Proceeding with workflow...")
-        command = f"sbatch --export=NONE submit_alpine.sh '{';'.join(input.run_ids)}' {input.sample_id}"
+    async def submit_once(self, input: CMGDJobInput, resources: ResourceRequest | None) -> dict:
+        command = [
+            "sbatch", "--export=NONE",
+            # lets sizing and reconciliation tell what the job was for
+            f"--comment={job_comment(runs=len(input.run_ids), queue=input.queue_id)}",
+            *(resources.sbatch_args() if resources else []),
+            "submit_alpine.sh", ';'.join(input.run_ids), input.sample_id,
+            # the same directory on every attempt, so later ones resume
+            *([work_dir(input.sample_id)] if input.resume else []),
+        ]
         # for testing
-        # command = "sbatch --export=NONE submit_test.sh"
+        # command = ["sbatch", "--export=NONE", "submit_test.sh"]
         
         job_id = await workflow.execute_activity(
             "sbatch_submit",
             command,
+            task_queue=settings.SUBMIT_TASK_QUEUE,
             start_to_close_timeout=timedelta(seconds=10),
         )
         
-        final_state = await workflow.execute_activity(
-            "get_job_status_activity",
-            job_id,
-            start_to_close_timeout=timedelta(days = 2),
-            heartbeat_timeout=timedelta(seconds=30),
-        )
+        if input.status_check_interval:
+            self.final_state = await self.wait_with_timers(job_id, input)
+        else:
+            self.final_state = await workflow.execute_activity(
+                "get_job_status_activity",
+                job_id,
+                task_queue=settings.MONITOR_TASK_QUEUE,
+                start_to_close_timeout=timedelta(days = 2),
+                heartbeat_timeout=timedelta(seconds=30),
+            )
         
+        nextflow_summary = await workflow.execute_activity(
+            "ingest_nextflow_trace",
+            args=[job_id, input.sample_id],
+            task_queue=settings.PERSIST_TASK_QUEUE,
+            start_to_close_timeout=timedelta(minutes=10),
+            heartbeat_timeout=timedelta(minutes=1),
+            result_type=dict | None,
+        )
         final_sacct_details = await workflow.execute_activity(
             "get_and_store_final_sacct_details",
-            job_id,
+            args=[job_id, nextflow_summary],
+            task_queue=settings.PERSIST_TASK_QUEUE,
             start_to_close_timeout=timedelta(seconds=30),
             heartbeat_timeout=timedelta(seconds=30),
         )
-
+        if self.final_state == "COMPLETED":
+            await record_completions([input], [str(job_id)])
+            if input.resume:
+                await workflow.execute_activity(
+                    "finish_work_dir",
+                    input.sample_id,
+                    task_queue=settings.PERSIST_TASK_QUEUE,
+                    # removing a large work/ tree and pruning take a while
+                    start_to_close_timeout=timedelta(minutes=30),
+                )
 
         return final_sacct_details
         
         
 
+    async def wait_with_timers(self, job_id: int, input: CMGDJobInput) -> str:
+        """Check the job's state between durable timers until it is terminal
+
+        Nothing runs on the worker while the timer is pending, so a waiting
+        job costs no activity slot. The interval grows by half after every
+        check up to `status_check_max_interval`. Each check adds about nine
+        history events, so at the default 600 s cap a 20 hour job makes
+        about 120 checks and 1,100 events.
+        """
+        interval = input.status_check_interval
+        while True:
+            state = await workflow.execute_activity(
+                "check_job_state",
+                job_id,
+                task_queue=settings.MONITOR_TASK_QUEUE,
+                start_to_close_timeout=timedelta(minutes=5),
+            )
+            if is_terminal_state(state):
+                return state
+            await workflow.sleep(interval)
+            interval = min(interval * 1.5, max(input.status_check_max_interval, input.status_check_interval))
+
     @workflow.signal(name=CONTINUE_SIGNAL)
     def continue_signal(self):
-        self.signal_received = True
\ No newline at end of file
+        self.signal_received = True
+
+
+@workflow.defn
+class SlurmBatchArrayWorkflow:
+    """Submit many samples as Slurm job arrays and follow each task
+
+    Returns a mapping from sample_id to the final Slurm state of its task.
+    """
+    @workflow.run
+    async def run(self, inputs: list[CMGDJobInput]) -> dict[str, str]:
+        done = {}
+        if any(input.skip_completed for input in inputs):
+            completed = set(await completed_samples([input for input in inputs if input.skip_completed]))
+            done = {sample_id: "COMPLETED" for sample_id in completed}
+            inputs = [input for input in inputs if input.sample_id not in completed]
+            workflow.logger.info(f"Skipping {len(done)} already completed samples")
+        if not inputs:
+            return done
+        workflow.logger.info(f"Submitting {len(inputs)} samples as job arrays")
+        job_ids = await workflow.execute_activity(
+            "sbatch_submit_array",
+            inputs,
+            task_queue=settings.SUBMIT_TASK_QUEUE,
+            result_type=dict[str, str],
+            # one sbatch per SLURM_MAX_ARRAY_SIZE samples
+            start_to_close_timeout=timedelta(minutes=10),
+            heartbeat_timeout=timedelta(minutes=2),
+        )
+
+        sample_ids = list(job_ids)
+        final_states = dict(zip(sample_ids, await asyncio.gather(
+            *[self.wait_and_store(job_ids[sample_id], sample_id) for sample_id in sample_ids]
+        )))
+        succeeded = [input for input in inputs if final_states.get(input.sample_id) == "COMPLETED"]
+        await record_completions(succeeded, [job_ids[input.sample_id] for input in succeeded])
+        return {**done, **final_states}
+
+    async def wait_and_store(self, job_id: str, sample_id: str) -> str:
+        final_state = await workflow.execute_activity(
+            "get_job_status_activity",
+            job_id,
+            task_queue=settings.MONITOR_TASK_QUEUE,
+            start_to_close_timeout=timedelta(days = 2),
+            heartbeat_timeout=timedelta(seconds=30),
+        )
+        nextflow_summary = await workflow.execute_activity(
+            "ingest_nextflow_trace",
+            args=[job_id, sample_id],
+            task_queue=settings.PERSIST_TASK_QUEUE,
+            start_to_close_timeout=timedelta(minutes=10),
+            heartbeat_timeout=timedelta(minutes=1),
+            result_type=dict | None,
+        )
+        await workflow.execute_activity(
+            "get_and_store_final_sacct_details",
+            args=[job_id, nextflow_summary],
+            task_queue=settings.PERSIST_TASK_QUEUE,
+            start_to_close_timeout=timedelta(seconds=30),
+            heartbeat_timeout=timedelta(seconds=30),
+        )
+        return final_state
+
+
+@workflow.defn
+class QueueCoordinatorWorkflow:
+    """Drain the job queue into SlurmBatchJobWorkflow children
+
+    Claims batches of QUEUED rows with the `claim_queued_jobs` activity and
+    starts one child workflow per row, keeping at most `max_children` in
+    flight. Children outlive the run that started them
+    (ParentClosePolicy.ABANDON) and report back with CHILD_FINISHED_SIGNAL,
+    which reaches whichever run of the coordinator is current. Finished
+    rows are written back to the queue in batches with `mark_queued_jobs`.
+
+    A child that is terminated, times out or fails before its report would
+    hold its slot for good, so the run awaits the result of every child it
+    started, and every `child_check_seconds` asks `closed_queue_children`
+    about the children of earlier runs.
+
+    The coordinator continues as new once Temporal suggests it or its
+    history exceeds `history_limit` events, carrying the ids of running
+    children in its `QueueCoordinatorState`.
+    """
+    def __init__(self):
+        self.state = QueueCoordinatorState()
+        self.running: set[int] = set()
+        # queue ids of the running children whose result this run awaits
+        self.watched: set[int] = set()
+        self.next_child_check: datetime | None = None
+        self.paused = False
+
+    @workflow.signal(name=CHILD_FINISHED_SIGNAL)
+    def child_finished(self, result: QueueJobResult):
+        # children of a previous run report here too; ignore duplicates
+        if result.queue_id in self.running:
+            self.running.discard(result.queue_id)
+            self.state.finished.append(result)
+            self.state.finished_total += 1
+
+    @workflow.signal
+    def set_max_children(self, max_children: int):
+        self.state.max_children = max_children
+
+    @workflow.signal
+    def pause(self, paused: bool):
+        """Stop (or resume) claiming new rows; running children are unaffected"""
+        self.paused = paused
+
+    @workflow.query
+    def status(self) -> QueueCoordinatorState:
+        return self.snapshot()
+
+    def snapshot(self) -> QueueCoordinatorState:
+        # a copy, as queries must not change workflow state
+        return dataclasses.replace(self.state, running=sorted(self.running), finished=list(self.state.finished))
+
+    @property
+    def unwatched(self) -> list[int]:
+        """Running children started by an earlier run"""
+        return sorted(self.running - self.watched)
+
+    @property
+    def free(self) -> int:
+        return 0 if self.paused else max(0, self.state.max_children - len(self.running))
+
+    def should_continue_as_new(self) -> bool:
+        info = workflow.info()
+        return info.is_continue_as_new_suggested() or info.get_current_history_length() > self.state.history_limit
+
+    async def mark_finished(self) -> None:
+        finished, self.state.finished = self.state.finished, []
+        if finished:
+            await workflow.execute_activity(
+                "mark_queued_jobs",
+                finished,
+                task_queue=settings.PERSIST_TASK_QUEUE,
+                start_to_close_timeout=timedelta(minutes=1),
+            )
+
+    async def start_child(self, input: CMGDJobInput) -> None:
+        try:
+            handle = await workflow.start_child_workflow(
+                SlurmBatchJobWorkflow.run,
+                input,
+                id=queue_workflow_id(input.queue_id),
+                parent_close_policy=ParentClosePolicy.ABANDON,
+            )
+        except WorkflowAlreadyStartedError:
+            # e.g. the row was claimed again after its lease ran out; the
+            # running child reports back or is found by check_children
+            workflow.logger.warning(f"Workflow for queue job {input.queue_id} is already running")
+            return
+        except Exception as e:
+            workflow.logger.error(f"Could not start workflow for queue job {input.queue_id}: {e}")
+            self.child_finished(QueueJobResult(input.queue_id, FAILED))
+            return
+        self.watched.add(input.queue_id)
+        asyncio.create_task(self.watch_child(input.queue_id, handle))
+
+    async def watch_child(self, queue_id: int, handle: workflow.ChildWorkflowHandle) -> None:
+        try:
+            await handle
+        except Exception as e:
+            # a child that reported first is ignored by child_finished
+            workflow.logger.warning(f"Workflow for queue job {queue_id} did not complete: {e}")
+            self.child_finished(QueueJobResult(queue_id, FAILED))
+        finally:
+            self.watched.discard(queue_id)
+
+    async def check_children(self) -> None:
+        """Free the slots of children of earlier runs that closed without reporting"""
+        unwatched = self.unwatched
+        if not unwatched or (self.next_child_check is not None and workflow.now() < self.next_child_check):
+            return
+        self.next_child_check = workflow.now() + timedelta(seconds=self.state.child_check_seconds)
+        results = await workflow.execute_activity(
+            "closed_queue_children",
+            unwatched,
+            task_queue=settings.PERSIST_TASK_QUEUE,
+            result_type=list[QueueJobResult],
+            start_to_close_timeout=timedelta(minutes=1),
+        )
+        for result in results:
+            workflow.logger.warning(f"Workflow for queue job {result.queue_id} closed without reporting")
+            self.child_finished(result)
+
+    @workflow.run
+    async def run(self, state: QueueCoordinatorState | None = None) -> None:
+        if state is not None:
+            self.state = state
+            self.running = set(state.running)
+
+        while not self.should_continue_as_new():
+            await self.check_children()
+            await self.mark_finished()
+            claimed = 0
+            wanted = min(self.free, self.state.claim_batch)
+            if wanted:
+                inputs = await workflow.execute_activity(
+                    "claim_queued_jobs",
+                    wanted,
+                    task_queue=settings.PERSIST_TASK_QUEUE,
+                    result_type=list[CMGDJobInput],
+                    start_to_close_timeout=timedelta(minutes=1),
+                )
+                claimed = len(inputs)
+                self.running.update(input.queue_id for input in inputs)
+                self.state.started_total += claimed
+                await asyncio.gather(*[self.start_child(input) for input in inputs])
+            if claimed and claimed == wanted:
+                # the queue may hold more; claim again right away
+                continue
+            # wait for a child to finish or the limit to go up, or for new
+            # rows if the queue ran dry
+            free = self.free
+            timeout = None
+            if free:
+                timeout = timedelta(seconds=self.state.idle_seconds)
+            elif self.unwatched:
+                timeout = timedelta(seconds=1)
+                if self.next_child_check is not None:
+                    timeout = max(self.next_child_check - workflow.now(), timeout)
+            try:
+                await workflow.wait_condition(
+                    lambda: bool(self.state.finished) or self.free > free or self.should_continue_as_new(),
+                    timeout=timeout,
+                )
+            except asyncio.TimeoutError:
+                pass
+
+        await workflow.wait_condition(workflow.all_handlers_finished)
+        await self.mark_finished()
+        workflow.continue_as_new(self.snapshot())
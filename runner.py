@@ -2,8 +2,25 @@
 
 import asyncio
 import asyncpg
-from dataclasses import dataclass
+import os
 import logging
+import signal
+import time
+
+from cmgd_nextflow_worker.capacity import CapacityTracker
+from cmgd_nextflow_worker.command_runner import CommandRunner, LatencyHistogram
+from cmgd_nextflow_worker.config import settings
+from cmgd_nextflow_worker.external_db import completion_key, dispose_engine
+from cmgd_nextflow_worker.metrics import (
+    DEQUEUE_SECONDS,
+    DEQUEUED_JOBS,
+    RUNNER_STAGE_SECONDS,
+    start_metrics_server,
+)
+from cmgd_nextflow_worker.models import CommandResult
+from cmgd_nextflow_worker.queue_notify import COMPLETION_CHANNEL, QUEUE_CHANNEL, QueueListener, asyncpg_dsn
+from cmgd_nextflow_worker.reconcile import CMGD_QUEUE, reconcile_periodically
+from cmgd_nextflow_worker.sacct import job_comment
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s [%(name)s] %(levelname)s: %(message)s',
@@ -11,26 +28,13 @@ logging.basicConfig(level=logging.DEBUG,
 logger = logging.getLogger(__name__)
 
 
-@dataclass
-class CommandResult:
-    returncode: int | None
-    stdout: bytes
-    stderr: bytes
-    
+command_runner = CommandRunner()
 
-async def run_cmd(cmd: str) -> CommandResult:
-    proc = await asyncio.create_subprocess_shell(
-        cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
-    
-    stdout, stderr = await proc.communicate()
-    returncode = proc.returncode
-    
-    return CommandResult(returncode, stdout, stderr)
 
-async def sbatch_submit(cmd: str) -> int:
+async def run_cmd(cmd: str | list[str]) -> CommandResult:
+    return await command_runner.run(cmd)
+
+async def sbatch_submit(cmd: str | list[str]) -> int:
     result = await run_cmd(cmd)
     
     if result.returncode != 0:
@@ -42,72 +46,288 @@ async def sbatch_submit(cmd: str) -> int:
     except ValueError:
         raise Exception(f"Error parsing job id: {result.stdout}")
         
-async def get_running_or_pending_job_count():
-    """Use squeue to get the number of running or pending jobs"""
-    cmd = "squeue -u $USER | wc -l"
-    result = await run_cmd(cmd)
-    if result.returncode != 0:
-        raise Exception(f"Error getting job count: {result.stderr}")
-    
-    try:
-        job_count = int(result.stdout.decode('utf-8').strip())-1  # Subtract 1 for the header line
-        return job_count
-    except ValueError:
-        raise Exception(f"Error parsing job count: {result.stdout}")
+# claimed by a runner but not yet submitted to slurm
+CLAIMED = "CLAIMED"
+# claimed, but the sample is already in the completion index
+SKIPPED = "SKIPPED"
+# sbatch failed RUNNER_MAX_ATTEMPTS times
+FAILED = "FAILED"
 
-async def process_queue_item(pg_dsn):
-    """
-    Selects a queue item for processing, performs an action, and updates the queue.
+
+class QueueRunner:
+    """Drains cmgd_queue into Slurm
+
+    A dispatcher reserves free job slots from a `CapacityTracker` and
+    claims that many rows (QUEUED -> CLAIMED) in one statement on a shared
+    connection pool. `concurrency` submit workers run sbatch for the
+    claimed rows outside of any transaction and mark each PROCESSED with
+    its Slurm job id. When the queue is empty or the cluster is full the
+    dispatcher blocks on LISTEN/NOTIFY rather than sleeping.
+
+    On shutdown, workers get `shutdown_grace` seconds to finish the item
+    they are working on; rows that were claimed but whose sbatch never
+    started are put back to QUEUED. Claimed rows whose sample is already
+    in the completion index are marked SKIPPED instead of submitted.
+    A row whose sbatch fails goes back to QUEUED with an exponential
+    backoff (`not_before`) and is marked FAILED after RUNNER_MAX_ATTEMPTS,
+    so a bad row or an overloaded controller is not hit in a tight loop.
+
+    Claims are leases of `RUNNER_CLAIM_LEASE_SECONDS`. Rows a crashed
+    runner left CLAIMED or PROCESSED are settled by the reconciliation
+    pass (see reconcile.py) that every runner runs at startup and then
+    every RECONCILE_INTERVAL seconds. Per-stage latencies are kept in
+    `timings` and logged every `report_interval` seconds.
     """
-    try:
-        connection = await asyncpg.connect(dsn=pg_dsn)
-        async with connection.transaction():
+    def __init__(
+        self,
+        pg_dsn: str,
+        concurrency: int = settings.RUNNER_CONCURRENCY,
+        claim_batch: int = settings.RUNNER_CLAIM_BATCH,
+        shutdown_grace: float = settings.RUNNER_SHUTDOWN_GRACE,
+        report_interval: float = 60,
+        capacity: CapacityTracker | None = None,
+    ):
+        self.pg_dsn = asyncpg_dsn(pg_dsn)
+        self.concurrency = concurrency
+        self.claim_batch = claim_batch
+        self.shutdown_grace = shutdown_grace
+        self.report_interval = report_interval
+        self.capacity = capacity or CapacityTracker(run_cmd)
+        self.pool: asyncpg.Pool | None = None
+        # finished jobs free their slots as they are reported; the next
+        # squeue snapshot corrects any drift
+        self.listener = QueueListener(
+            pg_dsn, [QUEUE_CHANNEL, COMPLETION_CHANNEL], on_completed=self.capacity.completed,
+        )
+        self.stopping = asyncio.Event()
+        # claimed rows waiting for a submit worker
+        self.submit_queue: asyncio.Queue[asyncpg.Record] = asyncio.Queue(maxsize=concurrency)
+        # row id -> stage ("claimed" or "submitting") of rows held by this runner
+        self.claimed: dict[int, str] = {}
+        self.timings = {stage: LatencyHistogram() for stage in ("capacity", "claim", "submit", "mark")}
+
+    def observe(self, stage: str, start: float, failed: bool = False) -> None:
+        seconds = time.perf_counter() - start
+        self.timings[stage].observe(seconds, failed)
+        RUNNER_STAGE_SECONDS.labels(stage=stage).observe(seconds)
+
+    async def claim(self, n: int) -> list[asyncpg.Record]:
+        start = time.perf_counter()
+        rows = await self.pool.fetch(
+            f"""
+            UPDATE cmgd_queue SET status = '{CLAIMED}', _updated_at = now(),
+                lease_expires_at = now() + make_interval(secs => $2)
+            WHERE id IN (
+                SELECT id FROM cmgd_queue
+                WHERE status = 'QUEUED' AND (not_before IS NULL OR not_before <= now())
+                ORDER BY _created_at LIMIT $1 FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, sample_id, run_ids
+            """,
+            n, settings.RUNNER_CLAIM_LEASE_SECONDS,
+        )
+        for row in rows:
+            self.claimed[row["id"]] = "claimed"
+        self.observe("claim", start)
+        DEQUEUE_SECONDS.labels(queue="cmgd_queue").observe(time.perf_counter() - start)
+        DEQUEUED_JOBS.labels(queue="cmgd_queue").inc(len(rows))
+        return rows
+
+    async def skip_completed(self, rows: list[asyncpg.Record]) -> list[asyncpg.Record]:
+        """Mark claimed rows of completed samples SKIPPED; return the others"""
+        if not settings.SKIP_COMPLETED or not rows:
+            return rows
+        keys = [completion_key(row["sample_id"], row["run_ids"]) for row in rows]
+        try:
+            completed = await self.pool.fetch(
+                """
+                SELECT c.sample_id, c.run_ids FROM sample_completions c
+                JOIN unnest($1::text[], $2::text[]) AS k(sample_id, run_ids) USING (sample_id, run_ids)
+                WHERE c.pipeline_revision = $3
+                """,
+                [key[0] for key in keys], [key[1] for key in keys], settings.PIPELINE_REVISION,
+            )
+        except asyncpg.exceptions.PostgresError as e:
+            # e.g. `cmgd-db create_tables` has not been run; submit everything
+            logger.warning(f"Could not check the completion index: {e}")
+            return rows
+        done = {(row["sample_id"], row["run_ids"]) for row in completed}
+        skipped = [row["id"] for row, key in zip(rows, keys) if key in done]
+        if skipped:
+            await self.pool.execute(
+                f"UPDATE cmgd_queue SET status = '{SKIPPED}', _updated_at = now() WHERE id = ANY($1)",
+                skipped,
+            )
+            for row_id in skipped:
+                self.claimed.pop(row_id, None)
+            logger.info(f"Skipped {len(skipped)} already completed samples")
+        return [row for row, key in zip(rows, keys) if key not in done]
+
+    async def release(self, row_ids: list[int]) -> None:
+        """Put claimed rows back in the queue"""
+        await self.pool.execute(
+            f"UPDATE cmgd_queue SET status = 'QUEUED', _updated_at = now() WHERE id = ANY($1) AND status = '{CLAIMED}'",
+            row_ids,
+        )
+        for row_id in row_ids:
+            self.claimed.pop(row_id, None)
+
+    async def retry_later(self, row_id: int) -> str | None:
+        """Put a row whose sbatch failed back in the queue after a backoff
+
+        Returns the row's new status, FAILED once it ran out of attempts.
+        """
+        status = await self.pool.fetchval(
+            f"""
+            UPDATE cmgd_queue SET
+                attempts = attempts + 1,
+                status = CASE WHEN attempts + 1 >= $2 THEN '{FAILED}' ELSE 'QUEUED' END,
+                not_before = now() + make_interval(secs => least($3 * power(2, attempts), $4)),
+                _updated_at = now()
+            WHERE id = $1 AND status = '{CLAIMED}'
+            RETURNING status
+            """,
+            row_id, settings.RUNNER_MAX_ATTEMPTS, settings.RUNNER_RETRY_DELAY, settings.RUNNER_RETRY_MAX_DELAY,
+        )
+        self.claimed.pop(row_id, None)
+        return status
+
+    async def wait(self) -> None:
+        """Block until work is enqueued or a job finishes (or the fallback timeout)"""
+        await self.listener.wait(settings.QUEUE_WAIT_TIMEOUT)
+
+    async def dispatch(self) -> None:
+        while not self.stopping.is_set():
+            start = time.perf_counter()
+            n = await self.capacity.reserve(self.claim_batch)
+            if n == 0:
+                await self.wait()
+                continue
+            self.observe("capacity", start)
             try:
-                # Select a row for update, skipping locked rows
-                row = await connection.fetchrow(
-                    "SELECT sample_id, run_ids, status FROM cmgd_queue WHERE status = 'QUEUED' ORDER BY _created_at LIMIT 1 FOR UPDATE SKIP LOCKED"
-                )
-                if not row:
-                    print("No items in the queue.")
-                    return
-                print(f"Processing row: {row}")
-                sample_id = row["sample_id"]
-                run_ids = row["run_ids"]
-
-                # Do something with the data (replace with your actual logic)
-                cmd = f"sbatch --export=NONE submit_alpine.sh '{run_ids}' {sample_id}"
-                job_id = await sbatch_submit(cmd)
-
-                await connection.execute(
-                    "UPDATE cmgd_queue SET status = 'PROCESSED', _updated_at=now(), batch_id = $2 WHERE sample_id = $1", sample_id, job_id
-                )
-                logger.info(f"Processed sample_id {sample_id} with job_id {job_id}")
+                rows = await self.skip_completed(await self.claim(n))
+            except Exception as e:
+                logger.error(f"Error claiming queue rows: {e}")
+                rows = []
+            self.capacity.release(n - len(rows))
+            if not rows:
+                await self.wait()
+                continue
+            for row in rows:
+                await self.submit_queue.put(row)
+
+    async def process(self, row: asyncpg.Record) -> None:
+        """Submit one claimed queue row and mark it PROCESSED"""
+        row_id, sample_id, run_ids = row["id"], row["sample_id"], row["run_ids"]
+        logger.info(f"Processing row: {row}")
+
+        start = time.perf_counter()
+        self.claimed[row_id] = "submitting"
+        try:
+            cmd = [
+                "sbatch", "--export=NONE",
+                # lets reconciliation find the row if we die before marking it
+                f"--comment={job_comment(runs=len(run_ids.split(';')), cmgd_queue=row_id)}",
+                "submit_alpine.sh", run_ids, sample_id,
+            ]
+            job_id = await sbatch_submit(cmd)
+        except Exception as e:
+            self.observe("submit", start, failed=True)
+            logger.error(f"Error submitting sample_id {sample_id}: {e}")
+            self.capacity.release()
+            if await self.retry_later(row_id) == FAILED:
+                logger.error(f"Giving up on sample_id {sample_id} after {settings.RUNNER_MAX_ATTEMPTS} attempts")
+            return
+        self.capacity.submitted()
+        self.observe("submit", start)
+
+        start = time.perf_counter()
+        await self.pool.execute(
+            # reconciliation may already have settled the row from the job's comment
+            "UPDATE cmgd_queue SET status = 'PROCESSED', _updated_at = now(), batch_id = $2 WHERE id = $1 AND status = 'CLAIMED'",
+            row_id, job_id,
+        )
+        self.claimed.pop(row_id, None)
+        self.observe("mark", start)
+        logger.info(f"Processed sample_id {sample_id} with job_id {job_id}")
 
+    async def worker(self, n: int) -> None:
+        while True:
+            row = await self.submit_queue.get()
+            try:
+                await self.process(row)
             except Exception as e:
-                logger.error(f"Error processing queue item: {e}")
-    except asyncpg.exceptions.PostgresError as e:
-        logger.error(f"Error connecting to database: {e}")
-    except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-    finally:
-        await connection.close()
+                logger.error(f"Error in worker {n}: {e}")
+            finally:
+                self.submit_queue.task_done()
+
+    async def report(self) -> None:
+        while True:
+            await asyncio.sleep(self.report_interval)
+            self.log_timings()
+
+    def log_timings(self) -> None:
+        for stage, histogram in self.timings.items():
+            if histogram.count:
+                logger.info(
+                    f"{stage}: n={histogram.count} failed={histogram.failures} "
+                    f"mean={histogram.sum / histogram.count * 1000:.1f}ms"
+                )
+        logger.info(f"slurm jobs by state: {self.capacity.counts_by_state()}")
+
+    def stop(self) -> None:
+        logger.info("Shutting down runner")
+        self.stopping.set()
+        # wake the dispatcher if it is blocked on the listener
+        self.listener.wake()
+
+    async def run(self) -> None:
+        self.pool = await asyncpg.create_pool(
+            dsn=self.pg_dsn, min_size=1, max_size=self.concurrency + 2,
+        )
+        await self.listener.start()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+
+        dispatcher = asyncio.create_task(self.dispatch())
+        workers = [asyncio.create_task(self.worker(n)) for n in range(self.concurrency)]
+        reporter = asyncio.create_task(self.report())
+        background = [reporter]
+        if settings.RECONCILE_INTERVAL > 0:
+            background.append(asyncio.create_task(reconcile_periodically(CMGD_QUEUE, run_cmd)))
+        try:
+            await self.stopping.wait()
+            dispatcher.cancel()
+            await asyncio.gather(dispatcher, return_exceptions=True)
+            # rows still waiting for a worker are handed back below
+            while not self.submit_queue.empty():
+                self.submit_queue.get_nowait()
+                self.submit_queue.task_done()
+            try:
+                await asyncio.wait_for(self.submit_queue.join(), self.shutdown_grace)
+            except TimeoutError:
+                pass
+        finally:
+            for task in [*workers, *background]:
+                task.cancel()
+            await asyncio.gather(*workers, *background, return_exceptions=True)
+            unsubmitted = [row_id for row_id, stage in self.claimed.items() if stage == "claimed"]
+            if unsubmitted:
+                await self.release(unsubmitted)
+                logger.info(f"Released {len(unsubmitted)} claimed rows")
+            for row_id in self.claimed:
+                # sbatch may or may not have gone through; leave for reconciliation
+                logger.warning(f"Row {row_id} left in {CLAIMED} state during submission")
+            self.log_timings()
+            await self.listener.close()
+            await self.pool.close()
+            await dispose_engine()
                     
                     
 async def main(PG_DSN):
-    
-    while True:
-        # check the number of running or pending jobs
-        job_count = await get_running_or_pending_job_count()
-        if job_count >= 400:
-            await asyncio.sleep(60)
-            continue
-        for _ in range(400-job_count):
-            try:
-                # Replace with your actual DSN
-                await process_queue_item(PG_DSN)
-            except Exception as e:
-                print(f"Error in main loop: {e}")
-            await asyncio.sleep(5)
+    start_metrics_server()
+    await QueueRunner(PG_DSN).run()
 
 
 
@@ -117,7 +337,7 @@ async def create_database_table():
     """
     PG_DSN = os.getenv("POSTGRES_DSN")
     try:
-        connection = await asyncpg.connect(dsn=PG_DSN)
+        connection = await asyncpg.connect(dsn=asyncpg_dsn(PG_DSN))
         await connection.execute("""
             CREATE TABLE IF NOT EXISTS cmgd_queue (
                 id SERIAL PRIMARY KEY,
@@ -129,6 +349,28 @@ async def create_database_table():
                 batch_id INT
             )
         """)
+        # claims are leases; reconciliation finds submitted rows by batch_id
+        await connection.execute("""
+            ALTER TABLE cmgd_queue ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ;
+            -- failed submissions back off until not_before
+            ALTER TABLE cmgd_queue ADD COLUMN IF NOT EXISTS attempts INT NOT NULL DEFAULT 0;
+            ALTER TABLE cmgd_queue ADD COLUMN IF NOT EXISTS not_before TIMESTAMPTZ;
+            CREATE INDEX IF NOT EXISTS cmgd_queue_processed_batch_id
+                ON cmgd_queue (batch_id) WHERE status = 'PROCESSED';
+        """)
+        # wake queue consumers listening on QUEUE_CHANNEL on every insert
+        await connection.execute(f"""
+            CREATE OR REPLACE FUNCTION cmgd_queue_notify() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('{QUEUE_CHANNEL}', '');
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE OR REPLACE TRIGGER cmgd_queue_notify
+                AFTER INSERT ON cmgd_queue
+                FOR EACH STATEMENT EXECUTE FUNCTION cmgd_queue_notify();
+        """)
         logger.info("Table created successfully.")
     except asyncpg.exceptions.PostgresError as e:
         logger.error(f"Error creating table: {e}")
@@ -138,7 +380,6 @@ async def create_database_table():
 
 if __name__ == "__main__":
     # Load environment variables from .env file
-    import os
     from dotenv import load_dotenv
     load_dotenv()
     PG_DSN = os.getenv("POSTGRES_DSN")  # Assuming PG_DSN is defined as before
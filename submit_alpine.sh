@@ -5,9 +5,42 @@
 #SBATCH --output=/scratch/alpine/seda0001_amc/logs/slurm-%j.out
 
 # Usage:
-# sbatch submit_alpine.sh <run_ids(; separated)> <sample_id>
+# sbatch submit_alpine.sh <run_ids(; separated)> <sample_id> [<work_dir>]
+# sbatch --array=0-<n-1> submit_alpine.sh --manifest <manifest.tsv>
+#
+# A manifest has one "<run_ids>\t<sample_id>" line per array index.
+#
+# With a work_dir, nextflow runs there instead of in $SLURM_SCRATCH, which
+# is removed when the job ends, and resumes the session of an earlier
+# attempt if there is one.
 set -e
 
+if [ "$1" = "--manifest" ]; then
+    IFS=$'\t' read -r RUN_IDS SAMPLE_ID < <(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" "$2")
+    NOTIFY_ID=${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}
+else
+    RUN_IDS=$1
+    SAMPLE_ID=$2
+    WORK_DIR=$3
+    NOTIFY_ID=$SLURM_JOB_ID
+fi
+
+# Let the worker know we are done as soon as the script exits, whatever
+# the outcome. The file is written under a temporary name and renamed so
+# the worker never reads a partial file, and removes it once read. Same
+# default as SLURM_NOTIFY_DIR in config.py; set it empty to disable.
+NOTIFY_DIR=${CMGD_NOTIFY_DIR-/scratch/alpine/seda0001_amc/notify}
+# one nextflow trace file per job, ingested by the worker afterwards
+TRACE_DIR=${CMGD_TRACE_DIR:-/scratch/alpine/seda0001_amc/traces}
+notify_exit() {
+    rc=$?
+    [ -n "$NOTIFY_DIR" ] && mkdir -p "$NOTIFY_DIR" \
+        && echo "$rc" > "$NOTIFY_DIR/$NOTIFY_ID.tmp" \
+        && mv "$NOTIFY_DIR/$NOTIFY_ID.tmp" "$NOTIFY_DIR/$NOTIFY_ID"
+    exit $rc
+}
+trap notify_exit EXIT
+
 echo "working in $SLURM_SCRATCH"
 
 export GOOGLE_APPLICATION_CREDENTIALS=$HOME/curatedmetagenomicdata-232f4a306d1d.json
@@ -15,10 +48,22 @@ module load singularity
 module load git
 module load nextflow
 
-cd $SLURM_SCRATCH
+mkdir -p "$TRACE_DIR"
+RESUME=
+if [ -n "$WORK_DIR" ]; then
+    mkdir -p "$WORK_DIR"
+    cd "$WORK_DIR"
+    if [ -f .nextflow/history ]; then
+        echo "resuming the previous session in $WORK_DIR"
+        RESUME=-resume
+    fi
+else
+    cd $SLURM_SCRATCH
+fi
 #cd /scratch/alpine/seda0001_amc/jobs
 #mkdir $2
 #cd $2
 export NXF_MODE=google
 #nextflow run main.nf --run_ids=$1 --sample_id=$2 -profile alpine
-nextflow run seandavi/curatedMetagenomicsNextflow --run_ids=$1 --sample_id=$2 -profile alpine
+nextflow run seandavi/curatedMetagenomicsNextflow --run_ids=$RUN_IDS --sample_id=$SAMPLE_ID -profile alpine $RESUME \
+    -with-trace "$TRACE_DIR/$NOTIFY_ID.txt"
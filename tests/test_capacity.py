@@ -0,0 +1,52 @@
+import asyncio
+from cmgd_nextflow_worker.capacity import CapacityTracker
+from cmgd_nextflow_worker.models import CommandResult
+
+SQUEUE_OUTPUT = b"""RUNNING|amilan
+RUNNING|amilan
+PENDING|amilan
+PENDING|amem
+COMPLETING|amilan
+squeue: error: some warning that ended up on stdout
+"""
+
+
+def test_reserve_and_optimistic_updates():
+    calls = []
+
+    async def fake_run_cmd(cmd: list[str]) -> CommandResult:
+        calls.append(cmd)
+        return CommandResult(0, SQUEUE_OUTPUT, b'')
+
+    async def main():
+        tracker = CapacityTracker(fake_run_cmd, limit=10, interval=3600, user='me')
+        assert await tracker.reserve(4) == 4
+        assert tracker.counts_by_state() == {'RUNNING': 2, 'PENDING': 2}
+        # 4 active + 4 reserved leaves 2 of 10
+        assert await tracker.reserve(5) == 2
+        tracker.submitted(3)
+        tracker.release(3)
+        assert tracker.active == 7
+        tracker.completed(2)
+        assert await tracker.reserve(10) == 5
+        return tracker
+
+    asyncio.run(main())
+    # all reservations were served from a single squeue snapshot
+    assert len(calls) == 1
+
+
+def test_failed_refresh_backs_off():
+    calls = []
+
+    async def failing_run_cmd(cmd: list[str]) -> CommandResult:
+        calls.append(cmd)
+        return CommandResult(1, b'', b'slurm_load_jobs error')
+
+    async def main():
+        tracker = CapacityTracker(failing_run_cmd, limit=10, interval=3600, user='me')
+        assert await tracker.reserve(4) == 0
+        assert await tracker.reserve(4) == 0
+
+    asyncio.run(main())
+    assert len(calls) == 1
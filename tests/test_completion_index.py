@@ -0,0 +1,13 @@
+from cmgd_nextflow_worker.external_db import _metadata_key, completion_key
+
+
+def test_completion_key_ignores_run_order():
+    assert completion_key("S1", ["SRR2", "SRR1"]) == ("S1", "SRR1;SRR2")
+    # cmgd_queue keeps run ids as one ';' separated string
+    assert completion_key("S1", "SRR2;SRR1") == completion_key("S1", ["SRR1", "SRR2"])
+
+
+def test_metadata_key_of_queue_rows():
+    assert _metadata_key({'sample_id': "S1", 'run_ids': ["SRR2", "SRR1"]}) == ("S1", "SRR1;SRR2")
+    assert _metadata_key({'sample_id': "S1"}) is None
+    assert _metadata_key(None) is None
@@ -0,0 +1,49 @@
+import asyncio
+import sys
+
+import pytest
+
+from cmgd_nextflow_worker import metrics
+from cmgd_nextflow_worker.command_runner import CommandRunner
+
+
+def test_noop_metrics_accept_every_call():
+    metric = metrics._NoopMetric()
+    metric.labels(command="sacct").observe(1.0)
+    metric.labels("x").inc()
+    metric.set(3)
+    with metrics.timed(metric):
+        pass
+
+
+@pytest.mark.skipif(metrics.prometheus_client is None, reason="prometheus_client not installed")
+def test_command_latency_and_failures_are_exported():
+    registry = metrics.prometheus_client.REGISTRY
+    name = {'command': sys.executable.rsplit('/', 1)[-1]}
+
+    def sample(metric: str) -> float:
+        return registry.get_sample_value(metric, name) or 0
+
+    count = sample('cmgd_command_seconds_count')
+    failures = sample('cmgd_command_failures_total')
+    runner = CommandRunner()
+    asyncio.run(runner.run([sys.executable, '-c', 'pass']))
+    asyncio.run(runner.run([sys.executable, '-c', 'raise SystemExit(3)']))
+    assert sample('cmgd_command_seconds_count') == count + 2
+    assert sample('cmgd_command_failures_total') == failures + 1
+
+
+@pytest.mark.skipif(metrics.prometheus_client is None, reason="prometheus_client not installed")
+def test_slurm_times_skip_missing_timestamps():
+    registry = metrics.prometheus_client.REGISTRY
+
+    def waits() -> float:
+        return registry.get_sample_value('cmgd_slurm_wait_seconds_count') or 0
+
+    before = waits()
+    # unset sacct times are 0 and must not be recorded as huge waits
+    metrics.observe_slurm_times("CANCELLED by 1", 100, 0, 0)
+    assert waits() == before
+    metrics.observe_slurm_times("COMPLETED", 100, 160, 400)
+    assert waits() == before + 1
+    assert registry.get_sample_value('cmgd_slurm_run_seconds_sum', {'state': 'COMPLETED'}) >= 240
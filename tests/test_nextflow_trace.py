@@ -0,0 +1,47 @@
+from datetime import datetime, timezone
+
+from cmgd_nextflow_worker import nextflow_trace as nt
+
+HEADER = "task_id\thash\tnative_id\tname\tstatus\texit\tsubmit\tduration\trealtime\t%cpu\tpeak_rss\tpeak_vmem\trchar\twchar\n"
+TRACE = HEADER + (
+    "1\t4e/8b1a2c\t12345\tFASTERQ_DUMP (SRR1)\tCOMPLETED\t0\t2025-03-23 10:00:00.000\t1h 2m 3s\t1h 1m\t195.5%\t1.5 GB\t3 GB\t10 GB\t20 GB\n"
+    "2\t7a/00ff00\t12346\tKNEADDATA (S1)\tFAILED\t137\t2025-03-23 11:00:00.000\t10m\t9m 30s\t800.0%\t30 GB\t32 GB\t5 MB\t-\n"
+    "3\t7a/00ff01\t12347\tKNEADDATA (S1)\tCOMPLETED\t0\t2025-03-23 11:20:00.000\t2h\t1h 59m 59.5s\t790.0%\t28.5 GB\t31 GB\t50 GB\t40 GB\n"
+)
+
+
+def test_parse_values():
+    assert nt.parse_duration("1h 2m 3s") == 3_723_000
+    assert nt.parse_duration("350ms") == 350
+    assert nt.parse_duration("1d 1.5s") == 86_401_500
+    assert nt.parse_duration("3723000") == 3_723_000  # trace.raw
+    assert nt.parse_duration("-") is None
+    assert nt.parse_memory("1.5 GB") == 1.5 * 1024**3
+    assert nt.parse_memory("512 KB") == 512 * 1024
+    assert nt.parse_memory("1610612736") == 1610612736  # trace.raw
+    assert nt.parse_memory("0") == 0
+    assert nt.parse_memory("-") is None
+    assert nt.parse_percent("195.5%") == 195.5
+    assert nt.parse_timestamp("1742724000000") == datetime(2025, 3, 23, 10, tzinfo=timezone.utc)
+
+
+def test_read_trace_and_summary(tmp_path):
+    path = tmp_path / "12448075.txt"
+    path.write_text(TRACE)
+    rows = list(nt.read_trace(str(path), 12448075, "S1"))
+    assert [row['process'] for row in rows] == ["FASTERQ_DUMP", "KNEADDATA", "KNEADDATA"]
+    assert rows[0]['task_id'] == 1
+    assert rows[0]['realtime_ms'] == 3_660_000
+    assert rows[1]['exit'] == 137
+    assert rows[1]['write_bytes'] is None
+
+    summary = nt.TraceSummary()
+    for row in rows:
+        summary.add(row)
+    result = summary.to_dict()
+    assert result['tasks'] == 3
+    kneaddata = result['processes']['KNEADDATA']
+    assert kneaddata['tasks'] == 2
+    assert kneaddata['failed'] == 1
+    assert kneaddata['max_peak_rss_bytes'] == 30 * 1024**3
+    assert kneaddata['realtime_seconds'] == 570 + 7199.5
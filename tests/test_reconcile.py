@@ -0,0 +1,53 @@
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+
+from cmgd_nextflow_worker.models import CommandResult
+from cmgd_nextflow_worker.reconcile import CMGD_QUEUE, JOB_QUEUE, job_arrays, outcome, sacct_window
+from cmgd_nextflow_worker.sacct import SacctJobSummary, job_comment
+
+
+def summary(job_id: int, state: str, comment: str) -> SacctJobSummary:
+    return SacctJobSummary(job_id, state, None, 0, 0, 0, 0, comment=comment)
+
+
+def test_outcome():
+    assert outcome("COMPLETED") == "COMPLETED"
+    assert outcome("OUT_OF_MEMORY") == "FAILED"
+    assert outcome("CANCELLED by 1234") == "FAILED"
+    assert outcome("RUNNING") == "ACTIVE"
+    assert outcome("PENDING") == "ACTIVE"
+
+
+def test_job_arrays_match_jobs_to_their_queue():
+    jobs = [
+        summary(1, "COMPLETED", job_comment(runs=1, queue=10)),
+        summary(2, "RUNNING", job_comment(runs=1, cmgd_queue=20)),
+        # submitted before jobs carried a queue reference
+        summary(3, "FAILED", ""),
+    ]
+    assert job_arrays(JOB_QUEUE, jobs) == {
+        'queue_ids': [10], 'job_ids': [1], 'outcomes': ["COMPLETED"],
+    }
+    # cmgd_queue rows are also matched by batch_id, so every job is passed
+    assert job_arrays(CMGD_QUEUE, jobs) == {
+        'queue_ids': [None, 20, None], 'job_ids': [1, 2, 3], 'outcomes': ["COMPLETED", "ACTIVE", "FAILED"],
+    }
+
+
+def test_sacct_window_is_split_into_slices():
+    calls = []
+
+    async def fake_run_cmd(cmd: list[str]) -> CommandResult:
+        calls.append(cmd)
+        # a job running through the whole window shows up in every slice
+        jobs = [{'job_id': 1, 'state': {'current': 'RUNNING'}}, {'job_id': 100 + len(calls), 'state': {'current': 'COMPLETED'}}]
+        return CommandResult(0, json.dumps({'jobs': jobs}).encode(), b'')
+
+    until = datetime(2025, 3, 23, 12, tzinfo=timezone.utc)
+    jobs = asyncio.run(sacct_window(fake_run_cmd, until - timedelta(hours=10), until, timedelta(hours=4)))
+    assert sorted(job.job_id for job in jobs) == [1, 101, 102, 103]
+    assert [cmd.count("--starttime") for cmd in calls] == [1, 1, 1]
+    # the last slice is open ended
+    assert ["--endtime" in cmd for cmd in calls] == [True, True, False]
+    assert calls[0][calls[0].index("--endtime") + 1] == calls[1][calls[1].index("--starttime") + 1]
@@ -0,0 +1,141 @@
+import asyncio
+import copy
+import json
+import os
+
+from sqlalchemy.dialects import postgresql
+
+from cmgd_nextflow_worker.external_db import SlurmBatchJobResult
+from cmgd_nextflow_worker.queue_notify import COMPLETION_CHANNEL
+from cmgd_nextflow_worker.result_writer import SacctResultWriter, hash_script, load_sacct_result, result_row
+
+EXAMPLE = os.path.join(os.path.dirname(__file__), '..', 'sacct-out-example.json')
+
+
+def test_result_row_typed_columns():
+    with open(EXAMPLE) as f:
+        result_dict = json.load(f)
+    result_dict['jobs'][0]['script'] = "#!/bin/bash\necho hello\n"
+    result_dict['jobs'][0]['comment']['job'] = "cmgd:runs=3"
+
+    row, script = result_row(result_dict)
+    assert row['job_id'] == 12448075
+    assert row['state'] == 'COMPLETED'
+    assert row['exit_code'] == 0
+    assert row['elapsed_seconds'] == 105
+    assert row['req_cpus'] == 1
+    assert row['req_mem_mb'] == 128
+    assert row['max_rss_bytes'] == 405504
+    assert row['run_count'] == 3
+    assert row['start_time'].timestamp() == 1742739450
+    assert script == "#!/bin/bash\necho hello\n"
+    assert row['script_hash'] == hash_script(script)
+
+    stored = load_sacct_result(SlurmBatchJobResult(**row))
+    assert 'script' not in stored['jobs'][0]
+    assert stored['jobs'][0]['steps'] == result_dict['jobs'][0]['steps']
+    assert len(row['sacct_compressed']) < len(json.dumps(result_dict)) / 5
+
+
+def example(job_id: int) -> dict:
+    with open(EXAMPLE) as f:
+        result_dict = json.load(f)
+    result_dict['jobs'][0]['job_id'] = job_id
+    return result_dict
+
+
+class FakeConnection:
+    def __init__(self, engine: "FakeEngine"):
+        self.engine = engine
+
+    async def execute(self, stmt, params=None):
+        self.engine.transactions[-1].append(stmt)
+
+
+class FakeEngine:
+    """Records the statements of each transaction; fails the first `failures`"""
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.transactions: list[list] = []
+
+    def begin(self):
+        engine = self
+
+        class Transaction:
+            async def __aenter__(self):
+                if engine.failures:
+                    engine.failures -= 1
+                    raise ConnectionError("database is down")
+                engine.transactions.append([])
+                return FakeConnection(engine)
+
+            async def __aexit__(self, *exc):
+                return False
+
+        return Transaction()
+
+
+def compiled(stmt) -> str:
+    return str(stmt.compile(dialect=postgresql.dialect()))
+
+
+def upserted_job_ids(transaction: list) -> list[int]:
+    upsert = next(stmt for stmt in transaction if "slurm_batch_job_results" in compiled(stmt))
+    # a multi-row VALUES binds job_id_m0, job_id_m1, ...
+    params = upsert.compile(dialect=postgresql.dialect()).params
+    return [value for key, value in params.items() if key.startswith('job_id')]
+
+
+def test_writer_batches_concurrent_writes():
+    engine = FakeEngine()
+
+    async def main():
+        writer = SacctResultWriter(engine, max_batch=3, max_delay=60)
+        # a full batch is written without waiting for max_delay
+        await asyncio.wait_for(asyncio.gather(*[writer.write(example(i)) for i in (1, 2, 3)]), 5)
+        # a lone write goes out after max_delay
+        writer.max_delay = 0.01
+        await asyncio.wait_for(writer.write(example(4)), 5)
+
+    asyncio.run(main())
+    assert [sorted(upserted_job_ids(t)) for t in engine.transactions] == [[1, 2, 3], [4]]
+
+
+def test_writer_upsert_keeps_summary_and_notifies():
+    engine = FakeEngine()
+
+    async def main():
+        writer = SacctResultWriter(engine, max_batch=2, max_delay=60)
+        script_job = example(5)
+        script_job['jobs'][0]['script'] = "#!/bin/bash\n"
+        # the same job twice in one batch is upserted once
+        await asyncio.wait_for(asyncio.gather(
+            writer.write(script_job, {'tasks': 1}), writer.write(copy.deepcopy(script_job)),
+        ), 5)
+
+    asyncio.run(main())
+    [transaction] = engine.transactions
+    scripts, upsert, notify = [compiled(stmt) for stmt in transaction]
+    assert scripts.startswith("INSERT INTO slurm_batch_scripts")
+    assert "ON CONFLICT (job_id) DO UPDATE" in upsert
+    assert "coalesce(excluded.nextflow_summary, slurm_batch_job_results.nextflow_summary)" in upsert
+    assert upserted_job_ids(transaction) == [5]
+    assert "pg_notify" in notify
+    assert COMPLETION_CHANNEL in transaction[2].compile().params.values()
+
+
+def test_failed_flush_fails_its_waiters_only():
+    engine = FakeEngine(failures=1)
+
+    async def main():
+        writer = SacctResultWriter(engine, max_batch=2, max_delay=60)
+        results = await asyncio.wait_for(asyncio.gather(
+            writer.write(example(6)), writer.write(example(7)), return_exceptions=True,
+        ), 5)
+        # the storage activity retries; the writer keeps working
+        await asyncio.wait_for(asyncio.gather(writer.write(example(6)), writer.write(example(7))), 5)
+        return results
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ConnectionError) for result in results)
+    assert [sorted(upserted_job_ids(t)) for t in engine.transactions] == [[6, 7]]
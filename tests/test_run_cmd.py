@@ -1,6 +1,8 @@
+import os
 import pytest
 import asyncio
 from cmgd_nextflow_worker.activities import ActivityContainer
+from cmgd_nextflow_worker.command_runner import CommandRunner
 
 from cmgd_nextflow_worker.models import CommandResult
 
@@ -13,4 +15,57 @@ def test_run_cmd():
     assert result.returncode == 0
     assert result.stdout == b'hello world\n'
     assert result.stderr == b''
-    
\ No newline at end of file
+    
+def test_run_cmd_argv_is_not_shell_expanded():
+    result = asyncio.run(activities.run_cmd(["echo", "$HOME", "a|b"]))
+    assert result.returncode == 0
+    assert result.stdout == b'$HOME a|b\n'
+
+def test_run_cmd_missing_executable():
+    result = asyncio.run(activities.run_cmd(["does-not-exist-cmgd"]))
+    assert result.returncode == 127
+
+def test_run_cmd_timeout():
+    runner = CommandRunner(timeout=0.1)
+    with pytest.raises(TimeoutError):
+        asyncio.run(runner.run(["sleep", "5"]))
+    assert runner.histograms['sleep'].failures == 1
+
+def test_run_cmd_output_limit():
+    runner = CommandRunner(max_output_bytes=10)
+    result = asyncio.run(runner.run(["head", "-c", "100000", "/dev/zero"]))
+    assert result.returncode == 0
+    assert len(result.stdout) == 10
+    assert runner.histograms['head'].count == 1
+
+def child_pids(cmdline: bytes) -> set[str]:
+    pids = set()
+    for pid in os.listdir("/proc"):
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                if f.read() == cmdline:
+                    pids.add(pid)
+        except OSError:
+            continue
+    return pids
+
+@pytest.mark.skipif(not os.path.isdir("/proc"), reason="needs /proc")
+def test_run_cmd_cancel_kills_child():
+    runner = CommandRunner()
+    cmd = ["sleep", "31.4159"]
+    before = child_pids(b"sleep\x0031.4159\x00")
+
+    async def main():
+        task = asyncio.create_task(runner.run(cmd))
+        # cancel only once the child has exec'd; the runner records the
+        # call whether or not the spawn itself has returned yet
+        while not (pids := child_pids(b"sleep\x0031.4159\x00") - before):
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return pids
+
+    pids = asyncio.run(main())
+    assert not any(os.path.exists(f"/proc/{pid}") for pid in pids)
+    assert runner.histograms['sleep'].failures == 1
@@ -0,0 +1,87 @@
+import copy
+import json
+import os
+import pytest
+from cmgd_nextflow_worker import sacct
+
+EXAMPLE = os.path.join(os.path.dirname(__file__), '..', 'sacct-out-example.json')
+
+
+@pytest.fixture(params=['msgspec', 'json'])
+def backend(request, monkeypatch):
+    if request.param == 'json':
+        monkeypatch.setattr(sacct, 'msgspec', None)
+    elif sacct.msgspec is None:
+        pytest.skip("msgspec is not installed")
+    return request.param
+
+
+def test_parse_sacct_summaries(backend):
+    with open(EXAMPLE, 'rb') as f:
+        data = f.read()
+    [summary] = sacct.parse_sacct_summaries(data)
+    assert summary.job_id == 12448075
+    assert summary.state == 'COMPLETED'
+    assert summary.exit_code == 0
+    assert summary.elapsed == 105
+    assert summary.start == 1742739450
+    assert summary.keys == ['12448075']
+
+
+def test_parse_sacct_summaries_newer_slurm_format(backend):
+    with open(EXAMPLE) as f:
+        doc = json.load(f)
+    job = copy.deepcopy(doc['jobs'][0])
+    # slurm >= 23.11 reports state as a list and wraps numbers
+    job['state']['current'] = ['OUT_OF_MEMORY']
+    job['exit_code']['return_code'] = {'set': True, 'infinite': False, 'number': 137}
+    job['array']['job_id'] = 500
+    job['array']['task_id'] = {'set': True, 'infinite': False, 'number': 3}
+    [summary] = sacct.parse_sacct_summaries(json.dumps({'jobs': [job]}))
+    assert summary.state == 'OUT_OF_MEMORY'
+    assert summary.exit_code == 137
+    assert sacct.get_summary_states([summary]) == {
+        '12448075': 'OUT_OF_MEMORY',
+        '500_3': 'OUT_OF_MEMORY',
+    }
+    assert sacct.is_terminal_state(summary.state)
+
+
+def test_job_comment_round_trip(backend):
+    comment = sacct.job_comment(runs=2, queue=17, cmgd_queue=None)
+    assert comment == "cmgd:runs=2,queue=17"
+    assert sacct.parse_job_comment(comment) == {'runs': 2, 'queue': 17}
+    assert sacct.parse_job_comment("someone else's comment") == {}
+    with open(EXAMPLE) as f:
+        doc = json.load(f)
+    [summary] = sacct.parse_sacct_summaries(json.dumps(doc))
+    assert summary.comment == ""
+    doc['jobs'][0]['comment']['job'] = comment
+    [summary] = sacct.parse_sacct_summaries(json.dumps(doc))
+    assert summary.comment == comment
+
+
+def test_parse_sacct_jobs_decodes_selected_records(backend):
+    with open(EXAMPLE) as f:
+        document = json.load(f)
+    job = document['jobs'][0]
+    other = copy.deepcopy(job)
+    other['job_id'] = 1
+    data = json.dumps(dict(document, jobs=[other, job])).encode('utf-8')
+    assert sacct.parse_sacct_jobs(data, [1]) == [job]
+
+
+def test_is_final_job():
+    with open(EXAMPLE) as f:
+        job = json.load(f)['jobs'][0]
+    assert sacct.is_final_job(job)
+    # step records still arriving
+    running_step = copy.deepcopy(job)
+    running_step['steps'][0]['state'] = 'RUNNING'
+    assert not sacct.is_final_job(running_step)
+    no_steps = dict(job, steps=[])
+    assert not sacct.is_final_job(no_steps)
+    # cancelled before it ever started
+    never_started = dict(job, steps=[], time=dict(job['time'], start=0))
+    assert sacct.is_final_job(never_started)
+    assert not sacct.is_final_job(dict(job, state={'current': 'RUNNING'}))
@@ -0,0 +1,118 @@
+import asyncio
+import json
+from cmgd_nextflow_worker.models import CommandResult
+from cmgd_nextflow_worker.sacct_poller import SacctPoller
+
+
+def make_sacct_output(states: dict[str, str]) -> bytes:
+    jobs = [
+        {'job_id': int(job_id), 'state': {'current': state}}
+        for job_id, state in states.items()
+    ]
+    return json.dumps({'jobs': jobs}).encode('utf-8')
+
+
+def test_poller_batches_jobs_into_chunks():
+    calls = []
+    known = {'1': 'RUNNING', '2': 'COMPLETED', '3': 'FAILED'}
+
+    async def fake_run_cmd(cmd: list[str]) -> CommandResult:
+        calls.append(' '.join(cmd))
+        job_ids = cmd[2].split(',')
+        output = make_sacct_output({j: known[j] for j in job_ids if j in known})
+        return CommandResult(0, output, b'')
+
+    async def main():
+        poller = SacctPoller(fake_run_cmd, min_interval=0.01, chunk_size=2, notify_dir='')
+        return await asyncio.gather(*[poller.next_state(j) for j in [1, 2, 3, 4]])
+
+    states = asyncio.run(main())
+    assert states == ['RUNNING', 'COMPLETED', 'FAILED', 'PENDING']
+    assert calls == ['sacct -j 1,2 --json', 'sacct -j 3,4 --json']
+
+
+def test_notify_polls_watched_job_immediately():
+    calls = []
+
+    async def fake_run_cmd(cmd: list[str]) -> CommandResult:
+        calls.append(' '.join(cmd))
+        return CommandResult(0, make_sacct_output({'7': 'TIMEOUT'}), b'')
+
+    async def main():
+        poller = SacctPoller(fake_run_cmd, min_interval=3600, notify_dir='')
+        waiting = asyncio.create_task(poller.next_state(7))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        assert poller.notify(7)
+        assert not poller.notify(8)
+        return await asyncio.wait_for(waiting, 5)
+
+    assert asyncio.run(main()) == 'TIMEOUT'
+    assert calls == ['sacct -j 7 --json']
+
+
+def test_immediate_check_skips_backoff():
+    calls = []
+
+    async def fake_run_cmd(cmd: list[str]) -> CommandResult:
+        calls.append(' '.join(cmd))
+        return CommandResult(0, make_sacct_output({'9': 'RUNNING'}), b'')
+
+    async def main():
+        poller = SacctPoller(fake_run_cmd, min_interval=3600, notify_dir='')
+        first = await asyncio.wait_for(poller.next_state(9, immediate=True), 5)
+        # the job is now scheduled an hour out, but a check polls it again
+        second = await asyncio.wait_for(poller.next_state(9, immediate=True), 5)
+        return first, second
+
+    assert asyncio.run(main()) == ('RUNNING', 'RUNNING')
+    assert calls == ['sacct -j 9 --json', 'sacct -j 9 --json']
+
+
+def test_poller_caches_records_of_finished_jobs():
+    from cmgd_nextflow_worker.sacct_cache import SacctDocumentCache
+
+    async def fake_run_cmd(cmd: list[str]) -> CommandResult:
+        return CommandResult(0, make_sacct_output({'1': 'RUNNING', '2': 'COMPLETED'}), b'')
+
+    async def main():
+        cache = SacctDocumentCache(max_size=10, ttl=60)
+        poller = SacctPoller(fake_run_cmd, min_interval=0.01, notify_dir='', cache=cache)
+        await asyncio.gather(poller.next_state(1), poller.next_state(2))
+        return cache
+
+    cache = asyncio.run(main())
+    assert cache.pop(1) is None
+    assert cache.pop(2) == {'jobs': [{'job_id': 2, 'state': {'current': 'COMPLETED'}}]}
+    # consumed by the first reader
+    assert cache.pop(2) is None
+
+
+def test_waiter_registered_during_poll_of_finished_job():
+    calls = []
+    release = None
+
+    async def fake_run_cmd(cmd: list[str]) -> CommandResult:
+        calls.append(' '.join(cmd))
+        await release.wait()
+        return CommandResult(0, make_sacct_output({'7': 'COMPLETED'}), b'')
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        poller = SacctPoller(fake_run_cmd, min_interval=0.01, notify_dir='')
+        first = asyncio.create_task(poller.next_state(7))
+        while not calls:
+            await asyncio.sleep(0.01)
+        # sacct is still running when the second waiter arrives
+        second = asyncio.create_task(poller.next_state(7))
+        await asyncio.sleep(0.01)
+        release.set()
+        states = await asyncio.wait_for(asyncio.gather(first, second), 5)
+        # the poller survives and serves later waiters
+        third = await asyncio.wait_for(poller.next_state(7), 5)
+        assert not poller._task.done()
+        return states, third
+
+    assert asyncio.run(main()) == (['COMPLETED', 'COMPLETED'], 'COMPLETED')
+    assert calls == ['sacct -j 7 --json', 'sacct -j 7 --json']
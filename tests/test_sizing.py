@@ -0,0 +1,114 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from cmgd_nextflow_worker.config import settings
+from cmgd_nextflow_worker.external_db import Base, SlurmBatchJobResult
+from cmgd_nextflow_worker.models import ResourceRequest
+from cmgd_nextflow_worker.sacct import job_comment
+from cmgd_nextflow_worker.sizing import MIB, SizingModel, parse_run_count
+
+
+def test_run_count_comment_round_trip():
+    assert parse_run_count(job_comment(runs=4)) == 4
+    assert parse_run_count(job_comment(runs=4, queue=17)) == 4
+    assert parse_run_count("cmgd:runs=4") == 4
+    assert parse_run_count("") is None
+    assert parse_run_count(None) is None
+    assert parse_run_count("cmgd:runs=x") is None
+    assert parse_run_count("something else") is None
+
+
+def test_predict_applies_margins_and_bounds():
+    model = SizingModel(min_samples=2, max_run_bucket=4)
+    model.buckets = {
+        1: (10, 16 * 1024 * MIB, 6.0, 2 * 3600),
+        # far beyond the bounds
+        2: (10, 1024 * 1024 * MIB, 100.0, 100 * 3600),
+    }
+    assert model.predict(1) == ResourceRequest(
+        mem_mb=int(16 * 1024 * settings.SIZING_MEM_MARGIN),
+        cpus=8,
+        time_minutes=int(120 * settings.SIZING_TIME_MARGIN),
+    )
+    assert model.predict(2) == ResourceRequest(
+        mem_mb=settings.SIZING_MAX_MEM_MB,
+        cpus=settings.SIZING_MAX_CPUS,
+        time_minutes=settings.SIZING_MAX_MINUTES,
+    )
+
+
+def test_predict_borrows_from_larger_run_counts():
+    model = SizingModel(min_samples=5, max_run_bucket=4)
+    model.buckets = {
+        1: (3, 16 * 1024 * MIB, 6.0, 3600),  # too few jobs
+        3: (20, 32 * 1024 * MIB, 6.0, 3600),
+    }
+    assert model.predict(1).mem_mb == int(32 * 1024 * settings.SIZING_MEM_MARGIN)
+    # run counts above the last bucket share it
+    assert model.predict(4) is None
+    assert model.predict(12) is None
+    model.buckets[4] = (20, 32 * 1024 * MIB, 6.0, 3600)
+    assert model.predict(12) == model.predict(4)
+
+
+def test_sbatch_args():
+    assert ResourceRequest(mem_mb=20480, cpus=8, time_minutes=180).sbatch_args() == [
+        "--mem=20480M", "--cpus-per-task=8", "--time=180",
+    ]
+
+
+def test_fit_takes_undersized_jobs_as_lower_bounds():
+    # a run count of its own, so rows of other jobs do not enter the fit
+    runs = 99_999
+    now = datetime.now(timezone.utc)
+
+    def job(job_id: int, state: str, rss_gib: float | None, elapsed: int) -> dict:
+        return dict(
+            job_id=job_id, state=state, run_count=runs, end_time=now, req_mem_mb=20 * 1024,
+            max_rss_bytes=None if rss_gib is None else int(rss_gib * 1024 * MIB),
+            time_limit_minutes=600, elapsed_seconds=elapsed, cpu_seconds=elapsed * 4.0,
+        )
+
+    rows = (
+        [job(2_000_000_000 + i, "COMPLETED", 10, 3600) for i in range(5)]
+        # ran out of memory above 20 GiB before the usage was recorded
+        + [job(2_000_000_010 + i, "OUT_OF_MEMORY", None, 3600) for i in range(5)]
+        + [job(2_000_000_020, "TIMEOUT", 8, 1800)]
+    )
+
+    async def main():
+        engine = create_async_engine(settings.POSTGRES_DSN)
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+        except (OSError, sa.exc.DBAPIError) as e:
+            await engine.dispose()
+            pytest.skip(f"Postgres unavailable: {e}")
+        R = SlurmBatchJobResult
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(sa.delete(R).where(R.run_count == runs))
+                await conn.execute(sa.insert(R), rows)
+            buckets = []
+            for quantile in (0.75, 1.0):
+                model = SizingModel(quantile=quantile, min_samples=5, max_run_bucket=runs)
+                await model.fit(engine)
+                buckets.append(model.buckets[runs])
+            return buckets
+        finally:
+            async with engine.begin() as conn:
+                await conn.execute(sa.delete(R).where(R.run_count == runs))
+            await engine.dispose()
+
+    (n, mem_bytes, cpus, elapsed), (_, _, _, max_elapsed) = asyncio.run(main())
+    assert n == 11
+    # the COMPLETED jobs alone would give 10 GiB
+    assert mem_bytes == 20 * 1024 * MIB
+    assert cpus == 4.0
+    assert elapsed == 3600
+    # the TIMEOUT job counts with its 10 h limit
+    assert max_elapsed == 600 * 60
@@ -0,0 +1,26 @@
+import asyncio
+
+import pytest
+from temporalio.testing import WorkflowEnvironment
+
+from cmgd_nextflow_worker.coordinator.load_test import run_load_test
+
+
+def test_load_test_settles_when_jobs_complete_while_waiting():
+    async def main():
+        try:
+            env = await WorkflowEnvironment.start_local()
+        except RuntimeError as e:
+            pytest.skip(f"Temporal dev server unavailable: {e}")
+        async with env:
+            # a small limit makes most jobs complete before they are admitted,
+            # and a small history limit forces several continue_as_new runs
+            return await asyncio.wait_for(
+                run_load_test(env.client, jobs=200, concurrency=20, limit=2, history_limit=200),
+                120,
+            )
+
+    state, runs, _ = asyncio.run(main())
+    assert state.completed_total + state.dropped_total == 200
+    assert state.admitted_total == state.completed_total
+    assert runs > 1
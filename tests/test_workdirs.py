@@ -0,0 +1,65 @@
+import os
+import time
+from datetime import timedelta
+
+from cmgd_nextflow_worker import workdirs
+
+DAY = 24 * 3600
+
+
+def make_dir(root, name: str, age: float, size: int = 0, completed: bool = False) -> str:
+    path = os.path.join(root, name)
+    os.makedirs(os.path.join(path, "work"))
+    with open(os.path.join(path, "work", "data"), "wb") as f:
+        f.write(b"x" * size)
+    if completed:
+        workdirs.finish(path, retention=timedelta(hours=1))
+    touched = time.time() - age
+    for name in os.listdir(path):
+        os.utime(os.path.join(path, name), (touched, touched))
+    os.utime(path, (touched, touched))
+    return path
+
+
+def test_work_dir_is_stable_and_safe(tmp_path):
+    root = str(tmp_path)
+    assert workdirs.work_dir("S1", root=root) == workdirs.work_dir("S1", root=root)
+    assert os.path.basename(workdirs.work_dir("S1", root=root)).startswith("S1-")
+    unsafe = workdirs.work_dir("../x y", root=root)
+    assert os.path.dirname(unsafe) == root
+    assert os.path.basename(unsafe).startswith(".._x_y-")
+    # ids that sanitize to the same name still get their own directory
+    assert workdirs.work_dir("a b", root=root) != workdirs.work_dir("a_b", root=root)
+
+
+def test_finish_removes_or_marks(tmp_path):
+    path = make_dir(tmp_path, "S1", age=0)
+    workdirs.finish(path, retention=timedelta(hours=1))
+    assert os.path.exists(os.path.join(path, workdirs.COMPLETED_MARKER))
+    workdirs.finish(path, retention=timedelta(0))
+    assert not os.path.exists(path)
+
+
+def test_prune_retention(tmp_path):
+    old_completed = make_dir(tmp_path, "a", age=2 * DAY, completed=True)
+    new_completed = make_dir(tmp_path, "b", age=60, completed=True)
+    old_failed = make_dir(tmp_path, "c", age=20 * DAY)
+    new_failed = make_dir(tmp_path, "d", age=2 * DAY)
+    removed = workdirs.prune(
+        str(tmp_path),
+        completed_retention=timedelta(days=1),
+        failed_retention=timedelta(days=14),
+        max_bytes=0,
+    )
+    assert sorted(removed) == [old_completed, old_failed]
+    assert os.path.exists(new_completed) and os.path.exists(new_failed)
+
+
+def test_prune_size_limit_spares_live_runs(tmp_path):
+    completed = make_dir(tmp_path, "a", age=60, size=1000, completed=True)
+    idle = make_dir(tmp_path, "b", age=2 * DAY, size=1000)
+    live = make_dir(tmp_path, "c", age=60, size=1000)
+    kwargs = dict(completed_retention=timedelta(days=1), failed_retention=timedelta(days=14))
+    assert workdirs.prune(str(tmp_path), max_bytes=2500, dry_run=True, **kwargs) == [completed]
+    assert workdirs.prune(str(tmp_path), max_bytes=500, **kwargs) == [completed, idle]
+    assert os.path.exists(live)